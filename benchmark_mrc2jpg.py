@@ -0,0 +1,311 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+import mrc_io
+from mrc_filters import gaussian_lowpass, mean_shrink
+
+#(ny, nx) of common detectors
+DETECTORS = {'ccd': (4096, 4096),
+             'falcon': (4096, 4096),
+             'k2': (3710, 3838),
+             'k3': (4092, 5760),
+             'k3_super': (8184, 11520)}
+
+MRC2JPG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mrc2jpg.py')
+
+
+def synthetic_signal(shape, rng, n_particles=300, radius=40):
+    '''
+    a smooth background with bright discs, values around 1.
+    Deterministic for a given rng state
+    '''
+    ny, nx = shape
+    y = np.linspace(-1, 1, ny, dtype='f4')[:, np.newaxis]
+    x = np.linspace(-1, 1, nx, dtype='f4')[np.newaxis, :]
+    signal = 1 + 0.1 * x + 0.05 * y ** 2
+    yy, xx = np.mgrid[-radius:radius, -radius:radius]
+    disc = (0.2 * (xx ** 2 + yy ** 2 < radius ** 2)).astype('f4')
+    for cy, cx in zip(rng.integers(0, ny - 2 * radius, n_particles),
+                      rng.integers(0, nx - 2 * radius, n_particles)):
+        signal[cy:cy + 2 * radius, cx:cx + 2 * radius] += disc
+    return signal
+
+
+def synthetic_frame(signal, dtype, rng, dose):
+    #counting detectors give integers, float modes get gaussian noise
+    if dtype.kind in 'iu':
+        frame = rng.poisson(signal * dose)
+        info = np.iinfo(dtype)
+        return np.clip(frame, info.min, info.max).astype(dtype)
+    return (signal + rng.standard_normal(signal.shape, dtype='f4')).astype(dtype)
+
+
+def write_synthetic_mrc(path, shape, mode, frames=1, seed=0, apix=1.0, dose=30.):
+    '''
+    writes a deterministic synthetic micrograph (frames=1) or movie.
+    Frames are written one at a time, so large stacks never sit in memory.
+    For movies the dose is spread over the frames
+    '''
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(mrc_io.MODES[mode]).newbyteorder('<')
+    signal = synthetic_signal(shape, rng)
+    header = mrc_io.make_header((frames,) + tuple(shape), dtype, voxel_size=apix,
+                                labels=['synthetic, seed {}'.format(seed)])
+    with open(path, 'wb') as f:
+        f.write(header.tobytes())
+        for _ in range(frames):
+            f.write(synthetic_frame(signal, dtype, rng, dose / frames).tobytes())
+    return path
+
+
+def peak_rss_mb(usage):
+    #linux reports kB, macOS bytes
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return usage.ru_maxrss * scale / 2 ** 20
+
+
+def run_isolated(func, *args):
+    '''
+    runs func in a fresh child process. Children inherit the peak rss of
+    their parent, so all heavy work is kept out of the benchmark process
+    '''
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(func, *args).result()
+
+
+class Benchmark(object):
+
+    def __init__(self):
+        super().__init__()
+        self.parse_arguments()
+        self.check_args()
+
+    def parse_arguments(self):
+        parser = argparse.ArgumentParser(description='Benchmark of the mrc2jpg conversion')
+        parser.add_argument('--detectors', help='Comma separated detector sizes, from '
+                            '{}. Default: k2,k3'.format(','.join(DETECTORS)))
+        parser.add_argument('--modes', help='Comma separated mrc modes. Default: 2,1')
+        parser.add_argument('--frames', help='Comma separated stack depths, 1 is a '
+                            'single micrograph. Default: 1')
+        parser.add_argument('--n_files', help='Micrographs per configuration for the '
+                            'throughput runs. Default: 8')
+        parser.add_argument('--n_cpus', help='Comma separated worker counts for the '
+                            'throughput runs. Default: 1,2,4 (up to available cpus)')
+        parser.add_argument('--scale', help='Shrink factor passed to mrc2jpg. Default: 4')
+        parser.add_argument('--lowpass', help='Lowpass in Angstrom passed to mrc2jpg. '
+                            'Default: 20')
+        parser.add_argument('--flip', help='Convert with --noflip (flipped jpgs) and '
+                            'time the flip, which the default conversion does not do',
+                            action='store_true')
+        parser.add_argument('--repeat', help='Repetitions of the stage timings, the '
+                            'median is reported. Default: 3')
+        parser.add_argument('--workdir', help='Where synthetic data is written and kept '
+                            'between runs. Default: a temporary folder')
+        parser.add_argument('--generate_only', help='Only write the synthetic data to '
+                            '--workdir', action='store_true')
+        parser.add_argument('-o', help='File the results are appended to, one json '
+                            'record per line. Default: benchmark_mrc2jpg.jsonl')
+        parser.parse_args(namespace=self)
+        return parser
+
+    def check_args(self):
+        try:
+            self.detectors = (self.detectors or 'k2,k3').split(',')
+            self.modes = [int(m) for m in (self.modes or '2,1').split(',')]
+            self.frames = [int(n) for n in (self.frames or '1').split(',')]
+            self.n_files = int(self.n_files or 8)
+            cpus = os.cpu_count() or 1
+            self.n_cpus = [int(n) for n in (self.n_cpus or '1,2,4').split(',')]
+            self.n_cpus = sorted({n for n in self.n_cpus if n <= cpus}) or [1]
+            self.scale = int(self.scale or 4)
+            self.lowpass = int(self.lowpass or 20)
+            self.repeat = int(self.repeat or 3)
+        except ValueError as e:
+            sys.exit('Invalid argument: {}'.format(e))
+        for d in self.detectors:
+            if d not in DETECTORS:
+                sys.exit('Unknown detector {}. Choose from {}'.format(d, ', '.join(DETECTORS)))
+        for m in self.modes:
+            if m not in mrc_io.MODES:
+                sys.exit('Mode {} is not supported'.format(m))
+        if self.generate_only and not self.workdir:
+            sys.exit('--generate_only needs --workdir')
+        self.cleanup = not self.workdir
+        if not self.workdir:
+            self.workdir = tempfile.mkdtemp(prefix='mrc2jpg_bench_')
+        if not self.o:
+            self.o = 'benchmark_mrc2jpg.jsonl'
+
+    def generate(self, detector, mode, frames):
+        #one folder per configuration, files are reused if already there
+        folder = os.path.join(self.workdir, '{}_mode{}_frames{}'.format(detector, mode, frames))
+        os.makedirs(folder, exist_ok=True)
+        files = []
+        for i in range(self.n_files):
+            path = os.path.join(folder, 'synthetic_{:04d}.mrc'.format(i))
+            if not mrc_io.is_complete(path):
+                write_synthetic_mrc(path, DETECTORS[detector], mode, frames, seed=i)
+            files.append(path)
+        return folder, files
+
+    def make_converter(self, folder):
+        #the real pipeline object, configured through its own command line
+        from mrc2jpg import imageConverter
+        argv = sys.argv
+        sys.argv = ['mrc2jpg.py', '-i', folder, '-o', os.path.join(folder, 'jpgs'),
+                    '-f', '--scale', str(self.scale), '--lowpass', str(self.lowpass),
+                    '--n_cpus', '1'] + (['--noflip'] if self.flip else [])
+        try:
+            return imageConverter()
+        finally:
+            sys.argv = argv
+
+    def time_stages(self, folder, mrcfile):
+        '''
+        median seconds of each step of the conversion of one file, in the
+        order the pipeline runs them, and the peak rss of the process.
+        The steps are those of imageConverter.process: read is the memory
+        map and copy of a micrograph, or converter.sum_frames for a movie
+        (streamed sum, each frame prebinned when the lowpass allows it).
+        The file is in the page cache after generation, so read is not the
+        cost of the disk. flip is only timed with --flip, the default
+        conversion does not flip
+        '''
+        with contextlib.redirect_stdout(io.StringIO()):
+            converter = self.make_converter(folder)
+        preprocessor = converter.preprocessor
+        steps = ['read', 'shrink', 'filter', 'normalize'] + (['flip'] if self.flip else [])
+        times = {k: [] for k in steps + ['encode']}
+        for _ in range(self.repeat):
+            t = time.perf_counter()
+            header, data = mrc_io.read_mrc(mrcfile)
+            apix = mrc_io.voxel_size(header)[0] or 1.0
+            if data.shape[0] > 1:
+                del data
+                image, binned = converter.sum_frames(mrcfile, apix)
+            else:
+                image, binned = np.array(data[0], dtype='f4'), 1
+            times['read'].append(time.perf_counter() - t)
+            #the rest of Preprocessor.__call__, one step at a time
+            apix *= binned
+            scale = preprocessor.scale // binned
+            shrink_first = preprocessor.shrink_first(apix, scale)
+            if shrink_first:
+                t = time.perf_counter()
+                image = mean_shrink(image, scale)
+                times['shrink'].append(time.perf_counter() - t)
+                apix *= scale
+            t = time.perf_counter()
+            image = gaussian_lowpass(image, preprocessor.lowpass * apix)
+            times['filter'].append(time.perf_counter() - t)
+            if not shrink_first:
+                t = time.perf_counter()
+                image = mean_shrink(image, scale)
+                times['shrink'].append(time.perf_counter() - t)
+            t = time.perf_counter()
+            image = converter.to_8bit(image)
+            times['normalize'].append(time.perf_counter() - t)
+            if self.flip:
+                t = time.perf_counter()
+                image = np.ascontiguousarray(image[::-1])
+                times['flip'].append(time.perf_counter() - t)
+            t = time.perf_counter()
+            Image.fromarray(image).save(io.BytesIO(), 'JPEG')
+            times['encode'].append(time.perf_counter() - t)
+        stages = {k: statistics.median(v) for k, v in times.items()}
+        return (stages, shrink_first, binned, 
+                peak_rss_mb(resource.getrusage(resource.RUSAGE_SELF)))
+
+    def time_workers(self, folder, files, n_cpus):
+        #a full mrc2jpg run in a child process, so startup and peak rss are included
+        cmd = [sys.executable, MRC2JPG, '-i', folder, '-o', os.path.join(folder, 'jpgs'),
+               '-f', '--scale', str(self.scale), '--lowpass', str(self.lowpass),
+               '--n_cpus', str(n_cpus)] + (['--noflip'] if self.flip else [])
+        #stderr goes to a file: a pipe that nobody reads while waiting could fill up
+        with tempfile.TemporaryFile() as stderr:
+            t = time.perf_counter()
+            p = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=stderr)
+            _, status, usage = os.wait4(p.pid, 0)
+            seconds = time.perf_counter() - t
+            #reaped here, Popen must not wait for it again
+            p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) \
+                           else os.WEXITSTATUS(status)
+            stderr.seek(0)
+            err = stderr.read().decode(errors='replace')
+        if status:
+            print('mrc2jpg failed with {} workers:\n{}'.format(n_cpus, err))
+        megabytes = sum(os.path.getsize(f) for f in files) / 2 ** 20
+        return {'n_cpus': n_cpus,
+                'seconds': seconds,
+                'micrographs_per_s': len(files) / seconds,
+                'mb_per_s': megabytes / seconds,
+                'peak_rss_mb': peak_rss_mb(usage),
+                'failed': bool(status)}
+
+    def environment(self):
+        try:
+            commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                             cwd=os.path.dirname(MRC2JPG),
+                                             stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'commit': commit,
+                'host': platform.node(),
+                'cpus': os.cpu_count(),
+                'python': platform.python_version(),
+                'numpy': np.__version__}
+
+    def main(self):
+        env = self.environment()
+        for detector in self.detectors:
+            for mode in self.modes:
+                for frames in self.frames:
+                    print('Generating {} mode {} with {} frames'.format(detector, mode, frames))
+                    folder, files = run_isolated(self.generate, detector, mode, frames)
+                    if self.generate_only:
+                        continue
+                    record = dict(env, detector=detector, shape=DETECTORS[detector],
+                                  mode=mode, frames=frames, n_files=len(files),
+                                  scale=self.scale, lowpass=self.lowpass,
+                                  flip=self.flip)
+                    stages, shrink_first, prebin, rss = run_isolated(self.time_stages, 
+                                                                     folder, files[0])
+                    record['stages'] = stages
+                    record['shrink_first'] = shrink_first
+                    record['prebin'] = prebin
+                    record['stages_peak_rss_mb'] = rss
+                    record['workers'] = [self.time_workers(folder, files, n)
+                                         for n in self.n_cpus]
+                    with open(self.o, 'a') as f:
+                        f.write(json.dumps(record) + '\n')
+                    self.print_record(record)
+        if self.cleanup:
+            shutil.rmtree(self.workdir)
+        if not self.generate_only:
+            print('Results appended to {}'.format(self.o))
+
+    def print_record(self, record):
+        stages = ', '.join('{} {:.3f}s'.format(k, v) for k, v in record['stages'].items())
+        print('  stages: {}'.format(stages))
+        for w in record['workers']:
+            print('  {n_cpus} workers: {micrographs_per_s:.2f} micrographs/s, '
+                  '{mb_per_s:.1f} MB/s, peak rss {peak_rss_mb:.0f} MB'.format(**w))
+
+
+if __name__ == '__main__':
+    b = Benchmark()
+    b.main()
@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import emscripts
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EMSCRIPTS = os.path.join(HERE, 'emscripts.py')
+
+#prints the seconds spent importing the module, in a fresh interpreter
+IMPORT_TIMER = ('import sys, time; sys.path.insert(0, {!r}); t = time.perf_counter(); '
+                'import {}; print(time.perf_counter() - t)')
+
+
+class StartupBenchmark(object):
+    '''
+    cost of starting each emscripts subcommand, every measurement in a new
+    interpreter as it happens in watch loops and array jobs:
+    the import of the module alone, and a full "emscripts <command> -h".
+    The interpreter itself and "emscripts -h" (no subcommand imported) are
+    the baselines
+    '''
+
+    def __init__(self):
+        super(StartupBenchmark, self).__init__()
+        self.parse_arguments()
+        self.check_args()
+
+    def parse_arguments(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--commands', help='Comma separated subcommands. '
+                            'Default: all')
+        parser.add_argument('--repeat', help='Runs of each measurement, the median is '
+                            'reported. Default: 5')
+        parser.add_argument('--importtime', help='Also list the slowest imports of '
+                            'each module (python -X importtime)', action='store_true')
+        parser.add_argument('-o', help='File the results are appended to, one json '
+                            'record per line. Default: benchmark_startup.jsonl')
+        parser.parse_args(namespace=self)
+        return parser
+
+    def check_args(self):
+        self.commands = self.commands.split(',') if self.commands else list(emscripts.COMMANDS)
+        for c in self.commands:
+            if c not in emscripts.COMMANDS:
+                sys.exit('Unknown command {}. Choose from {}'.format(
+                                                c, ', '.join(emscripts.COMMANDS)))
+        try:
+            self.repeat = int(self.repeat or 5)
+        except ValueError:
+            sys.exit('--repeat must be an integer')
+        if not self.o:
+            self.o = 'benchmark_startup.jsonl'
+
+    def wall_time(self, cmd):
+        #median seconds of cmd, run --repeat times. None if it fails
+        times = []
+        for _ in range(self.repeat):
+            t = time.perf_counter()
+            p = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - t)
+            if p.returncode:
+                return None
+        return statistics.median(times)
+
+    def import_time(self, module):
+        times = []
+        for _ in range(self.repeat):
+            p = subprocess.run([sys.executable, '-c', IMPORT_TIMER.format(HERE, module)],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            if p.returncode:
+                return None #a dependency is missing
+            times.append(float(p.stdout))
+        return statistics.median(times)
+
+    def slowest_imports(self, module, n=5):
+        '''
+        [(cumulative seconds, package)] of the packages imported directly by
+        the module that take the longest, from python -X importtime
+        '''
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                           cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        imports = []
+        for line in p.stderr.decode().splitlines():
+            #import time: self [us] | cumulative | imported package
+            fields = line.split('|')
+            if not line.startswith('import time:') or len(fields) != 3:
+                continue
+            name = fields[2].rstrip()
+            depth = (len(name) - len(name.lstrip())) // 2
+            if depth == 0 and name.strip() == module:
+                #everything before it was imported by the module
+                return sorted(imports, reverse=True)[:n]
+            if depth == 1 and fields[1].strip().isdigit():
+                imports.append((int(fields[1]) / 1e6, name.strip()))
+        return []
+
+    def environment(self):
+        return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'host': platform.node(),
+                'python': platform.python_version()}
+
+    def main(self):
+        record = self.environment()
+        record['python_startup'] = self.wall_time([sys.executable, '-c', 'pass'])
+        record['dispatcher'] = self.wall_time([sys.executable, EMSCRIPTS, '-h'])
+        print('python startup {:.3f}s, emscripts -h {:.3f}s'.format(
+                                record['python_startup'], record['dispatcher']))
+        record['commands'] = {}
+        print('{:<26}{:>10}{:>10}'.format('command', 'import', '-h'))
+        for command in self.commands:
+            module = emscripts.COMMANDS[command][0]
+            result = {'module': module,
+                      'import': self.import_time(module),
+                      'help': self.wall_time([sys.executable, EMSCRIPTS, command, '-h'])}
+            if self.importtime:
+                result['slowest_imports'] = self.slowest_imports(module)
+            record['commands'][command] = result
+            print('{:<26}{:>10}{:>10}'.format(command,
+                    *('{:.3f}s'.format(t) if t is not None else 'failed'
+                      for t in (result['import'], result['help']))))
+            for seconds, name in result.get('slowest_imports', []):
+                print('    {:>8.3f}s {}'.format(seconds, name))
+        with open(self.o, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        print('Results appended to {}'.format(self.o))
+
+
+def main():
+    b = StartupBenchmark()
+    b.main()
+
+
+if __name__ == '__main__':
+    main()
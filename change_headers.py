@@ -1,38 +1,161 @@
+import argparse
 import os
+import sys
+from contextlib import ExitStack
+import fasta_io
 
-filename = '/home/andrea/Downloads/usp48.fasta'
-s = 'mrglvrem'
-i=1
-
-def uniquify(i):
-    with open(filename, 'r') as f_in:
-        with open(filename + '_corrected', 'w') as out:
-            for line in f_in:
-                if line.startswith('>'):
-                    new_line = line.replace('\n','') + '_' + str(i) + '\n'
-                    out.write(new_line)
-                    i+=1
-                else:
-                    out.write(line)
-            
-def uniquify_trim(pos):
-    i = 0
-    with open(filename, 'r') as f_in:
-        with open(filename + '_trimmed', 'w') as out:
-            for line in f_in:
-                if line.startswith('>'):
-                    new_line = line.replace('\n','') + '_' + str(i) + '\n'
-                    out.write(new_line)
-                    i+=1
-                else:
-                    out.write(line[pos:])
-                    
-def find_shit(pattern):
-    with open(filename, 'r') as f_in:
-        for line in f_in:
-            if pattern.upper() in line:
-                return line.find(pattern.upper())
-                
-                    
-#   
-uniquify_trim(find_shit('ialiwps'))
\ No newline at end of file
+
+class HeaderChanger(object):
+    '''
+    one pass over a fasta file (plain or gzipped): headers made unique by
+    numbering them, and/or every sequence trimmed to start at its own match
+    of a motif. The records are streamed, memory use does not depend on the
+    size of the file. With --fetch records are read from the input instead,
+    through its .fai index
+    '''
+
+    def __init__(self):
+        super(HeaderChanger, self).__init__()
+        self.parse_arguments()
+        self.check_args()
+
+    def parse_arguments(self):
+        parser = argparse.ArgumentParser(description='Uniquify headers and trim '
+                                         'sequences of a fasta file')
+        parser.add_argument('fasta', help='Input fasta, plain or gzipped')
+        parser.add_argument('-o', help='Output file, gzipped if it ends with .gz. '
+                            'Default: [fasta]_trimmed with --motif, else [fasta]_corrected')
+        parser.add_argument('--uniquify', help='Append _1, _2 ... to the name of '
+                            'every record written (records left out by '
+                            '--drop_missing are not counted)', action='store_true')
+        parser.add_argument('--motif', help='Trim every sequence to start at its '
+                            'first match of the motif (case insensitive)')
+        parser.add_argument('--before', help='Residues kept before the motif. '
+                            'Default: 0')
+        parser.add_argument('--ignore_gaps', help='Alignments: the motif may be '
+                            'interrupted by gaps', action='store_true')
+        parser.add_argument('--drop_missing', help='Leave out the records without '
+                            'the motif (default: written untrimmed)', action='store_true')
+        parser.add_argument('--index', help='Also write a .fai index of the output',
+                            action='store_true')
+        parser.add_argument('--fetch', help='Print these records of the input '
+                            '(name or name:start-end, 1 based), using its .fai '
+                            'index. The index is built if needed', nargs='+')
+        parser.parse_args(namespace=self)
+        return parser
+
+    def check_args(self):
+        if not os.path.isfile(self.fasta):
+            sys.exit('{} does not exist'.format(self.fasta))
+        try:
+            self.before = int(self.before or 0)
+        except ValueError:
+            sys.exit('--before must be an integer')
+        if self.fetch:
+            if fasta_io.is_gzipped(self.fasta):
+                sys.exit('--fetch needs an uncompressed fasta file')
+            return
+        if not (self.uniquify or self.motif):
+            sys.exit('Nothing to do: use --uniquify and/or --motif')
+        if not self.o:
+            base = self.fasta[:-3] if self.fasta.endswith('.gz') else self.fasta
+            self.o = base + ('_trimmed' if self.motif else '_corrected')
+        if self.index and self.o.endswith('.gz'):
+            sys.exit('Compressed output cannot be indexed')
+
+    def rename(self, header, n):
+        #the number goes on the name, so that the names are unique
+        name, _, description = header.partition(b' ')
+        name += b'_' + str(n).encode()
+        return name + b' ' + description if description else name
+
+    def process(self):
+        pattern = fasta_io.motif_pattern(self.motif, self.ignore_gaps) if self.motif \
+                  else None
+        records, missing = 0, 0
+        offset = 0
+        tmp = self.o + '.tmp'
+        tmp_fai = fasta_io.index_path(tmp)
+        try:
+            with ExitStack() as stack:
+                out = stack.enter_context(fasta_io.open_fasta(tmp, 'wb',
+                                                              self.o.endswith('.gz')))
+                #the index is written along, entries are not kept in memory
+                fai = stack.enter_context(open(tmp_fai, 'w')) if self.index else None
+                for header, lines in fasta_io.iter_records(self.fasta):
+                    sequence = b''.join(lines)
+                    #keep the line length of the input
+                    width = len(lines[0]) if len(lines) > 1 else 0
+                    if pattern:
+                        match = pattern.search(sequence)
+                        if match:
+                            sequence = sequence[max(0, match.start() - self.before):]
+                        else:
+                            missing += 1
+                            if self.drop_missing:
+                                continue
+                    records += 1
+                    if self.uniquify:
+                        header = self.rename(header, records)
+                    record = fasta_io.format_record(header, sequence, width)
+                    if fai:
+                        linebases = min(width or len(sequence), len(sequence))
+                        fai.write('{}\t{}\t{}\t{}\t{}\n'.format(
+                                    fasta_io.record_name(header), len(sequence),
+                                    offset + len(header) + 2, linebases,
+                                    linebases + 1 if linebases else 0))
+                    out.write(record)
+                    offset += len(record)
+        except BaseException:
+            #nothing half written is left next to the output
+            for path in (tmp, tmp_fai):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        os.replace(tmp, self.o)
+        if self.index:
+            os.replace(tmp_fai, fasta_io.index_path(self.o))
+        return records, missing
+
+    def parse_region(self, region):
+        #name or name:start-end, 1 based and inclusive as samtools
+        name, _, span = region.rpartition(':')
+        if not name or '-' not in span:
+            return region, 0, None
+        start, _, end = span.partition('-')
+        try:
+            return name, int(start) - 1, int(end)
+        except ValueError:
+            return region, 0, None
+
+    def fetch_records(self):
+        index = fasta_io.get_index(self.fasta)
+        out = sys.stdout.buffer
+        for region in self.fetch:
+            name, start, end = (region, 0, None) if region in index \
+                               else self.parse_region(region)
+            if name not in index:
+                sys.exit('{} not found in {}'.format(name, self.fasta))
+            entry = index[name]
+            sequence = fasta_io.fetch(self.fasta, entry, start, end)
+            header = region if end is not None else name
+            out.write(fasta_io.format_record(header.encode(), sequence, entry.linebases))
+        out.flush()
+
+    def main(self):
+        try:
+            if self.fetch:
+                return self.fetch_records()
+            records, missing = self.process()
+        except ValueError as e:
+            #a malformed fasta, or one that cannot be indexed
+            sys.exit(str(e))
+        print('{} records written to {}'.format(records, self.o))
+        if self.motif:
+            print('{} records without {}{}'.format(missing, self.motif,
+                                                  ', left out' if self.drop_missing else ''))
+
+
+if __name__ == '__main__':
+    c = HeaderChanger()
+    c.main()
@@ -0,0 +1,76 @@
+import importlib
+import sys
+
+#subcommand -> (module, entry point, description).
+#The entry point is a class, that is instantiated (it parses the command line)
+#and then run with .main(), or a function that is called without arguments.
+#Nothing is imported until a subcommand is run: this module must stay free
+#of heavy imports, it is started thousands of times by watch loops and
+#cluster array jobs
+COMMANDS = {
+    'mrc2jpg': ('mrc2jpg', 'imageConverter',
+                'Convert mrc micrographs to jpg previews'),
+    'gautomatch-screener': ('gautomatch_screener', 'Gautomatcher',
+                            'Screen gautomatch parameters on a set of micrographs'),
+    'screener-results': ('screener_results', 'main',
+                         'Summary of the results of gautomatch-screener'),
+    'remove-from-jpg': ('remove_from_jpg', 'Micrograph_remover',
+                        'Rename/delete the micrographs whose jpg was deleted'),
+    'remove-jpg-from-starfile': ('remove_jpg_from_starfile', 'main',
+                                 'Keep only the micrographs with a jpg in a star file'),
+    'filenames-from-starfile': ('filenames_from_starfile', 'main',
+                                'List the micrograph names of a star file'),
+    'relion-to-cistem': ('relion_to_cistem_ptcls', 'CistemExporter',
+                         'Export Relion particle coordinates to cisTEM'),
+    'change-headers': ('change_headers', 'HeaderChanger',
+                       'Uniquify headers, trim sequences at a motif, index fasta files'),
+    'rename-files': ('rename_files', 'BulkRenamer',
+                     'Renumber (zero pad, shift) or rename files, collision safe'),
+    'word-frequency': ('word_frequency_psiblast', 'command_line',
+                       'Word frequencies of the hit descriptions of a BLAST xml'),
+    'benchmark-mrc2jpg': ('benchmark_mrc2jpg', 'Benchmark',
+                          'Benchmark mrc2jpg on synthetic micrographs'),
+    'benchmark-startup': ('benchmark_startup', 'main',
+                          'Startup and import time of every subcommand'),
+    }
+
+
+def usage():
+    width = max(len(c) for c in COMMANDS)
+    lines = ['usage: emscripts <command> [options]', '',
+             'commands:']
+    lines += ['  {:<{}}  {}'.format(c, width, COMMANDS[c][2]) for c in COMMANDS]
+    lines += ['', 'emscripts <command> -h shows the options of a command']
+    return '\n'.join(lines)
+
+
+def load(command):
+    #imports the module of the subcommand, and only that
+    module, entry, _ = COMMANDS[command]
+    return getattr(importlib.import_module(module), entry)
+
+
+def run(command, args):
+    entry = load(command)
+    #the tools parse sys.argv themselves
+    sys.argv = ['emscripts ' + command] + list(args)
+    if isinstance(entry, type):
+        return entry().main()
+    return entry()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0
+    command = argv[0].replace('_', '-')
+    if command not in COMMANDS:
+        sys.exit('Unknown command {}\n\n{}'.format(argv[0], usage()))
+    #errors end the tools with sys.exit, return values are not exit codes
+    run(command, argv[1:])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
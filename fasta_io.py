@@ -0,0 +1,185 @@
+import gzip
+import os
+import re
+from collections import namedtuple
+
+#FASTA files, plain or gzipped, read one record at a time in binary mode.
+#Uncompressed files can be indexed with a samtools style .fai file:
+#one line per record with name, length, offset of the sequence,
+#residues per line and bytes per line, so that any record (or any part of
+#it) is read with a single seek
+
+INDEX_SUFFIX = '.fai'
+
+FaiEntry = namedtuple('FaiEntry', 'name length offset linebases linewidth')
+
+
+def is_gzipped(fasta):
+    with open(fasta, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def open_fasta(fasta, mode='rb', compressed=None):
+    #gzip is recognised from the content when reading, from the name when writing
+    if compressed is None:
+        compressed = fasta.endswith('.gz') if 'w' in mode else is_gzipped(fasta)
+    if compressed:
+        return gzip.open(fasta, mode, compresslevel=6)
+    return open(fasta, mode, buffering=2 ** 20)
+
+
+def record_name(header):
+    #the first word of the header, as samtools
+    return header.split(None, 1)[0].decode() if header.strip() else ''
+
+
+def iter_records(fasta):
+    '''
+    (header, lines) of every record: the header without > and the lines of
+    the sequence, without line ends. Only one record is in memory at a time
+    '''
+    header = None
+    lines = []
+    with open_fasta(fasta) as f:
+        for line in f:
+            line = line.rstrip(b'\r\n')
+            if line.startswith(b'>'):
+                if header is not None:
+                    yield header, lines
+                header = line[1:]
+                lines = []
+            elif header is not None:
+                if line:
+                    lines.append(line)
+            elif line.strip():
+                raise ValueError('{} does not start with a > header'.format(fasta))
+    if header is not None:
+        yield header, lines
+
+
+def format_record(header, sequence, width=0):
+    '''
+    the bytes of one record, the sequence in lines of width residues
+    (0: on one line)
+    '''
+    if not sequence:
+        return b'>' + header + b'\n'
+    if not width or len(sequence) <= width:
+        return b'>' + header + b'\n' + sequence + b'\n'
+    lines = [sequence[i:i + width] for i in range(0, len(sequence), width)]
+    return b'>' + header + b'\n' + b'\n'.join(lines) + b'\n'
+
+
+def motif_pattern(motif, ignore_gaps=False):
+    '''
+    compiled, case insensitive pattern of a motif. With ignore_gaps the
+    residues may be separated by alignment gaps (- or .)
+    '''
+    residues = [re.escape(r.encode()) for r in motif]
+    joiner = b'[-.]*' if ignore_gaps else b''
+    return re.compile(joiner.join(residues), re.IGNORECASE)
+
+
+def index_path(fasta):
+    return fasta + INDEX_SUFFIX
+
+
+def index_entry(name, sequence_offset, lines):
+    '''
+    the FaiEntry of a record whose sequence starts at sequence_offset.
+    lines: (residues, bytes) of every line, line end included
+    '''
+    if not lines:
+        return FaiEntry(name, 0, sequence_offset, 0, 0)
+    linebases, linewidth = lines[0]
+    if linewidth == linebases:
+        #a single line without line end, at the end of the file (as samtools)
+        linewidth += 1
+    for residues, width in lines[1:-1]:
+        if (residues, width) != (linebases, linewidth):
+            raise ValueError('The lines of {} do not have the same length, it '
+                             'cannot be indexed'.format(name))
+    residues, width = lines[-1]
+    if residues > linebases:
+        raise ValueError('The last line of {} is longer than the others, it '
+                         'cannot be indexed'.format(name))
+    #the last line of the file may have no line end
+    if width != residues and width - residues != linewidth - linebases:
+        raise ValueError('The line ends of {} are not all the same, it '
+                         'cannot be indexed'.format(name))
+    return FaiEntry(name, sum(r for r, _ in lines), sequence_offset,
+                    linebases, linewidth)
+
+
+def build_index(fasta):
+    '''
+    writes [fasta].fai, in one pass over the file. Returns the entries
+    '''
+    if is_gzipped(fasta):
+        raise ValueError('{} is compressed. Only plain files can be indexed'.format(fasta))
+    entries = []
+    name = None
+    lines = []
+    offset = 0
+    sequence_offset = 0
+    with open(fasta, 'rb', buffering=2 ** 20) as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    entries.append(index_entry(name, sequence_offset, lines))
+                name = record_name(line[1:])
+                sequence_offset = offset + len(line)
+                lines = []
+            elif line.strip():
+                lines.append((len(line.rstrip(b'\r\n')), len(line)))
+            offset += len(line)
+    if name is not None:
+        entries.append(index_entry(name, sequence_offset, lines))
+    write_index(index_path(fasta), entries)
+    return entries
+
+
+def write_index(fai, entries):
+    with open(fai, 'w') as f:
+        for e in entries:
+            f.write('{}\t{}\t{}\t{}\t{}\n'.format(*e))
+
+
+def load_index(fasta):
+    '''
+    {name: FaiEntry}, None if there is no index or it is older than the file
+    '''
+    fai = index_path(fasta)
+    try:
+        if os.path.getmtime(fai) < os.path.getmtime(fasta):
+            return None
+        with open(fai, 'r') as f:
+            entries = (line.rstrip('\n').split('\t') for line in f if line.strip())
+            return {e[0]: FaiEntry(e[0], *map(int, e[1:5])) for e in entries}
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_index(fasta):
+    index = load_index(fasta)
+    if index is None:
+        index = {e.name: e for e in build_index(fasta)}
+    return index
+
+
+def fetch(fasta, entry, start=0, end=None):
+    '''
+    residues start to end (0 based, end excluded) of the record of a
+    FaiEntry, read with one seek
+    '''
+    end = entry.length if end is None else min(end, entry.length)
+    if start >= end or not entry.linebases:
+        return b''
+    first = entry.offset + start // entry.linebases * entry.linewidth \
+            + start % entry.linebases
+    last = entry.offset + (end - 1) // entry.linebases * entry.linewidth \
+           + (end - 1) % entry.linebases
+    with open(fasta, 'rb') as f:
+        f.seek(first)
+        raw = f.read(last - first + 1)
+    return raw.replace(b'\n', b'').replace(b'\r', b'')
@@ -1,21 +1,28 @@
+import argparse
 import os
+import star_io
 
-def main():
-    os.chdir(workdir)
-    with open(starfile, 'r') as f:
-        temp = f.readlines()
-    filenames = [os.path.basename(line.split()[0]) 
-                 for line in temp 
-                 if line.strip() 
-                 if not line.startswith('_')
-                 if not line.rstrip().endswith('_')]
-    
+def write_filenames(starfile, outfile, workers=1):
+    if workers > 1:
+        star_io.filter_star_sharded(starfile, outfile, columns=['rlnMicrographName'],
+                                    header=False, strip_paths=True, workers=workers)
+        return
+    filenames = (os.path.basename(name) for name, in 
+                 star_io.iter_rows(starfile, ['rlnMicrographName']))
     with open(outfile, 'w') as f:
-        f.write('\n'.join(filenames))
+        f.writelines(name + '\n' for name in filenames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes the names of the micrographs '
+                                     'of a star file, one per line, without folders')
+    parser.add_argument('starfile', help='e.g. micrographs.star')
+    parser.add_argument('-o', help='Output file. Default: names.txt', default='names.txt')
+    parser.add_argument('--workers', help='More than 1: large star files are split '
+                        'and read in parallel. Default: 1', type=int, default=1)
+    args = parser.parse_args()
+    write_filenames(args.starfile, args.o, args.workers)
 
 
 if __name__ == '__main__':
-    workdir = '/local_data/andrea/relion3_benchmark/Select/ctf_res'
-    starfile = 'micrographs.star'
-    outfile = 'names.txt'
-    main()
\ No newline at end of file
+    main()
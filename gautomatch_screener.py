@@ -5,11 +5,47 @@ import argparse
 import os
 import json
 import sys
-from PIL import Image, ImageDraw, ImageFont
-from subprocess import Popen, PIPE
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+from subprocess import Popen, PIPE, run, CalledProcessError
 import shutil
 import glob
-from concurrent.futures import ProcessPoolExecutor
+import tempfile
+import hashlib
+import math
+import multiprocessing
+from collections import deque
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor, wait, 
+                                FIRST_COMPLETED)
+from functools import lru_cache
+import mrc_io
+import star_io
+import screener_results
+
+FONT_FILE = '/usr/share/fonts/truetype/ubuntu-font-family/UbuntuMono-R.ttf'
+COLORS = ['#00ff00', '#ff0000', '#0000ff', '#ffff00', '#ff00ff', '#00ffff']
+
+
+@lru_cache(maxsize=8)
+def load_font(size):
+    try:
+        return ImageFont.truetype(FONT_FILE, size=size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=32)
+def ring_offsets(radius, thickness):
+    '''
+    (dy, dx) of the pixels of a ring of the given inner radius and thickness,
+    centred on 0. Computed once per radius and stamped on every particle
+    '''
+    outer = radius + thickness
+    dy, dx = np.mgrid[-outer:outer + 1, -outer:outer + 1]
+    r2 = dy ** 2 + dx ** 2
+    ring = (r2 >= radius ** 2) & (r2 < outer ** 2)
+    return dy[ring], dx[ring]
+
 
 class Gautomatcher(object):
     
@@ -18,6 +54,7 @@ class Gautomatcher(object):
         self.parse_arguments()
         self.check_args()
         self.mrc_files = glob.glob(os.path.join(self.mrc_folder, '*.mrc'))
+        self.fingerprints = {}
             
     
     def parse_arguments(self):
@@ -33,11 +70,43 @@ class Gautomatcher(object):
         parser.add_argument('--matrix_file', help='The file containing the parameters'
                             'to be tested. Default: [mrc_folder]/test.json')
         parser.add_argument('--debug', help='Activate debug mode', action='store_true')
-        parser.add_argument('--n_threads', help='Number of parallel threads for'
-                            ' execution. Default n=3')
+        parser.add_argument('--n_threads', help='Number of parallel processes for'
+                            ' annotating the jpgs. Default n=3')
+        parser.add_argument('--gpus', help='Comma separated ids of the GPUs to use.'
+                            ' Default: all GPUs reported by nvidia-smi')
+        parser.add_argument('--slots_per_gpu', help='How many gautomatch runs can share'
+                            ' one GPU at the same time. Default: 1')
+        parser.add_argument('--retries', help='How many times a failed gautomatch run'
+                            ' is retried. Default: 1')
+        parser.add_argument('--batch_size', help='Maximum number of micrographs given to '
+                            'one gautomatch call. Default: all micrographs that share a '
+                            'parameter set, split so that every gpu slot has work')
         parser.add_argument('--default_params', help='A json file with starting parameters.'
                             ' Give full path if not in mrc_folder'
                             ' Default: [mrc_folder]/default_gautomatch_paramaters.json')
+        parser.add_argument('--cache_dir', help='Where the results of every gautomatch run '
+                            'are kept, so that repeated or interrupted sweeps only run '
+                            'what is missing. Default: [mrc_folder]/.gautomatch_cache')
+        parser.add_argument('--rerun', help='Ignore cached results and run everything '
+                            'again', action='store_true')
+        parser.add_argument('--adaptive', help='Instead of annotating the full grid, '
+                            'search for the best parameters on a subset of the '
+                            'micrographs, starting from the values in the matrix file. '
+                            'Values outside the range of the matrix file are not '
+                            'tried. The best set has the highest mean figure of merit '
+                            'times log(1 + mean picks per micrograph)', 
+                            action='store_true')
+        parser.add_argument('--subset', help='--adaptive: number of micrographs, evenly '
+                            'spread over the dataset. Default: 8')
+        parser.add_argument('--max_rounds', help='--adaptive: maximum number of '
+                            'refinement rounds. Default: 4')
+        parser.add_argument('--tolerance', help='--adaptive: stop when a round improves '
+                            'the objective by less than this fraction. Default: 0.01')
+        parser.add_argument('--min_picks', help='--adaptive: parameter sets giving fewer '
+                            'picks per micrograph than this are rejected. Default: 10')
+        parser.add_argument('--target_picks', help='--adaptive: aim for this number of '
+                            'picks per micrograph instead of the best mean figure '
+                            'of merit')
         parser.add_argument('--apixM', help='Pixel size in Angstrom')
         parser.add_argument('--diameter', help='Particle diameter, in Angstrom')
         parser.parse_args(namespace=self) 
@@ -69,9 +138,38 @@ class Gautomatcher(object):
         else:
             if not os.path.isdir(self.o):
                 os.makedirs(self.o)
-        #setting n_threads default
-        if not self.n_threads:
-            self.n_threads = 3
+        #setting cache_dir default
+        if not self.cache_dir:
+            self.cache_dir = os.path.join(self.mrc_folder, '.gautomatch_cache')
+        #gpu scheduling
+        try:
+            self.n_threads = int(self.n_threads or 3)
+            self.slots_per_gpu = int(self.slots_per_gpu or 1)
+            self.retries = int(self.retries or 1)
+            self.batch_size = int(self.batch_size or 0)
+            if self.gpus:
+                self.gpus = [int(g) for g in self.gpus.split(',')]
+        except ValueError:
+            sys.exit('--n_threads, --slots_per_gpu, --retries and --batch_size must be '
+                     'integers, --gpus a comma separated list of integers')
+        if self.n_threads < 1:
+            sys.exit('--n_threads must be at least 1')
+        if self.slots_per_gpu < 1:
+            sys.exit('--slots_per_gpu must be at least 1')
+        if self.retries < 0:
+            sys.exit('--retries cannot be negative')
+        #adaptive search
+        try:
+            self.subset = int(self.subset or 8)
+            self.max_rounds = int(self.max_rounds or 4)
+            self.tolerance = float(self.tolerance or 0.01)
+            self.min_picks = float(self.min_picks or 10)
+            self.target_picks = float(self.target_picks) if self.target_picks else None
+        except ValueError:
+            sys.exit('--subset and --max_rounds must be integers, --tolerance, '
+                     '--min_picks and --target_picks numbers')
+        if not self.gpus:
+            self.gpus = self.detect_gpus()
         #setting test default parameters file / checking existence:
         #more convenient to do it this way than using argparse's default= option
         if not self.default_params:
@@ -85,10 +183,10 @@ class Gautomatcher(object):
         #setting test matrix file / checking existence:
         if not self.matrix_file:
             self.matrix_file = os.path.join(self.mrc_folder, 'test.json')
-            self.test = self._import_parameters(self.matrix_file)
         if not os.path.isfile(self.matrix_file):
             msg = f'The matrix file {self.matrix_file} does not exist. Exiting now.'
             sys.exit(msg)
+        self.test = self._import_parameters(self.matrix_file)
         #pixel size can be set via command line, or via defaults file. 
         #command line overrides default file
         #needs to be type float
@@ -104,79 +202,206 @@ class Gautomatcher(object):
         #box size for drawing on image
         self.box_size = float(self.diameter) / float(self.apixM)
         
-    def pick_mrc(self, mrc):
-        try:
-            parms = self.test.copy() #otherwise we end up polluting def_parms
-            parms['filein'] = mrc[0]
-            gid = mrc[1] 
-            print('Processing {}'.format(mrc))
-            for par in self.test:
-                new_jpg = self.copy_jpg(mrc, self.mrc_folder, par)
-                print('Created {}'.format(new_jpg))
-                count = 1
-                coords = {}
-                #iterating over each parameter to test    
-                for value in self.test[par]:
-                    #creating folder and link names
-                    basename = '{}_{}'.format(par, value)
-                    out_folder = os.path.join(self.star_folder, basename)
-                    starfile = '{}_automatch.star'.format(os.path.basename(mrc[0]).replace('.mrc', ''))
-                    starfile = os.path.join(self.star_folder, basename, starfile)
-                    print(f'Running gautomatch with {par} at {value}')
-                    #doing the actual picking via gautomatch
-                    linkname = self.prepare_gautomatch_folder(parms['filein'],
-                                                               out_folder)
-                    print(gid)
-                    self.run_gautomatch(par, value, linkname, gid)
-                    #collect picked coordinates
-                    coords[str(count)] = self.read_coords(starfile)
-                    count += 1
-                #create figure legend and annotate
-                text_legend = self.create_legend(par, self.test[par])
-                self.annotate_image(new_jpg, coords, text_legend)
-            print('Done processing {}'.format(mrc))
-        except Exception as e:
-            print(e.__name__)
-            print(e)
-        return 1
-    
-    def prepare_gautomatch_folder(self, mrc, subfolder):
+    def detect_gpus(self):
         '''
-        gautomatch automatically generates filenames based on the name of the input
-        inside the current working directory. so we make a subdirectory and run 
-        gautomatch from there, thus avoiding the overwriting of output files
+        gpu ids from CUDA_VISIBLE_DEVICES or nvidia-smi, so that we don't need
+        to initialise CUDA (and import pycuda) just to count the cards
+        '''
+        visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+        if visible is not None:
+            #gautomatch --gid counts from 0 within the visible devices
+            gpus = list(range(len([v for v in visible.split(',') if v.strip()])))
+        else:
+            try:
+                out = run(['nvidia-smi', '--query-gpu=index', '--format=csv,noheader'],
+                          stdout=PIPE, stderr=PIPE, check=True).stdout
+                gpus = [int(i) for i in out.split()]
+            except (OSError, CalledProcessError, ValueError):
+                gpus = []
+        if not gpus:
+            print('Warning: could not detect any GPU, using --gid 0')
+            gpus = [0]
+        return gpus
+    
+    def fingerprint(self, mrc, block=2**20):
+        '''
+        identifies the content of a micrograph without reading all of it:
+        size plus a hash of the first and the last MB
+        '''
+        size = os.path.getsize(mrc)
+        sha = hashlib.sha1(str(size).encode())
+        with open(mrc, 'rb') as f:
+            sha.update(f.read(block))
+            if size > block:
+                f.seek(max(size - block, block))
+                sha.update(f.read(block))
+        return sha.hexdigest()
+    
+    def parameter_set(self, par, value, base=None):
+        '''
+        the full set of parameters of a run: the defaults, updated with base
+        (the best values so far during --adaptive) and then with the tested value
+        '''
+        params = {p: v for p, v in self.default.items() if p != 'gid'}
+        params.update(base or {})
+        params[par] = value
+        return params
+    
+    def cache_file(self, mrc, par, value, base=None):
         '''
-        linkname = os.path.basename(mrc)
+        the cache is content addressed: the key is the micrograph fingerprint
+        plus the full parameter set gautomatch runs with (defaults + tested value)
+        '''
+        params = self.parameter_set(par, value, base)
+        key = json.dumps({'micrograph': self.fingerprints[mrc], 'parameters': params},
+                         sort_keys=True)
+        key = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+    
+    def load_cached(self, mrc, par, value, base=None):
+        #returns the cached picks, or None if this combination was never run
+        if self.rerun:
+            return None
         try:
-            os.mkdir(subfolder)
-        except FileExistsError:
-            pass #while self.testing
-        os.chdir(subfolder)
+            with open(self.cache_file(mrc, par, value, base), 'r') as f:
+                return [tuple(p) for p in json.load(f)['picks']]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+    
+    def store_cached(self, mrc, par, value, picks, base=None):
+        cache_file = self.cache_file(mrc, par, value, base)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        record = {'micrograph': os.path.basename(mrc),
+                  'parameter': par,
+                  'value': value,
+                  'count': len(picks),
+                  'picks': picks}
+        #write and rename, so that a crash never leaves half a result behind
+        tmp = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp, cache_file)
+    
+    def make_tasks(self, mrcs=None, test=None):
+        '''
+        one task per (micrograph, parameter, value), the unit of work
+        of the scheduler. Default: all micrographs and the whole test matrix
+        '''
+        mrcs = sorted(mrcs or self.mrc_files)
+        test = test or self.test
+        for mrc in mrcs:
+            if mrc not in self.fingerprints:
+                self.fingerprints[mrc] = self.fingerprint(mrc)
+        return [(mrc, par, value) 
+                for mrc in mrcs 
+                for par in test 
+                for value in test[par]]
+    
+    def make_batches(self, tasks, n_slots=1):
+        '''
+        groups the tasks that share a parameter set into batches for a single
+        gautomatch call, so that CUDA initialisation, template loading and FFT
+        planning are paid once per batch instead of once per micrograph.
+        A group is split into balanced batches when there are fewer groups 
+        than gpu slots, or when it is larger than --batch_size.
+        returns [(par, value, [mrc, ...])]
+        '''
+        groups = {}
+        for mrc, par, value in tasks:
+            groups.setdefault((par, value), []).append(mrc)
+        n_batches = max(-(-n_slots // max(len(groups), 1)), 1)
+        batches = []
+        for (par, value), mrcs in groups.items():
+            size = -(-len(mrcs) // n_batches)
+            if self.batch_size:
+                size = min(size, self.batch_size)
+            for i in range(0, len(mrcs), size):
+                batches.append((par, value, mrcs[i:i + size]))
+        return batches
+    
+    def pick(self, par, value, mrcs, gid, base=None):
+        '''
+        runs gautomatch once on a batch of micrographs with one tested value 
+        and returns {mrc: picks} with picks as (x, y, figure of merit).
+        Successful runs are cached per micrograph
+        '''
+        basename = '{}_{}'.format(par, value)
+        out_folder = os.path.join(self.star_folder, basename)
+        if base:
+            out_folder = os.path.join(self.star_folder, 'adaptive', basename)
+        run_dir, linknames = self.prepare_gautomatch_folder(mrcs, out_folder)
         try:
-            os.symlink(mrc, 
-                       linkname)
-        except FileExistsError:
-            print('Uh oh cannot link to image')
-            raise
-        return linkname   
+            self.run_gautomatch(par, value, linknames, gid, run_dir, base)
+            self.collect_outputs(run_dir, out_folder)
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+        picks = {}
+        for mrc in mrcs:
+            starfile = '{}_automatch.star'.format(os.path.basename(mrc).replace('.mrc', ''))
+            picks[mrc] = self.read_picks(os.path.join(out_folder, starfile))
+            self.store_cached(mrc, par, value, picks[mrc], base)
+        return picks
+    
+    def annotate(self, mrc, par, coords_by_value):
+        original_jpg, new_jpg = self.jpg_names(mrc, par)
+        coords = {str(i): coords_by_value[value] 
+                  for i, value in enumerate(self.test[par], 1)}
+        text_legend = self.create_legend(par, self.test[par])
+        self.annotate_image(original_jpg, coords, text_legend, out_jpg=new_jpg, mrc=mrc)
+        print('Annotated {}'.format(new_jpg))
+        return new_jpg
+    
+    def prepare_gautomatch_folder(self, mrcs, subfolder):
+        '''
+        gautomatch automatically generates filenames based on the name of the input
+        inside the current working directory. so every run gets its own temporary
+        directory inside subfolder, with links to the micrographs of the batch, and
+        gautomatch is started there. Nothing changes the working directory of this 
+        process, so runs can overlap in threads.
+        returns the run directory and the names of the links in it
+        '''
+        os.makedirs(subfolder, exist_ok=True)
+        run_dir = tempfile.mkdtemp(prefix='.run_', dir=subfolder)
+        linknames = []
+        for mrc in mrcs:
+            linkname = os.path.basename(mrc)
+            os.symlink(os.path.abspath(mrc), os.path.join(run_dir, linkname))
+            linknames.append(linkname)
+        return run_dir, linknames
+    
+    def collect_outputs(self, run_dir, out_folder):
+        #moves everything gautomatch wrote, but not the links, next to the other results
+        for entry in os.scandir(run_dir):
+            if not entry.is_symlink():
+                os.replace(entry.path, os.path.join(out_folder, entry.name))
     
-    def run_gautomatch(self, parameter, value, linkname, gpuid=0):
+    def run_gautomatch(self, parameter, value, linknames, gpuid=0, run_dir=None, 
+                       base=None):
 #         cmd = 'gautomatch --apixM 1.76 --diameter 160 --speed {speed} --boxsize {boxsize} --min_dist {min_dist} --cc_cutoff {cc_cutoff} --lsigma_D {lsigma_D} --lsigma_cutoff {lsigma_cutoff} --lave_D {lave_d} --lave_max {lave_max} --lave_min {lave_min} --lp {lp} --hp {hp} {link}'.format(**parameter_set, link = linkname)
         test = f'--{parameter} {value}'
-        default = ' '.join([f'--{p} {v}' for p, v in self.default.items() if p != parameter])
+        params = self.parameter_set(parameter, value, base)
+        default = ' '.join([f'--{p} {v}' for p, v in params.items() 
+                            if p != parameter])
         gid = f'--gid {gpuid}'
-        cmd = f'gautomatch {default} {test} {gid} {linkname}'
-        with Popen(cmd.split(), stdout = PIPE, stderr = PIPE) as gautomatch:
-            print(f'Running gautomatch on {linkname}')
+        cmd = f'gautomatch {default} {test} {gid}'.split() + linknames
+        what = linknames[0] if len(linknames) == 1 else f'{len(linknames)} micrographs'
+        with Popen(cmd, stdout = PIPE, stderr = PIPE, cwd=run_dir) as gautomatch:
+            print(f'Running gautomatch on {what} with {parameter} = {value}')
             out_ga, err = gautomatch.communicate()
-            print(f'Ran gautomatch on {linkname}')
-        boxfile = '{}_automatch.box'.format(os.path.splitext(linkname)[0])
-        with Popen(['wc', boxfile], stdout=PIPE, stderr=PIPE) as wc:
-            out, err = wc.communicate()
-            count = out.split()[0]
-        os.chdir(self.mrc_folder)
-        print(f'Picked {count} particles on {linkname}')
-        return 1
+            print(f'Ran gautomatch on {what} with {parameter} = {value}')
+        if gautomatch.returncode:
+            raise RuntimeError('gautomatch failed on {} with {} {}:\n{}'.format(
+                                        what, parameter, value, err.decode()))
+        counts = {}
+        for linkname in linknames:
+            boxfile = '{}_automatch.box'.format(os.path.splitext(linkname)[0])
+            try:
+                with open(os.path.join(run_dir or '', boxfile), 'r') as f:
+                    counts[linkname] = sum(1 for line in f if line.strip())
+            except FileNotFoundError:
+                raise RuntimeError(f'gautomatch wrote no results for {linkname}')
+            print(f'Picked {counts[linkname]} particles on {linkname}')
+        return counts
             
     def prepare_subfolders(self):
         #make subfolders && clean annotated subfolder
@@ -184,11 +409,8 @@ class Gautomatcher(object):
             os.mkdir(self.jpg_in_folder)
         except FileExistsError:
             pass
-        try:
-            os.mkdir(self.star_folder)
-        except FileExistsError:
-            shutil.rmtree(self.star_folder)
-            os.mkdir(self.star_folder)
+        #results of earlier runs are kept: they are reused through the cache
+        os.makedirs(self.star_folder, exist_ok=True)
     
     def check_jpgs_are_present(self):
         t = os.path.join(self.jpg_in_folder, '*.jpg')
@@ -199,98 +421,339 @@ class Gautomatcher(object):
         return set(mrc_filenames) <= set(jpg_filenames)
 
     def draw_circles(self, coords, radius, image, thickness = 5,
-                         color = '#00ff00'):
+                         color = '#00ff00', batch=256):
             '''
             coords = [(x0,y0),...(xn,yn)] where x and y specify the center of the binding box
-            radius = radius of the ellipse to be drawn
-            image = the image where you want the ellipse to be drawn
-            thickness = how thick the border of the ellipse should be
-            outline = color of the outline
+            radius = radius of the circle to be drawn
+            image = RGB numpy array (h, w, 3) where the circles are drawn, in place
+            thickness = how thick the border of the circle should be
+            color = color of the outline
+            the ring pixels of many particles are set at once with numpy
+            indexing, batch particles at a time to bound memory
             '''
-            draw = ImageDraw.Draw(image)
-            for set in coords:
-                for i in range(thickness):
-                    center_x = set[0]
-                    center_y = set[1]
-                    #relion gives the xy of the center of the circle; 
-                    #PIL wants the xy of upper left corner of the binding box
-                    draw.ellipse((center_x-radius-i, center_y-radius+i, 
-                                  center_x+radius+i, center_y+radius-i),
-                                  outline=color)
+            if not len(coords):
+                return image
+            dy, dx = ring_offsets(int(radius), int(thickness))
+            rgb = ImageColor.getrgb(color)
+            centers = np.asarray(coords)[:, :2].astype(int)
+            height, width = image.shape[:2]
+            for start in range(0, len(centers), batch):
+                chunk = centers[start:start + batch]
+                xs = (chunk[:, 0, np.newaxis] + dx).ravel()
+                ys = (chunk[:, 1, np.newaxis] + dy).ravel()
+                inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+                image[ys[inside], xs[inside]] = rgb
             return image
     
-    def write_on_image(self, image, text, posxy, color='#00ff00'):
-        font_file = '/usr/share/fonts/truetype/ubuntu-font-family/UbuntuMono-R.ttf'
-        font = ImageFont.truetype(font_file, size=100)
+    def write_on_image(self, image, text, posxy, color='#00ff00', size=100):
         draw = ImageDraw.Draw(image)
-        draw.text(posxy, text, font=font, fill=color)
+        draw.text(posxy, text, font=load_font(size), fill=color)
         return image
     
     def read_coords(self, starfile):
-        coords = []
-        with open(starfile, 'r') as f:
-            for line in f:
-                if line[0].isdigit():
-                    coords.append((int(line.split()[0]),
-                                   int(line.split()[1])))
-        return coords
+        return [(x, y) for x, y, _ in self.read_picks(starfile)]
+    
+    def read_picks(self, starfile):
+        '''
+        returns [(x, y, figure of merit)]. The figure of merit column is
+        found by its label, 0 if the file does not have one
+        '''
+        table = star_io.find_table(starfile)
+        columns = ['rlnCoordinateX', 'rlnCoordinateY']
+        if 'rlnAutopickFigureOfMerit' in table:
+            columns.append('rlnAutopickFigureOfMerit')
+        picks = star_io.iter_rows(starfile, columns, table=table)
+        return [(int(float(x)), int(float(y)), float(fom[0]) if fom else 0.) 
+                for x, y, *fom in picks]
     
     def open_as_rgb(self, grayscale_image):
-        img =  Image.open(grayscale_image)
-    #     img.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_180)
-        rgbimage = Image.new('RGB', img.size)
-        rgbimage.paste(img)
-        return rgbimage
+        #as a numpy array, decoded once
+        img =  Image.open(grayscale_image).convert('L')
+        return np.repeat(np.asarray(img)[:, :, np.newaxis], 3, axis=2)
         
     def create_legend(self, par,grid):
-        text_legend = {'1': '{} = {}'.format(par, grid[0]),
-                  '2': '{} = {}'.format(par, grid[1]),
-                  '3': '{} = {}'.format(par, grid[2])}
+        text_legend = {str(i): '{} = {}'.format(par, value) 
+                       for i, value in enumerate(grid, 1)}
         return text_legend
     
-    def copy_jpg(self, mrc, out_folder, par):
+    def jpg_names(self, mrc, par):
+        #the preview made by mrc2jpg and the annotated copy for one parameter
         original_jpg =os.path.join(self.jpg_in_folder, 
-                                   os.path.basename(mrc[0]).replace('mrc', 'jpg')) 
+                                   os.path.basename(mrc).replace('mrc', 'jpg')) 
         new_jpg = os.path.basename(original_jpg).replace('.jpg', '_{}.jpg').format(par)
         new_jpg = os.path.join(self.mrc_folder, new_jpg)
-        shutil.copy(original_jpg, new_jpg)
-        return new_jpg
+        return original_jpg, new_jpg
+    
+    def preview_scale(self, jpg_size, mrc):
+        '''
+        jpg pixels per micrograph pixel. Picks are in micrograph pixels, the
+        preview may have been shrunk by mrc2jpg --scale
+        '''
+        if mrc is None:
+            return 1.
+        try:
+            header = mrc_io.read_header(mrc)
+        except (OSError, ValueError):
+            return 1.
+        return jpg_size[0] / int(header['nx'])
     
-    def annotate_image(self, jpg, coords, text_legend):
-        radius = int(self.box_size)
-        colors = {'1': '#00ff00',
-                  '2': '#ff0000',
-                  '3': '#0000ff'}
-        text_pos= {'1': (30,30),
-                  '2': (30,120),
-                  '3': (30,190)}
-        for i in ['1','2','3']:
-            rgbimage = self.open_as_rgb(jpg)
-            rgbimage = self.draw_circles(coords[i], radius, rgbimage,
-                                    color= colors[i])
-            rgbimage = self.write_on_image(rgbimage, text_legend[i], text_pos[i], 
-                                      color = colors[i])
-            rgbimage.save(jpg)
-            radius += 6 
+    def annotate_image(self, jpg, coords, text_legend, out_jpg=None, mrc=None):
+        '''
+        draws every set of coordinates on the jpg, each with its own color and
+        a slightly bigger radius, and writes the legend. The jpg is decoded and
+        encoded only once. Saved to out_jpg, or over jpg
+        '''
+        rgb = self.open_as_rgb(jpg)
+        scale = self.preview_scale((rgb.shape[1], rgb.shape[0]), mrc)
+        radius = self.box_size * scale
+        thickness = max(int(round(5 * scale)), 1)
+        font_size = max(int(100 * scale), 12)
+        for n, i in enumerate(sorted(coords, key=int)):
+            color = COLORS[n % len(COLORS)]
+            picks = [(x * scale, y * scale) for x, y, *_ in coords[i]]
+            self.draw_circles(picks, radius + n * 6 * scale, rgb, thickness, color)
+        image = Image.fromarray(rgb)
+        for n, i in enumerate(sorted(coords, key=int)):
+            color = COLORS[n % len(COLORS)]
+            position = (int(30 * scale), int((30 + n * 80) * scale))
+            self.write_on_image(image, text_legend[i], position, color, font_size)
+        image.save(out_jpg or jpg)
         
+    def schedule(self, tasks, collect, base=None):
+        '''
+        dispatches (micrograph, parameter, value) tasks to slots_per_gpu slots
+        on each gpu, grouped in batches that run in one gautomatch call. A new
+        batch starts as soon as a slot frees up, failed batches
+        are put back in the queue up to --retries times.
+        collect(task, picks) is called for every task, cached ones first.
+        returns the failed tasks as [(task, exception)]
+        '''
+        slots = deque(gid for gid in self.gpus for _ in range(self.slots_per_gpu))
+        cached = {task: self.load_cached(*task, base) for task in tasks}
+        todo = [task for task in tasks if cached[task] is None]
+        batches = self.make_batches(todo, len(slots))
+        pending = deque((batch, 0) for batch in batches) #(batch, attempt)
+        running = {}
+        failed = []
+        print(f'{len(tasks) - len(todo)} of {len(tasks)} gautomatch jobs found in '
+              f'the cache {self.cache_dir}')
+        print(f'Running {len(todo)} gautomatch jobs in {len(batches)} batches on gpus '
+              f'{self.gpus}, {self.slots_per_gpu} at a time per gpu')
+        for task, picks in cached.items():
+            if picks is not None:
+                collect(task, picks)
+        #the gpu work happens in gautomatch, threads are enough to wait for it
+        with ThreadPoolExecutor(max_workers=len(slots)) as executor:
+            while pending or running:
+                while pending and slots:
+                    batch, attempt = pending.popleft()
+                    gid = slots.popleft()
+                    future = executor.submit(self.pick, *batch, gid, base)
+                    running[future] = (batch, attempt, gid)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch, attempt, gid = running.pop(future)
+                    slots.append(gid)
+                    par, value, mrcs = batch
+                    try:
+                        for mrc, picks in future.result().items():
+                            collect((mrc, par, value), picks)
+                    except Exception as e:
+                        if attempt < self.retries:
+                            print(f'Retrying {len(mrcs)} micrographs {par}={value}: {e}')
+                            pending.append((batch, attempt + 1))
+                        else:
+                            failed.extend(((mrc, par, value), e) for mrc in mrcs)
+        for (mrc, par, value), e in failed:
+            print(f'Failed: {os.path.basename(mrc)} {par}={value}: {type(e).__name__}: {e}')
+        return failed
+    
     def run_parallel(self):
-        from itertools import cycle
-        from pycuda import driver
-        #initialize gpu driver simply to know gpu count
-        driver.init()
-        ngpus = driver.Device.count()
-        #pre-map each file to one gpu.
-        #note that we will let gautomatch do the assignment via the --gid flag
-        cycler = cycle(range(ngpus))
-        self.mrc_files = list(zip(self.mrc_files, cycler))
-        with ProcessPoolExecutor(max_workers=3) as executor:
-            executor.map(self.pick_mrc, self.mrc_files)
-            
+        '''
+        runs the whole test matrix on all micrographs. Once all values of a
+        parameter are done on a micrograph, the jpg is annotated in a separate
+        pool so that the gpus never wait for it
+        '''
+        picked = {} #(mrc, par) -> {value: picks}, until all values are done
+        results = {} #(mrc, par, value) -> picks, for the results file
+        annotations = []
+        #The annotation processes are started with forkserver: forking while
+        #the scheduler threads run can deadlock the children
+        forkserver = multiprocessing.get_context('forkserver')
+        with ProcessPoolExecutor(max_workers=self.n_threads,
+                                 mp_context=forkserver) as annotator:
+            def collect(task, picks):
+                mrc, par, value = task
+                results[task] = picks
+                values = picked.setdefault((mrc, par), {})
+                values[value] = picks
+                if len(values) == len(self.test[par]):
+                    annotations.append(annotator.submit(self.annotate, mrc, par,
+                                                        picked.pop((mrc, par))))
+            failed = self.schedule(self.make_tasks(), collect)
+            self.save_results(results)
+            for future in annotations:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'Annotation failed: {type(e).__name__}: {e}')
+        return failed
+    
+    def save_results(self, results):
+        #all picks of the sweep in one file, see screener_results.py
+        outfile = os.path.join(self.star_folder, screener_results.RESULTS)
+        screener_results.save_results(outfile, results)
+        print(f'{sum(len(p) for p in results.values())} picks saved to {outfile}')
+        return outfile
+    
+    def choose_subset(self):
+        #evenly spread over the (sorted, usually chronological) micrographs
+        mrcs = sorted(self.mrc_files)
+        if len(mrcs) <= self.subset:
+            return mrcs
+        step = len(mrcs) / self.subset
+        return [mrcs[int(i * step)] for i in range(self.subset)]
+    
+    def objective(self, picks_by_mrc):
+        '''
+        score of one parameter set on the subset, higher is better.
+        Default: mean figure of merit of all picks times the log of the mean
+        number of picks per micrograph, so that a stricter cutoff that only
+        drops the weaker picks does not win by itself. Sets with fewer than
+        --min_picks per micrograph are rejected. With --target_picks:
+        closeness of the mean number of picks to the target, on a log scale
+        '''
+        counts = [len(picks) for picks in picks_by_mrc.values()]
+        mean_count = sum(counts) / max(len(counts), 1)
+        if self.target_picks:
+            return -abs(math.log((mean_count + 1) / (self.target_picks + 1)))
+        if not counts or mean_count < self.min_picks:
+            return -math.inf
+        foms = [fom for picks in picks_by_mrc.values() for _, _, fom in picks]
+        return sum(foms) / len(foms) * math.log(1 + mean_count)
+    
+    def value_range(self, par):
+        #(lowest, highest) numeric value of par in the matrix file and defaults
+        values = [v for v in list(self.test[par]) + [self.default.get(par)]
+                  if isinstance(v, (int, float)) and not isinstance(v, bool)]
+        return (min(values), max(values)) if values else None
+    
+    def refine_values(self, tried, best, bounds=None):
+        '''
+        new candidates around the best value of a numeric parameter: the
+        midpoints towards its tried neighbours, or one grid step further out
+        if the best value is at the edge of what was tried. Candidates
+        outside bounds (lowest, highest) are left out
+        '''
+        if isinstance(best, bool) or not isinstance(best, (int, float)):
+            return []
+        values = sorted(v for v in tried if isinstance(v, (int, float)))
+        if len(values) < 2:
+            return []
+        i = values.index(best)
+        candidates = []
+        if i > 0:
+            candidates.append((values[i - 1] + best) / 2)
+        elif values[0] <= 0 or 2 * best - values[1] > 0:
+            #do not step from positive values into zero or negative ones
+            candidates.append(2 * best - values[1])
+        if i < len(values) - 1:
+            candidates.append((values[i + 1] + best) / 2)
+        else:
+            candidates.append(2 * best - values[-2])
+        if bounds:
+            candidates = [c for c in candidates if bounds[0] <= c <= bounds[1]]
+        if all(isinstance(v, int) for v in values):
+            candidates = [int(round(c)) for c in candidates]
+        else:
+            candidates = [float('{:.4g}'.format(c)) for c in candidates]
+        return [c for c in dict.fromkeys(candidates) if c not in tried]
+    
+    def evaluate(self, mrcs, par, values, base):
+        #objective of every value of par, with the other parameters as in base
+        picked = {value: {} for value in values}
+        def collect(task, picks):
+            mrc, par, value = task
+            picked[value][mrc] = picks
+        failed = self.schedule(self.make_tasks(mrcs, {par: values}), collect, base)
+        failed_values = {value for (_, _, value), _ in failed}
+        return {value: self.objective(picks) for value, picks in picked.items()
+                if value not in failed_values}
+    
+    def adaptive_search(self):
+        '''
+        coordinate descent on a subset of the micrographs. The first round
+        tries the values of the matrix file for each parameter in turn, later
+        rounds only try values around the best one so far, within the range
+        of the matrix file and the defaults. Stops after
+        --max_rounds, or when a round improves the objective by less than
+        --tolerance. Returns the best parameters and their objective
+        '''
+        mrcs = self.choose_subset()
+        print(f'Searching on {len(mrcs)} micrographs: '
+              f'{[os.path.basename(m) for m in mrcs]}')
+        best = {par: self.default.get(par, grid[0]) for par, grid in self.test.items()}
+        tried = {par: set() for par in self.test}
+        candidates = {par: list(grid) for par, grid in self.test.items()}
+        score = -math.inf
+        for n in range(1, self.max_rounds + 1):
+            previous = score
+            for par in self.test:
+                values = list(dict.fromkeys(candidates[par] + [best[par]]))
+                scores = self.evaluate(mrcs, par, values, best)
+                #values whose runs failed are not proposed again
+                tried[par].update(values)
+                if scores:
+                    value = max(scores, key=scores.get)
+                    best[par], score = value, scores[value]
+                    print(f'Round {n}, {par}: ' + ', '.join(f'{v}: {s:.4g}'
+                                                for v, s in sorted(scores.items())))
+                candidates[par] = self.refine_values(tried[par], best[par],
+                                                     self.value_range(par))
+            print(f'Round {n}: objective {score:.4g} with {best}')
+            if not any(candidates.values()):
+                print('No new values left to try')
+                break
+            if math.isfinite(previous) and \
+               score - previous <= self.tolerance * abs(previous):
+                print(f'Objective levelled off ({previous:.4g} -> {score:.4g})')
+                break
+        return best, score
+    
+    def save_parameters(self, best, outfile=None):
+        '''
+        writes the defaults updated with the best values, in the format of the
+        default parameters file, so that it can be used as --default_params
+        '''
+        if not outfile:
+            outfile = os.path.join(self.mrc_folder, 'best_gautomatch_parameters.json')
+        with open(self.default_params, 'r') as f:
+            params = json.load(f)
+        params.update({par: str(value) for par, value in best.items()})
+        with open(outfile, 'w') as f:
+            json.dump(params, f, indent=0)
+        print(f'Best parameters written to {outfile}')
+        return outfile
+    
     def _run_sequential(self):
         #for debugging purposes since parallelization suppresses errors
-        for f in self.mrc_files:
-            f = (f, 0) # 0 = gpuid
-            self.pick_mrc(f)   
+        picked = {}
+        results = {}
+        todo = []
+        for mrc, par, value in self.make_tasks():
+            picks = self.load_cached(mrc, par, value)
+            if picks is None:
+                todo.append((mrc, par, value))
+            else:
+                picked.setdefault((mrc, par), {})[value] = picks
+                results[(mrc, par, value)] = picks
+        for par, value, mrcs in self.make_batches(todo):
+            for mrc, picks in self.pick(par, value, mrcs, self.gpus[0]).items():
+                picked.setdefault((mrc, par), {})[value] = picks
+                results[(mrc, par, value)] = picks
+        self.save_results(results)
+        for (mrc, par), coords_by_value in picked.items():
+            self.annotate(mrc, par, coords_by_value)
             
     def _import_parameters(self,parms_file):
         '''
@@ -341,18 +804,22 @@ class Gautomatcher(object):
     def main(self):
 #         assert self.check_jpgs_are_present(), 'Some jpg files are missing'
         self.prepare_subfolders()
-        too_many_parms_msg = 'For practical reasons, I can only iterate over n==3 values of each parameter'
-        for par in self.test:
-            assert len(self.test[par]) == 3, too_many_parms_msg 
         print(f'The script will iterate over the following parameters: {self.test}')
-        if self.debug:
+        if self.adaptive:
+            best, score = self.adaptive_search()
+            if not math.isfinite(score):
+                sys.exit('No parameter set gave enough picks, try a lower --min_picks')
+            print(f'Best parameters (objective {score:.4g}): {best}')
+            self.save_parameters(best)
+        elif self.debug:
             self._run_sequential() #debug_mode
         else:
-            self.run_parallel()
+            failed = self.run_parallel()
+            if failed:
+                sys.exit(f'{len(failed)} gautomatch jobs failed')
     
 if __name__ == '__main__':
     g = Gautomatcher()
-    g.debug = 0
     g.main()
 
 
@@ -6,10 +6,17 @@ import subprocess
 import argparse
 import errno
 import multiprocessing
+import itertools
+import json
+import time
+import numpy as np
 from PIL import Image
-from multiprocessing.dummy import Pool as ThreadPool
-
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import mrc_io
+from mrc_filters import Preprocessor, mean_shrink, percentile_limits, sample_pixels
 
+#kept in the output folder by --watch, records what has been converted
+MANIFEST = '.mrc2jpg_manifest.json'
 
 
 class imageConverter(object):
@@ -28,11 +35,43 @@ class imageConverter(object):
         parser.add_argument('--scale', help='Scale factor e.g. 4 shrinks by 4 '
                             'times')
         parser.add_argument('--lowpass', help='Lowpass resolution in Angstrom')
-        parser.add_argument('--n_cpus', help='How many cpus should be used. Default: all available -1')
+        parser.add_argument('--clip', help='Clip the contrast to these percentiles, '
+                            'e.g. 0.5,99.5, so that outliers do not wash out the preview. '
+                            'Default: full range')
+        parser.add_argument('--clip_method', help='How the percentiles are estimated: '
+                            'sample (a subsample of pixels) or histogram (a fixed-bin '
+                            'histogram of all pixels). Default: sample',
+                            choices=['sample', 'histogram'], default='sample')
+        parser.add_argument('--session_stats', help='Estimate the contrast limits once, '
+                            'from this many micrographs spread over the session, and use '
+                            'them for all previews so that they are comparable')
+        parser.add_argument('--pyramid', help='Additional shrink factors, comma separated, '
+                            'e.g. 8,32. Each micrograph is read once and every size is '
+                            'written to [output folder]_bin[factor]. Factors must be '
+                            'multiples of --scale')
+        parser.add_argument('--n_cpus', help='How many worker processes should be used. '
+                            'Default: all available cpus -1')
+        parser.add_argument('--chunksize', help='How many micrographs each worker '
+                            'converts per task. Default: 1')
+        parser.add_argument('--max_in_flight', help='Maximum number of tasks queued or '
+                            'running at any time, limits memory use. Default: 2 * n_cpus')
+        parser.add_argument('--frames', help='For movie stacks: frames to sum, as '
+                            'first:last or first:last:step, 0-based, last excluded. '
+                            'Default: all frames')
+        parser.add_argument('--average', help='For movie stacks: average the frames '
+                            'instead of summing them', action='store_true')
         parser.add_argument('--noflip', help='Does NOT rotate and flip the jpg to conform with relion coordinates',
                             action='store_true')
         parser.add_argument('--invert', help='Invert contrast', action='store_true')
         parser.add_argument('--file', help='File containing micrograph names')
+        parser.add_argument('--watch', help='Keep running and convert new micrographs '
+                            'as they are written to the input folder. Stop with Ctrl-C',
+                            action='store_true')
+        parser.add_argument('--poll', help='Seconds between checks for new files in '
+                            '--watch mode. Default: 10')
+        parser.add_argument('--eman2', help='Convert with EMAN2 e2proc2d.py instead '
+                            'of the built-in mrc reader (much slower)',
+                            action='store_true')
         parser.parse_args(namespace=self) 
         return parser
         
@@ -62,26 +101,58 @@ class imageConverter(object):
                 sys.exit('The path {} does not exist. Use -f to create'.format(self.o))
         #setting scale factor
         if not self.scale:
-            self.scale = ''
+            self.scale = None
         else:
             if self.scale.isdigit():
-                self.scale = '--meanshrink {}'.format(self.scale)
+                self.scale = int(self.scale)
             else:
-                sys.exit('{} is not a valid scale factor')
-        #setting processing options
+                sys.exit('{} is not a valid scale factor'.format(self.scale))
+        #setting processing options. Stored as cutoff frequency in 1/A
         if not self.lowpass:
-            self.lowpass = ''
+            self.lowpass = None
         else:
             self.lowpass = self.lowpass.replace('A','')
             if self.lowpass.isdigit():
-                self.lowpass = '--process filter.lowpass.gauss:cutoff_freq={}'.format(\
-                                                            1/int(self.lowpass))
+                self.lowpass = 1/int(self.lowpass)
             else:
-                sys.exit('{} is not a valid resolution')
-        if self.invert:
-            self.invert = '--mult=-1'
-        else:
-            self.invert = ''
+                sys.exit('{} is not a valid resolution'.format(self.lowpass))
+        self.preprocessor = Preprocessor(lowpass=self.lowpass, scale=self.scale)
+        #frame selection for movie stacks, stored as slice arguments
+        try:
+            frames = (self.frames or '::').split(':')
+            self.frames = tuple(int(n) if n else None for n in (frames + [''] * 2)[:3])
+        except ValueError:
+            sys.exit('{} is not a valid frame range'.format(self.frames))
+        #contrast
+        try:
+            if self.clip:
+                self.clip = tuple(float(p) for p in self.clip.split(','))
+            self.session_stats = int(self.session_stats or 0)
+        except ValueError:
+            sys.exit('--clip needs two percentiles, e.g. 0.5,99.5, '
+                     '--session_stats a number of micrographs')
+        if self.clip and (len(self.clip) != 2 or not 0 <= self.clip[0] < self.clip[1] <= 100):
+            sys.exit('{} is not a valid percentile range'.format(self.clip))
+        if self.session_stats and not self.clip:
+            self.clip = (0., 100.)
+        if self.eman2 and self.clip:
+            sys.exit('--clip and --session_stats cannot be used with --eman2')
+        #{shrink factor: (low, high)}, set by estimate_session_limits
+        self.session_limits = None
+        #output sizes: [(shrink factor, folder)], the first one is the --scale output
+        self.levels = [(self.scale or 1, self.o)]
+        if self.pyramid:
+            if self.eman2:
+                sys.exit('--pyramid cannot be used with --eman2')
+            try:
+                factors = sorted({int(n) for n in self.pyramid.split(',')})
+            except ValueError:
+                sys.exit('{} is not a valid list of shrink factors'.format(self.pyramid))
+            for n in factors:
+                if n % self.levels[0][0] or n <= self.levels[0][0]:
+                    sys.exit('Pyramid factor {} must be a larger multiple of --scale ({})'.format(
+                                                                n, self.levels[0][0]))
+                self.levels.append((n, os.path.normpath(self.o) + '_bin{}'.format(n)))
         #checking cpus
         try:
             cpu_max = multiprocessing.cpu_count()
@@ -90,42 +161,164 @@ class imageConverter(object):
             print ('I cannot detect the number of cpus on the system, defaulting to 4') 
         
         if not self.n_cpus:
-            self.n_cpus = cpu_max -1
+            self.n_cpus = max(cpu_max -1, 1)
         else:
             try:
                 self.n_cpus = int(self.n_cpus)
-            except TypeError:
+            except ValueError:
                 sys.exit('please give an integer number for the --n_cpu parameter')
             if self.n_cpus > cpu_max:
                 sys.exit('Only {0} CPUs are available on this system. Please make sure that n_cpus <= {0}'.format(cpu_max))
+        #watch mode
+        if self.watch and self.file:
+            sys.exit('--watch monitors the input folder and cannot be used with --file')
+        try:
+            self.poll = float(self.poll or 10)
+        except ValueError:
+            sys.exit('--poll must be a number of seconds')
+        #scheduling
+        try:
+            self.chunksize = int(self.chunksize or 1)
+            self.max_in_flight = int(self.max_in_flight or 2 * self.n_cpus)
+        except ValueError:
+            sys.exit('--chunksize and --max_in_flight must be integers')
+        if self.chunksize < 1 or self.max_in_flight < 1:
+            sys.exit('--chunksize and --max_in_flight must be at least 1')
+    
+    def eman2_options(self):
+        options = []
+        if self.lowpass:
+            options.append('--process=filter.lowpass.gauss:cutoff_freq={}'.format(
+                                                                    self.lowpass))
+        if self.scale:
+            options += ['--meanshrink', str(self.scale)]
+        if self.invert:
+            options.append('--mult=-1')
+        return options
+    
+    def jpg_name(self, mrcfile, folder=None):
+        return os.path.join(folder or self.o, 
+                            os.path.basename(mrcfile).replace('.mrc', '.jpg'))
     
     def convert_image(self, mrcfile):
-        outfile = os.path.join(self.o, (mrcfile.split('/')[-1].replace('.mrc', '.jpg')))
-        if os.path.isfile(outfile) and not self.f:
-            raise IOError(errno.EEXIST)
-        elif os.path.isfile(outfile) and self.f:
+        outfiles = [self.jpg_name(mrcfile, folder) for _, folder in self.levels]
+        if not self.f:
+            if all(os.path.isfile(o) for o in outfiles):
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), outfiles[0])
+        if self.eman2:
+            return self.convert_image_eman2(mrcfile, outfiles[0])
+        levels = self.process(mrcfile)
+        for (factor, _), outfile in zip(self.levels, outfiles):
+            if self.f or not os.path.isfile(outfile):
+                self.write_jpg(levels[factor], outfile, factor)
+        return outfiles[0]
+    
+    def process(self, mrcfile):
+        '''
+        reads, filters and shrinks one micrograph or movie.
+        returns {shrink factor: image} for every output size
+        '''
+        header, data = mrc_io.read_mrc(mrcfile)
+        apix = mrc_io.voxel_size(header)[0]
+        if data.shape[0] > 1:
+            del data
+            image, binned = self.sum_frames(mrcfile, apix)
+            image = self.preprocessor(image, apix=apix, binned=binned)
+        else:
+            image = self.preprocessor(data[0], apix=apix)
+        #every level of the pyramid is shrunk from the closest bigger one
+        levels = {self.levels[0][0]: image}
+        for factor, _ in self.levels[1:]:
+            source = max(n for n in levels if factor % n == 0)
+            levels[factor] = mean_shrink(levels[source], factor // source)
+        return levels
+    
+    def estimate_session_limits(self, mrclist):
+        '''
+        contrast limits estimated once from --session_stats micrographs
+        spread evenly over the session, for each output size
+        '''
+        mrclist = sorted(mrclist)
+        step = max(len(mrclist) // self.session_stats, 1)
+        samples = {}
+        for mrcfile in mrclist[::step][:self.session_stats]:
+            for factor, image in self.process(mrcfile).items():
+                samples.setdefault(factor, []).append(
+                                        np.asarray(sample_pixels(image)).ravel())
+        limits = {}
+        for factor, s in samples.items():
+            limits[factor] = percentile_limits(np.concatenate(s), *self.clip,
+                                               method=self.clip_method)
+        print('Contrast limits from {} micrographs: {}'.format(
+                                min(self.session_stats, len(mrclist)), limits))
+        return limits
+    
+    def sum_frames(self, mrcfile, apix):
+        '''
+        streams the frames of a movie into a running sum. When the lowpass
+        allows it each frame is shrunk before being added, so the peak memory
+        is one frame plus a (shrunk) accumulator.
+        returns the sum and the shrink factor already applied
+        '''
+        binned = self.preprocessor.prebin(apix)
+        total = None
+        n = 0
+        for frame in mrc_io.iter_sections(mrcfile, *self.frames):
+            if binned > 1:
+                frame = mean_shrink(frame, binned)
+            if total is None:
+                total = np.zeros(frame.shape, dtype='f4')
+            total += frame
+            n += 1
+        if not n:
+            raise ValueError('No frames selected by --frames in {}'.format(mrcfile))
+        if self.average:
+            total /= n
+        return total, binned
+    
+    def write_jpg(self, image, outfile, factor=None):
+        if self.session_limits:
+            limits = self.session_limits[factor]
+        elif self.clip:
+            limits = percentile_limits(image, *self.clip, method=self.clip_method)
+        else:
+            limits = None
+        image = self.to_8bit(image, limits)
+        #EMAN2 puts the origin of the jpg at the bottom left, relion at the 
+        #top left like the mrc data. With --noflip we reproduce the EMAN2 layout
+        if self.noflip:
+            image = image[::-1]
+        Image.fromarray(image).save(outfile, 'JPEG')
+    
+    def to_8bit(self, image, limits=None):
+        image = np.asarray(image, dtype='f4')
+        if limits:
+            low, high = limits
+            image = np.clip(image, low, high)
+        else:
+            low, high = image.min(), image.max()
+        scale = 255 / (high - low) if high > low else 0
+        image = (image - low) * scale
+        if self.invert:
+            image = 255 - image
+        return image.astype('u1')
+    
+    def convert_image_eman2(self, mrcfile, outfile):
+        if os.path.isfile(outfile):
             os.remove(outfile) #otherwise eman might make a stack
-        command = 'python2.7 /Xsoftware64/EM/EMAN2/bin/e2proc2d.py ' + \
-            '{lowpass} {scale} {invert} {mrc} {jpg}'.format(mrc=mrcfile, 
-                                                   jpg=outfile,
-                                                   scale = self.scale,
-                                                   lowpass = self.lowpass,
-                                                   invert = self.invert)
-        command = command.split()
+        command = ['python2.7', '/Xsoftware64/EM/EMAN2/bin/e2proc2d.py'] + \
+                  self.eman2_options() + [mrcfile, outfile]
         s = subprocess.Popen(command, stdout=subprocess.PIPE, 
                              stderr = subprocess.PIPE)
         _, err = s.communicate()
         #EMAN2 might fail randomly
         if 'Traceback' in str(err) and not self.f:
-            sys.exit('EMAN2 failed with the following error: \n\n{}'.format(err))
-        print (err)
-        print(_)
-        print ('Converted {}'.format(outfile.split('/')[-1]))
+            raise RuntimeError('EMAN2 failed with the following error: \n\n{}'.format(err))
         #finally, flip horizontal and rotate 180 because EMAN2 chooses different
         #coordinates compared to relion which we will use downstream
         if not self.noflip:
             self.flip_and_rotate(outfile)
-            print('Flipped & rotated {}'.format(outfile.split('/')[-1]))
+        return outfile
          
     def flip_and_rotate(self, image):
         img =  Image.open(image)
@@ -154,12 +347,17 @@ class imageConverter(object):
             sys.exit(f'No files found in input file {input_file}')
         return files
     
+    def make_output_folders(self):
+        for _, folder in self.levels:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+    
     def create_images(self, mrclist):
-        if not os.path.isdir(self.o):
-            os.makedirs(self.o)
+        self.make_output_folders()
         for f in sorted(mrclist):
             try:
-                self.convert_image(f)
+                outfile = self.convert_image(f)
+                print('Converted {}'.format(os.path.basename(outfile)))
             except IOError:
                 msg = '{} exists. Skipped. Use -f to force overwrite'.format(
                             f.replace('.mrc','.jpg'))
@@ -168,30 +366,201 @@ class imageConverter(object):
     def make_commands(self, mrclist):
         cmds = []
         for file_ in mrclist:
-            outfile = os.path.join(self.o, (file_.split('/')[-1].replace('.mrc', '.jpg')))
-            command = 'python /Xsoftware64/EM/EMAN2/bin/e2proc2d.py ' + \
-                    '{lowpass} {scale} {mrc} {jpg}'.format(mrc=file_, 
-                                                       jpg=outfile,
-                                                       scale = self.scale,
-                                                       lowpass = self.lowpass)
-            cmds.append(command.split())
+            command = ['python', '/Xsoftware64/EM/EMAN2/bin/e2proc2d.py'] + \
+                      self.eman2_options() + [file_, self.jpg_name(file_)]
+            cmds.append(command)
         return cmds
     
+    def convert_chunk(self, chunk):
+        '''
+        runs in the worker processes. Errors are returned instead of raised,
+        so that one bad micrograph does not take down the whole pool.
+        returns [(mrcfile, status, message)], status is converted/skipped/failed
+        '''
+        results = []
+        for mrcfile in chunk:
+            try:
+                outfile = self.convert_image(mrcfile)
+                results.append((mrcfile, 'converted', os.path.basename(outfile)))
+            except FileExistsError:
+                results.append((mrcfile, 'skipped', 'jpg exists, use -f to overwrite'))
+            except Exception as e:
+                results.append((mrcfile, 'failed', '{}: {}'.format(type(e).__name__, e)))
+        return results
+    
+    def report(self, result, position, total):
+        mrcfile, status, message = result
+        print('[{}/{}] {} {}: {}'.format(position, total, status.capitalize(),
+                                         os.path.basename(mrcfile), message))
+    
     def create_images_parallel(self, mrclist):
-        if not os.path.isdir(self.o):
-            os.makedirs(self.o)
-        pool = ThreadPool(self.n_cpus)
-        _ = pool.map(self.convert_image, mrclist)
-        pool.close()
-        pool.join()
+        '''
+        converts in a process pool. At most max_in_flight chunks are queued
+        at any time, so that memory stays flat however many files there are.
+        Progress is reported in input order. Returns the results of all
+        conversions, as given by convert_chunk
+        '''
+        self.make_output_folders()
+        mrclist = sorted(mrclist)
+        chunks = enumerate([mrclist[i:i + self.chunksize] 
+                            for i in range(0, len(mrclist), self.chunksize)])
+        in_flight = {}
+        finished = {} #chunk number -> results, waiting to be reported in order
+        next_chunk = 0
+        position = 0
+        results = []
+        with ProcessPoolExecutor(max_workers=self.n_cpus) as executor:
+            while True:
+                free = self.max_in_flight - len(in_flight)
+                for n, chunk in itertools.islice(chunks, free):
+                    in_flight[executor.submit(self.convert_chunk, chunk)] = (n, chunk)
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    n, chunk = in_flight.pop(future)
+                    try:
+                        finished[n] = future.result()
+                    except Exception as e: #the worker died, e.g. out of memory
+                        msg = '{}: {}'.format(type(e).__name__, e)
+                        finished[n] = [(f, 'failed', msg) for f in chunk]
+                while next_chunk in finished:
+                    for result in finished.pop(next_chunk):
+                        position += 1
+                        self.report(result, position, len(mrclist))
+                        results.append(result)
+                    next_chunk += 1
+        return results
+    
+    def conversion_parameters(self):
+        #anything that changes the jpg. A change invalidates the manifest entries
+        return {'scale': self.scale,
+                'lowpass': self.lowpass,
+                'invert': bool(self.invert),
+                'noflip': bool(self.noflip),
+                'eman2': bool(self.eman2),
+                'pyramid': [n for n, _ in self.levels[1:]],
+                'frames': list(self.frames),
+                'average': bool(self.average),
+                'clip': list(self.clip) if self.clip else None,
+                'clip_method': self.clip_method,
+                'session_stats': self.session_stats}
+    
+    def load_manifest(self, manifest_file):
+        try:
+            with open(manifest_file, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            print('Warning: {} is corrupted, starting a new one'.format(manifest_file))
+            return {}
+    
+    def save_manifest(self, manifest_file, manifest):
+        #write and rename, so that a crash never leaves half a manifest
+        tmp = manifest_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, manifest_file)
+    
+    def start_notifier(self):
+        '''
+        inotify (through the optional inotify_simple package) tells us as soon
+        as the microscope closes a file. Without it we fall back to polling
+        '''
+        try:
+            import inotify_simple
+        except ImportError:
+            return None
+        notifier = inotify_simple.INotify()
+        flags = inotify_simple.flags
+        notifier.add_watch(self.i, flags.CLOSE_WRITE | flags.MOVED_TO)
+        return notifier
+    
+    def wait_for_changes(self, notifier):
+        #returns the names of files that were closed or moved in while waiting
+        if notifier is None:
+            time.sleep(self.poll)
+            return set()
+        events = notifier.read(timeout=int(self.poll * 1000))
+        return {e.name for e in events}
+    
+    def find_new_files(self, manifest, failed, previous, closed):
+        '''
+        one scandir pass over the input folder. A file is ready when it is not
+        in the manifest with the same size, mtime and parameters, when its size
+        has not changed since the last poll (or inotify saw it being closed)
+        and when it is as long as its header says.
+        returns the ready files and the {path: (size, mtime)} seen in this pass
+        '''
+        params = self.conversion_parameters()
+        ready = []
+        current = {}
+        for entry in os.scandir(self.i):
+            if not entry.name.endswith('.mrc') or not entry.is_file():
+                continue
+            stat = entry.stat()
+            state = (stat.st_size, stat.st_mtime)
+            current[entry.path] = state
+            done = manifest.get(entry.name)
+            if done and (done['size'], done['mtime']) == state and done['params'] == params:
+                continue
+            if failed.get(entry.path) == state: #only retry if the file changed
+                continue
+            if previous.get(entry.path) != state and entry.name not in closed:
+                continue #new or still growing, check again next time
+            if mrc_io.is_complete(entry.path):
+                ready.append(entry.path)
+        return ready, current
+    
+    def watch_folder(self):
+        manifest_file = os.path.join(self.o, MANIFEST)
+        manifest = self.load_manifest(manifest_file)
+        params = self.conversion_parameters()
+        notifier = self.start_notifier()
+        failed = {}
+        previous = {}
+        closed = set()
+        print('Watching {} for new micrographs ({}). Press Ctrl-C to stop'.format(
+                            self.i, 'inotify' if notifier else 'polling'))
+        try:
+            while True:
+                ready, previous = self.find_new_files(manifest, failed, previous, closed)
+                if ready:
+                    if self.session_stats and not self.session_limits:
+                        self.session_limits = self.estimate_session_limits(ready)
+                    for mrcfile, status, _ in self.create_images_parallel(ready):
+                        size, mtime = previous[mrcfile]
+                        if status == 'failed':
+                            failed[mrcfile] = (size, mtime)
+                        else:
+                            manifest[os.path.basename(mrcfile)] = {'size': size,
+                                                                   'mtime': mtime,
+                                                                   'params': params}
+                    self.save_manifest(manifest_file, manifest)
+                closed = self.wait_for_changes(notifier)
+        except KeyboardInterrupt:
+            self.save_manifest(manifest_file, manifest)
+            print('\nStopped watching. {} micrographs converted in total'.format(
+                                                                    len(manifest)))
         
     def main(self):
+            if self.watch:
+                return self.watch_folder()
             if not self.file:
                 files = self.get_mrc_files()
             else:
                 files = self.get_mrc_files_from_file(self.file)
-            self.create_images_parallel(files)
+            if self.session_stats:
+                self.session_limits = self.estimate_session_limits(files)
+            results = self.create_images_parallel(files)
 #             self.create_images(files) #testing
+            failed = [r for r in results if r[1] == 'failed']
+            if failed:
+                print('\nThe following micrographs could not be converted:')
+                for mrcfile, _, message in failed:
+                    print('{}: {}'.format(mrcfile, message))
+                sys.exit('{} of {} micrographs failed'.format(len(failed), len(files)))
     
 
 if __name__ == '__main__':
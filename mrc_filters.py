@@ -0,0 +1,134 @@
+from functools import lru_cache
+import numpy as np
+
+#up to this cutoff (in cycles/pixel of the shrunk image) the lowpass is
+#applied after shrinking, which is much cheaper. It is an approximation:
+#the gaussian passes about 0.4% at the new nyquist, and what the mean shrink
+#folds back is filtered a little differently, about 2% rms on white noise
+#(bounded in tests/test_mrc_filters.py)
+SHRINK_FIRST_MAX_SIGMA = 0.15
+
+
+def mean_shrink(image, factor):
+    '''
+    same as EMAN2 --meanshrink: average of factor x factor blocks,
+    incomplete blocks at the edges are dropped. Works on 2d images and on
+    3d stacks (shrinks the last two axes)
+    '''
+    if factor == 1:
+        return np.asarray(image, dtype='f4')
+    ny, nx = image.shape[-2] // factor, image.shape[-1] // factor
+    image = image[..., :ny * factor, :nx * factor]
+    image = image.reshape(image.shape[:-2] + (ny, factor, nx, factor))
+    return image.mean(axis=(-3, -1), dtype='f4')
+
+
+@lru_cache(maxsize=16)
+def gaussian_mask(shape, sigma):
+    '''
+    the EMAN2 filter.lowpass.gauss transfer function exp(-f^2 / 2sigma^2)
+    laid out for rfft2 of an image of the given (ny, nx) shape.
+    sigma is in cycles/pixel. Cached: a session usually has one image size
+    '''
+    fy = np.fft.fftfreq(shape[0]).astype('f4')
+    fx = np.fft.rfftfreq(shape[1]).astype('f4')
+    f2 = fy[:, np.newaxis] ** 2 + fx[np.newaxis, :] ** 2
+    mask = np.exp(-f2 / (2 * sigma ** 2))
+    mask.flags.writeable = False
+    return mask
+
+
+def gaussian_lowpass(image, sigma):
+    '''
+    lowpass with real FFTs. image can be 2d or a 3d stack, in which case
+    all sections are filtered in one call
+    '''
+    image = np.asarray(image, dtype='f4')
+    shape = image.shape[-2:]
+    ft = np.fft.rfft2(image)
+    ft *= gaussian_mask(shape, sigma)
+    return np.fft.irfft2(ft, s=shape).astype('f4', copy=False)
+
+
+class Preprocessor(object):
+    '''
+    the --lowpass and --scale stage of mrc2jpg.
+    lowpass: cutoff frequency in 1/A as given to filter.lowpass.gauss
+    scale: integer meanshrink factor
+    '''
+
+    def __init__(self, lowpass=None, scale=None):
+        super(Preprocessor, self).__init__()
+        self.lowpass = lowpass
+        self.scale = scale or 1
+
+    def shrink_first(self, apix, scale=None):
+        scale = scale or self.scale
+        if scale == 1 or not self.lowpass:
+            return True
+        return self.lowpass * apix * scale <= SHRINK_FIRST_MAX_SIGMA
+
+    def prebin(self, apix=1.0):
+        '''
+        the shrink factor that can be applied to each movie frame before
+        summing without changing the result
+        '''
+        return self.scale if self.shrink_first(apix or 1.0) else 1
+
+    def __call__(self, image, apix=1.0, binned=1):
+        '''
+        binned: shrink factor that has already been applied to image,
+        apix refers to the unbinned pixels
+        '''
+        #EMAN2 falls back to 1 A/pix when the header is empty, so do we
+        apix = (apix or 1.0) * binned
+        scale = self.scale // binned
+        if not self.lowpass:
+            return mean_shrink(image, scale)
+        if self.shrink_first(apix, scale):
+            image = mean_shrink(image, scale)
+            return gaussian_lowpass(image, self.lowpass * apix * scale)
+        image = gaussian_lowpass(image, self.lowpass * apix)
+        return mean_shrink(image, scale)
+
+
+def sample_pixels(image, max_samples=2 ** 20):
+    '''
+    a strided subsample of about max_samples pixels. A view, nothing is copied
+    '''
+    if image.ndim == 1:
+        return image[::max(int(np.ceil(image.size / max_samples)), 1)]
+    step = max(int(np.ceil(np.sqrt(image.size / max_samples))), 1)
+    return image[..., ::step, ::step]
+
+
+def histogram_percentiles(image, percentiles, bins=4096):
+    '''
+    percentiles from a fixed-bin histogram of all pixels, accurate to one
+    bin width. The bin range is a bit wider than the requested percentiles
+    of a subsample, so that a few extreme pixels do not squash all the others
+    into one bin. Pixels outside the range are counted but not binned
+    '''
+    sample = np.asarray(sample_pixels(image), dtype='f4').ravel()
+    margins = (min(percentiles) / 2, (100 + max(percentiles)) / 2)
+    low, high = (float(v) for v in np.percentile(sample, margins))
+    if high <= low:
+        return [low for _ in percentiles]
+    counts, edges = np.histogram(image, bins=bins, range=(low, high))
+    below = np.count_nonzero(image < low)
+    cumulative = (below + np.cumsum(counts)) / image.size
+    cumulative = np.concatenate(([below / image.size], cumulative))
+    return [float(np.interp(p / 100, cumulative, edges)) for p in percentiles]
+
+
+def percentile_limits(image, low, high, method='sample'):
+    '''
+    (low, high) percentiles of the pixel values, used to clip outliers like
+    hot pixels and carbon edges before scaling to 8 bit.
+    method: sample (percentiles of a strided subsample, no full sort) or
+    histogram (one pass over a fixed-bin histogram)
+    '''
+    if method == 'histogram':
+        return tuple(histogram_percentiles(image, (low, high)))
+    sample = np.asarray(sample_pixels(image), dtype='f4').ravel()
+    return tuple(float(v) for v in np.percentile(sample, (low, high)))
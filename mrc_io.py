@@ -0,0 +1,233 @@
+import os
+import numpy as np
+
+#MRC2014 header, see https://www.ccpem.ac.uk/mrc_format/mrc2014.php
+#fields are declared without byte order, read_header applies the right one
+HEADER_FIELDS = [('nx', 'i4'), ('ny', 'i4'), ('nz', 'i4'), ('mode', 'i4'),
+                 ('nxstart', 'i4'), ('nystart', 'i4'), ('nzstart', 'i4'),
+                 ('mx', 'i4'), ('my', 'i4'), ('mz', 'i4'),
+                 ('cella', 'f4', 3), ('cellb', 'f4', 3),
+                 ('mapc', 'i4'), ('mapr', 'i4'), ('maps', 'i4'),
+                 ('dmin', 'f4'), ('dmax', 'f4'), ('dmean', 'f4'),
+                 ('ispg', 'i4'), ('nsymbt', 'i4'),
+                 ('extra1', 'V8'), ('exttyp', 'S4'), ('nversion', 'i4'),
+                 ('extra2', 'V84'),
+                 ('origin', 'f4', 3), ('map', 'S4'), ('machst', 'u1', 4),
+                 ('rms', 'f4'), ('nlabl', 'i4'), ('label', 'S80', 10)]
+HEADER_SIZE = 1024
+
+#mode -> numpy type. Mode 0 is signed as per MRC2014
+MODES = {0: 'i1',
+         1: 'i2',
+         2: 'f4',
+         6: 'u2',
+         12: 'f2'}
+DTYPE_TO_MODE = {np.dtype(v).name: k for k, v in MODES.items()}
+
+#machine stamps
+LITTLE_ENDIAN_STAMP = (0x44, 0x44, 0x00, 0x00)
+BIG_ENDIAN_STAMP = (0x11, 0x11, 0x00, 0x00)
+
+
+def header_dtype(byteorder='<'):
+    fields = []
+    for f in HEADER_FIELDS:
+        name, type_ = f[0], f[1]
+        if type_[0] in 'if':
+            type_ = byteorder + type_
+        fields.append((name, type_) + tuple(f[2:]))
+    return np.dtype(fields)
+
+
+def _guess_byteorder(raw):
+    '''
+    the machine stamp tells the endianness, but many programs write it wrong.
+    If the stamp is missing or odd, the mode and dimensions must make sense
+    in one of the two byte orders
+    '''
+    stamp = tuple(raw[212:214])
+    if stamp == LITTLE_ENDIAN_STAMP[:2]:
+        candidates = ['<', '>']
+    elif stamp == BIG_ENDIAN_STAMP[:2]:
+        candidates = ['>', '<']
+    else:
+        candidates = ['<', '>']
+    for order in candidates:
+        nx, ny, nz, mode = np.frombuffer(raw[:16], dtype=order + 'i4')
+        if mode in MODES and min(nx, ny, nz) > 0:
+            return order
+    raise ValueError('Cannot make sense of the mrc header (mode {})'.format(
+                                        np.frombuffer(raw[12:16], dtype='<i4')[0]))
+
+
+def read_header(mrc):
+    '''
+    returns the header of an mrc file as a numpy record, in the byte order
+    of the file. Use data_dtype(header) for the type of the pixels
+    '''
+    with open(mrc, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    if len(raw) < HEADER_SIZE:
+        raise ValueError('{} is too short to be an mrc file'.format(mrc))
+    order = _guess_byteorder(raw)
+    header = np.frombuffer(raw, dtype=header_dtype(order))[0]
+    return header
+
+
+def data_dtype(header):
+    order = header.dtype['nx'].byteorder
+    order = '<' if order == '=' and np.little_endian else order
+    try:
+        return np.dtype(order + MODES[int(header['mode'])])
+    except KeyError:
+        raise ValueError('mrc mode {} is not supported'.format(header['mode']))
+
+
+def data_offset(header):
+    return HEADER_SIZE + int(header['nsymbt'])
+
+
+def data_size(header):
+    nvoxels = int(header['nx']) * int(header['ny']) * int(header['nz'])
+    return data_dtype(header).itemsize * nvoxels
+
+
+def is_complete(mrc):
+    '''
+    True if the header can be read and the file is as long as the header
+    says. Used to skip files that are still being written
+    '''
+    try:
+        header = read_header(mrc)
+        return os.path.getsize(mrc) >= data_offset(header) + data_size(header)
+    except (OSError, ValueError):
+        return False
+
+
+def read_extended_header(mrc, header=None):
+    '''
+    returns the raw bytes of the extended header (FEI, SERI etc.).
+    Interpretation depends on header['exttyp'] and is left to the caller
+    '''
+    if header is None:
+        header = read_header(mrc)
+    with open(mrc, 'rb') as f:
+        f.seek(HEADER_SIZE)
+        return f.read(int(header['nsymbt']))
+
+
+def read_mrc(mrc, mmap=True):
+    '''
+    returns (header, data) where data has shape (nz, ny, nx).
+    With mmap=True the data is a read only memory map, so only the pages
+    actually used are read from disk
+    '''
+    header = read_header(mrc)
+    dtype = data_dtype(header)
+    shape = (int(header['nz']), int(header['ny']), int(header['nx']))
+    offset = data_offset(header)
+    expected = offset + data_size(header)
+    size = os.path.getsize(mrc)
+    if size < expected:
+        raise ValueError('{} is truncated: {} bytes instead of {}'.format(
+                                                        mrc, size, expected))
+    if mmap:
+        data = np.memmap(mrc, dtype=dtype, mode='r', offset=offset, shape=shape)
+    else:
+        with open(mrc, 'rb') as f:
+            f.seek(offset)
+            data = np.fromfile(f, dtype=dtype, count=shape[0]*shape[1]*shape[2])
+        data = data.reshape(shape)
+    return header, data
+
+
+def iter_sections(mrc, start=None, stop=None, step=None):
+    '''
+    yields the sections (movie frames) of a stack one at a time, as 2d
+    memory maps. Every frame is mapped on its own and released once the
+    caller moves on, so memory use does not grow with the stack depth.
+    start, stop and step select frames as in a python slice
+    '''
+    header, _ = read_mrc(mrc) #validates the file length
+    dtype = data_dtype(header)
+    nz, ny, nx = int(header['nz']), int(header['ny']), int(header['nx'])
+    frame_bytes = dtype.itemsize * nx * ny
+    offset = data_offset(header)
+    for z in range(*slice(start, stop, step).indices(nz)):
+        frame = np.memmap(mrc, dtype=dtype, mode='r', 
+                          offset=offset + z * frame_bytes, shape=(ny, nx))
+        yield frame
+        del frame
+
+
+def read_image(mrc, mmap=True):
+    '''
+    convenience function for single micrographs: returns the first section
+    as a 2d array
+    '''
+    _, data = read_mrc(mrc, mmap=mmap)
+    return data[0]
+
+
+def voxel_size(header):
+    '''
+    pixel size in Angstrom along x, y, z. 0 if the header does not set it
+    '''
+    cella = header['cella']
+    sampling = (header['mx'], header['my'], header['mz'])
+    return tuple(float(c) / int(s) if s else 0. for c, s in zip(cella, sampling))
+
+
+def make_header(shape, dtype, voxel_size=1.0, labels=(), nsymbt=0):
+    '''
+    little endian MRC2014 header for data of shape (nz, ny, nx).
+    The statistics are left as undetermined (dmax < dmin, rms < 0) as allowed
+    by the standard: write_mrc fills them in, streaming writers may not
+    '''
+    try:
+        mode = DTYPE_TO_MODE[np.dtype(dtype).name]
+    except KeyError:
+        raise ValueError('Data type {} cannot be written to mrc'.format(dtype))
+    nz, ny, nx = shape
+    header = np.zeros(1, dtype=header_dtype('<'))[0]
+    header['nx'], header['ny'], header['nz'] = nx, ny, nz
+    header['mode'] = mode
+    header['mx'], header['my'], header['mz'] = nx, ny, nz
+    header['cella'] = (nx * voxel_size, ny * voxel_size, nz * voxel_size)
+    header['cellb'] = (90., 90., 90.)
+    header['mapc'], header['mapr'], header['maps'] = 1, 2, 3
+    header['dmin'], header['dmax'], header['dmean'], header['rms'] = 0, -1, -2, -1
+    header['ispg'] = 0 if nz == 1 else 1
+    header['nsymbt'] = nsymbt
+    header['nversion'] = 20140
+    header['map'] = b'MAP '
+    header['machst'] = LITTLE_ENDIAN_STAMP
+    header['nlabl'] = len(labels)
+    for i, label in enumerate(labels[:10]):
+        header['label'][i] = label.encode()[:80]
+    return header
+
+
+def write_mrc(mrc, data, voxel_size=1.0, labels=(), extended_header=b''):
+    '''
+    writes a 2d image or a 3d stack as MRC2014, little endian.
+    The mode is chosen from the data type of the array
+    '''
+    data = np.asarray(data)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    if data.ndim != 3:
+        raise ValueError('Can only write 2d or 3d arrays, got {}d'.format(data.ndim))
+    if data.dtype.name == 'float64':
+        data = data.astype('f4')
+    header = make_header(data.shape, data.dtype, voxel_size=voxel_size, 
+                         labels=labels, nsymbt=len(extended_header))
+    #stats in float64, otherwise float16 and large int16 images overflow
+    header['dmin'] = data.min()
+    header['dmax'] = data.max()
+    header['dmean'] = data.mean(dtype='f8')
+    header['rms'] = data.std(dtype='f8')
+    with open(mrc, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(extended_header)
+        f.write(data.astype(data.dtype.newbyteorder('<'), copy=False).tobytes())
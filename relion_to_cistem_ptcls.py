@@ -6,44 +6,140 @@
 # cisTEM. You can choose if you want to create a list of files automaticaly or you will provide the files.txt file
 #
 
+import argparse
+import heapq
+import itertools
 import os
-import glob
 import sys
-import re
-
-path = '/local_data/shreya/20180529_Rad6_Rad18_PCNA_neg/A4_cisTEM/PCNA/Micrographs'
-starfile = os.path.join(path, 'particles.star')
-outfile = os.path.join(path, 'cistem_coordinates.txt')
-pattern = os.path.join(path, '*.mrc')
-mrc_cis_full = [os.path.basename(i) for i in glob.glob(pattern)]
-
-if not mrc_cis_full:
-    sys.exit(f'No micrographs found in {path}')
-    
-assert os.path.isfile(starfile)
-
-#change here!
-pixel_size = 2.33
-counter = 0
-
-# create a list from particle.star file
-with open(starfile, 'r') as p:
-    ptcls = p.readlines()
-ptcls = list(set(ptcls)) #particles might be in more than one class average (ML)
-cleaned = [p for p in ptcls if re.sub(r'\s+', '', p) #remove whitespace
-                                   if '_' not in p] #remove headers
-out_ptcls = []
-for particle in ptcls:
-    line = particle.split()
-    if len(line)>3: #header and empty lines
-        micrograph = os.path.basename(line[3])
-        if micrograph not in mrc_cis_full:
-            continue
-        x_ang = float(line[0].strip()) * pixel_size
-        y_ang = float(line[1].strip()) * pixel_size
-        out_ptcls.append(f'{micrograph} {x_ang} {y_ang}')
-        counter +=1
-out_ptcls = sorted(out_ptcls)
-with open(outfile, 'w') as f:
-    f.write('\n'.join(out_ptcls))
-print(f'Found {counter} number of particles and written to {outfile}')
+import tempfile
+import star_io
+
+COLUMNS = ['rlnCoordinateX', 'rlnCoordinateY', 'rlnMicrographName']
+
+
+class CistemExporter(object):
+    '''
+    writes "micrograph x y" lines, with x and y in Angstrom, for the particles
+    of a Relion star file whose micrograph is in the cisTEM folder.
+    The star file is read chunk particles at a time, every chunk is sorted
+    and deduplicated on its own and the chunks are merged at the end,
+    so memory use does not depend on the number of particles
+    '''
+
+    def __init__(self):
+        super(CistemExporter, self).__init__()
+        self.parse_arguments()
+        self.check_args()
+
+    def parse_arguments(self):
+        parser = argparse.ArgumentParser(description='Relion coordinates to cisTEM')
+        parser.add_argument('--path', help='The folder with the micrographs imported '
+                            'by cisTEM. Default: current directory')
+        parser.add_argument('--star', help='The particles star file. '
+                            'Default: [path]/particles.star')
+        parser.add_argument('-o', help='Output file. Default: [path]/cistem_coordinates.txt')
+        parser.add_argument('--apix', help='Pixel size of the micrographs, in Angstrom',
+                            required=True)
+        parser.add_argument('--chunk', help='Particles converted and sorted at a time. '
+                            'Default: 200000')
+        parser.add_argument('--index', help='Keep a byte offset index of the star file '
+                            '([star].idx), so that only the particles of the micrographs '
+                            'in [path] are read', action='store_true')
+        parser.parse_args(namespace=self)
+        return parser
+
+    def check_args(self):
+        self.path = os.path.abspath(self.path or os.getcwd())
+        if not os.path.isdir(self.path):
+            sys.exit(f'The folder {self.path} does not exist')
+        self.star = self.star or os.path.join(self.path, 'particles.star')
+        if not os.path.isfile(self.star):
+            sys.exit(f'The star file {self.star} does not exist')
+        self.o = self.o or os.path.join(self.path, 'cistem_coordinates.txt')
+        try:
+            self.apix = float(self.apix)
+            self.chunk = int(self.chunk or 200000)
+        except ValueError:
+            sys.exit('--apix must be a number, --chunk an integer')
+
+    def list_micrographs(self):
+        with os.scandir(self.path) as entries:
+            mrcs = {e.name for e in entries if e.name.endswith('.mrc')}
+        if not mrcs:
+            sys.exit(f'No micrographs found in {self.path}')
+        return mrcs
+
+    def read_rows(self, mrcs):
+        if self.index:
+            index = star_io.get_index(self.star, 'rlnMicrographName')
+            return star_io.iter_selected_rows(self.star, index,
+                                lambda m: os.path.basename(m) in mrcs, COLUMNS)
+        return star_io.iter_rows(self.star, COLUMNS)
+
+    def convert(self, rows, mrcs):
+        '''
+        one chunk of (x, y, micrograph) rows to sorted, unique output lines
+        '''
+        lines = set()
+        for x, y, micrograph in rows:
+            micrograph = micrograph.rpartition('/')[2]
+            if micrograph in mrcs:
+                lines.add(f'{micrograph} {float(x) * self.apix} {float(y) * self.apix}')
+        return sorted(lines)
+
+    def write_run(self, lines, tmpdir):
+        fd, run = tempfile.mkstemp(suffix='.txt', dir=tmpdir)
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(line + '\n' for line in lines)
+        return run
+
+    def merge(self, runs, out):
+        '''
+        merges the sorted runs into out, dropping the particles that are in
+        more than one run. Returns the number of lines written
+        '''
+        files = [open(run, 'r') for run in runs]
+        try:
+            count = 0
+            previous = None
+            for line in heapq.merge(*files):
+                if line != previous:
+                    out.write(line)
+                    count += 1
+                previous = line
+            return count
+        finally:
+            for f in files:
+                f.close()
+
+    def export(self):
+        mrcs = self.list_micrographs()
+        rows = self.read_rows(mrcs)
+        #particles might be in more than one class average (ML): duplicates
+        #are removed within a chunk when sorting, across chunks when merging
+        first = self.convert(list(itertools.islice(rows, self.chunk)), mrcs)
+        following = list(itertools.islice(rows, self.chunk))
+        tmp = self.o + '.tmp'
+        with open(tmp, 'w') as out:
+            if not following:
+                #all in memory, no need for temporary files
+                out.writelines(line + '\n' for line in first)
+                counter = len(first)
+            else:
+                with tempfile.TemporaryDirectory(dir=os.path.dirname(self.o)) as tmpdir:
+                    runs = [self.write_run(first, tmpdir)]
+                    while following:
+                        runs.append(self.write_run(self.convert(following, mrcs), tmpdir))
+                        following = list(itertools.islice(rows, self.chunk))
+                    counter = self.merge(runs, out)
+        os.replace(tmp, self.o)
+        return counter
+
+    def main(self):
+        counter = self.export()
+        print(f'Found {counter} number of particles and written to {self.o}')
+
+
+if __name__ == '__main__':
+    e = CistemExporter()
+    e.main()
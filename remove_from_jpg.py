@@ -1,11 +1,15 @@
 #!/usr/bin/python
 
 import argparse
-import glob
+import json
 import logging
 import os
-import shutil
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import star_io
+
+JOURNAL = 'remove_from_jpg.journal'
 
 class Micrograph_remover(object):
     
@@ -14,6 +18,7 @@ class Micrograph_remover(object):
         self.parser = self.parse_args()
         self.check = self.check_args()
         self.logger = self.start_logger()
+        self.listings = {}
         
     def parse_args(self):
         parser = argparse.ArgumentParser()
@@ -28,6 +33,20 @@ class Micrograph_remover(object):
         mode.add_argument('-r', help = 'Rename the unwanted micrographs to '
                           'file.mrc_bad (Default mode)', action='store_true')
         mode.add_argument('--star', help = 'starfile from which micrographs must be removed')
+        mode.add_argument('--resume', help = 'Finish the renames and deletions of an '
+                          'interrupted run, as recorded in the journal',
+                          action='store_true')
+        mode.add_argument('--undo', help = 'Rename back the micrographs renamed by '
+                          'earlier runs, as recorded in the journal. Deleted '
+                          'files cannot be restored', action='store_true')
+        parser.add_argument('--index', help = 'Keep a byte offset index of the starfile '
+                            'next to it ([star].idx), so that rows are copied by '
+                            'micrograph without parsing them', action='store_true')
+        parser.add_argument('-n', '--dry_run', help = 'Only report what would be done',
+                            action='store_true')
+        parser.add_argument('--threads', help = 'Number of renames/deletions running '
+                            'at the same time. On network storage most of the time is '
+                            'spent waiting for the server. Default: 16')
         parser.parse_args(namespace=self)
         return parser
     
@@ -47,91 +66,228 @@ class Micrograph_remover(object):
             if not os.path.isdir(self.m):
                 sys.exit('The micrograph dir {} does not exist'.format(self.m))
         #default is rename files in folder
-        if not any((self.star, self.d, self.r)):
+        if not any((self.star, self.d, self.r, self.resume, self.undo)):
             self.r = True
-        if hasattr(self, 'star') and not os.path.isfile(self.star):
+        if self.star and not os.path.isfile(self.star):
             sys.exit('{} does not exist. Aborting'.format(self.star))            
+        try:
+            self.threads = int(self.threads or 16)
+        except ValueError:
+            sys.exit('--threads must be an integer')
+        self.journal = os.path.join(self.m, JOURNAL)
         return 1
     
+    def list_folder(self, folder):
+        '''
+        {extension: set of file names}, from a single scandir of the folder.
+        Cached, every folder is listed only once per run
+        '''
+        folder = os.path.abspath(folder)
+        if folder not in self.listings:
+            listing = {}
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    ext = os.path.splitext(entry.name)[1]
+                    listing.setdefault(ext, set()).add(entry.name)
+            self.listings[folder] = listing
+        return self.listings[folder]
+    
     def get_jpg_list(self):
-        jpgs = glob.glob(os.path.join(self.j, '*.jpg'))
+        jpgs = [os.path.join(self.j, f) for f in self.list_folder(self.j).get('.jpg', ())]
         if len(jpgs) == 0:
             sys.exit('No jpg files found in {}'.format(self.j))
         return jpgs
     
     def get_mrc_list(self):
-        mrcs = glob.glob(os.path.join(self.m, '*.mrc'))
+        mrcs = [os.path.join(self.m, f) for f in self.list_folder(self.m).get('.mrc', ())]
         return mrcs
     
     def rename_unwanted(self, files):
-        for f in files:
-            try:
-                shutil.move(f, f + '_bad')
-            except OSError as e:
-                self.logger.error('The file {} could not be renamed'.format(f))
-                self.logger.debug('Reason: {}\n\n'.format(str(e)))
+        return self.apply([('rename', f, f + '_bad') for f in files])
     
     def delete_unwanted(self, files):
-        for f in files:
-            try:
-                os.remove(f)
-            except OSError as e:
-                self.logger.debug('The file {} could not be removed'.format(f))
-                self.logger.debug('Reason: {}\n\n'.format(str(e)))
+        return self.apply([('delete', f, None) for f in files])
+    
+    def do_action(self, action, src, dst):
+        if action == 'rename':
+            #same folder, so a plain rename: atomic and a single call
+            os.rename(src, dst)
+        else:
+            os.remove(src)
+    
+    def write_journal(self, records):
+        with open(self.journal, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def read_journal(self):
+        '''
+        returns (planned, done, undone): the actions by id and the ids that
+        were completed and reverted. A torn last line is ignored
+        '''
+        planned, done, undone = {}, set(), set()
+        try:
+            with open(self.journal, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if 'action' in record:
+                        planned[record['id']] = (record['action'], record['src'],
+                                                 record['dst'])
+                    elif 'done' in record:
+                        done.add(record['done'])
+                    elif 'undone' in record:
+                        undone.add(record['undone'])
+        except FileNotFoundError:
+            pass
+        return planned, done, undone
+    
+    def apply(self, actions, ids=None, key='done'):
+        '''
+        runs the actions [(action, src, dst)] in a thread pool. Every action is
+        written to the journal before anything is touched, and marked as done
+        as soon as it succeeds, so that an interrupted run can be resumed
+        (--resume) and renames reverted (--undo).
+        returns the number of actions that succeeded
+        '''
+        if not actions:
+            return 0
+        if ids is None:
+            #the pid keeps the ids of two runs in the same second apart
+            run = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+            ids = ['{}:{}'.format(run, i) for i in range(len(actions))]
+            planned = self.read_journal()[0]
+            if any(i in planned for i in ids):
+                sys.exit('Run {} is already in {}. Nothing was changed'.format(
+                                                                run, self.journal))
+            self.write_journal({'id': i, 'action': a, 'src': src, 'dst': dst}
+                               for i, (a, src, dst) in zip(ids, actions))
+        succeeded = 0
+        with ThreadPoolExecutor(max_workers=self.threads) as executor, \
+             open(self.journal, 'a') as journal:
+            futures = {executor.submit(self.do_action, *a): (i, a)
+                       for i, a in zip(ids, actions)}
+            for future in as_completed(futures):
+                i, (action, src, dst) = futures[future]
+                try:
+                    future.result()
+                except OSError as e:
+                    self.logger.error('Could not {} {}'.format(action, src))
+                    self.logger.debug('Reason: {}\n\n'.format(str(e)))
+                    continue
+                journal.write(json.dumps({key: i}) + '\n')
+                journal.flush()
+                succeeded += 1
+        self.logger.info('{} of {} actions succeeded'.format(succeeded, len(actions)))
+        print('{} of {} files processed. Journal: {}'.format(succeeded, len(actions),
+                                                             self.journal))
+        return succeeded
+    
+    def resume_actions(self):
+        planned, done, _ = self.read_journal()
+        todo = [i for i in planned if i not in done]
+        actions = []
+        ids = []
+        for i in todo:
+            action, src, dst = planned[i]
+            if not os.path.exists(src) and (action == 'delete' or os.path.exists(dst)):
+                #done, but interrupted before it was recorded
+                self.write_journal([{'done': i}])
+                continue
+            actions.append(planned[i])
+            ids.append(i)
+        print('Resuming {} actions from {}'.format(len(actions), self.journal))
+        if self.dry_run:
+            self.report(actions)
+            return 0
+        return self.apply(actions, ids)
+    
+    def undo_actions(self):
+        planned, done, undone = self.read_journal()
+        ids = [i for i in planned if i in done and i not in undone]
+        deleted = [i for i in ids if planned[i][0] == 'delete']
+        ids = [i for i in reversed(ids) if planned[i][0] == 'rename']
+        actions = [('rename', planned[i][2], planned[i][1]) for i in ids]
+        print('Undoing {} renames from {}'.format(len(actions), self.journal))
+        if deleted:
+            print('{} deleted files cannot be restored'.format(len(deleted)))
+        if self.dry_run:
+            self.report(actions)
+            return 0
+        return self.apply(actions, ids, key='undone')
+    
+    def report(self, actions, starfile=None, show=10):
+        #dry run: what would be done
+        counts = {}
+        for action, _, _ in actions:
+            counts[action] = counts.get(action, 0) + 1
+        print('Dry run, nothing is changed.')
+        for action, n in sorted(counts.items()):
+            print('Would {} {} files'.format(action, n))
+        for action, src, dst in actions[:show]:
+            print('  {} {}{}'.format(action, src, ' -> ' + dst if dst else ''))
+        if len(actions) > show:
+            print('  ... and {} more'.format(len(actions) - show))
+        if starfile:
+            print('Would write {}'.format(self.cleaned_name(starfile)))
 
     def start_logger(self):
-        log = os.path.join(self.m, '{}remove_from_jpg.log')
+        log = os.path.join(self.m, 'remove_from_jpg.log')
         logger = logging.getLogger(__name__) 
         logging.basicConfig(filename = log, level=logging.INFO)
         return logger
     
     def find_extra_mrcs(self, jpgs, mrcs):
-        jpgs.sort()
-        mrcs.sort()
-        jpgs_base = [os.path.basename(os.path.abspath(i)) for i in jpgs]
-        mrcs_base = [os.path.basename(os.path.abspath(i)).replace('.mrc','.jpg') 
-                     for i in mrcs]
-        extra = []
-        for i, value in enumerate(mrcs_base):
-            if value not in jpgs_base:
-                extra.append(mrcs[i])
-        return extra
+        jpgs_base = {os.path.splitext(os.path.basename(i))[0] for i in jpgs}
+        extra = [m for m in mrcs
+                 if os.path.splitext(os.path.basename(m))[0] not in jpgs_base]
+        return sorted(extra)
+    
+    def cleaned_name(self, starfile):
+        return os.path.splitext(starfile)[0] + '_cleaned.star'
     
     def delete_from_starfile(self, mrcs, starfile):
-        to_delete = [os.path.basename(m)[:-4] for m in mrcs] #*.mrc_bad
-        with open(self.star, 'r') as f:
-            buffer = f.read()
-        out = []
-        #remove all lines that mention bad micrographs
-        for line in buffer.split('\n'):
-#             if line in ['\n', 'data_', 'loop_']:
-#                 out.append(line)
-#                 continue
-#             elif line.startswith('_') or line.startswith('#'):
-#                 out.append(line)
-#                 continue
-#             elif not line:
-#                 continue
-            try:
-                filename = os.path.basename(line.split()[0])
-            except IndexError: #empty line
-                out.append(line)
-                continue
-            if filename not in to_delete:
-                out.append(line)
-            #else ignore line and go on
-        new_name = os.path.join(os.path.normpath(self.star),
-                                (os.path.splitext(starfile)[0] + '_cleaned.star'))
-        with open(new_name, 'w') as o:
-            o.write('\n'.join(out))            
+        #the micrographs may or may not have been renamed to *.mrc_bad already
+        to_delete = {os.path.basename(m).replace('.mrc_bad', '.mrc') for m in mrcs}
+        #remove all rows that mention bad micrographs, everything else is kept
+        new_name = self.cleaned_name(starfile)
+        if self.index:
+            index = star_io.get_index(starfile, 'rlnMicrographName')
+            kept, total = star_io.copy_rows(
+                        starfile, new_name, index,
+                        lambda micrograph: os.path.basename(micrograph) not in to_delete)
+        else:
+            kept, total = star_io.filter_star(
+                        starfile, new_name, 
+                        lambda fields: os.path.basename(fields[0]) not in to_delete,
+                        columns=['rlnMicrographName'])
+        self.logger.info('{} of {} rows of {} written to {}'.format(kept, total, 
+                                                                 starfile, new_name))
             
     def get_bad_mrc_list(self):
-        return glob.glob(os.path.join(self.m, '*.mrc_bad'))
+        return [os.path.join(self.m, f)
+                for f in self.list_folder(self.m).get('.mrc_bad', ())]
     
     def main(self):
+        if self.resume:
+            return self.resume_actions()
+        if self.undo:
+            return self.undo_actions()
         jpgs = self.get_jpg_list()
         mrcs = self.get_mrc_list()
         extra_mrcs = self.find_extra_mrcs(jpgs, mrcs)
+        if self.dry_run:
+            action = 'rename' if self.r else 'delete' if self.d else None
+            actions = [(action, m, m + '_bad' if self.r else None)
+                       for m in extra_mrcs] if action else []
+            starfile = self.star if self.star and extra_mrcs or \
+                                    self.star and self.get_bad_mrc_list() else None
+            self.report(actions, starfile)
+            return
         if len(extra_mrcs): 
             if self.r:
                 self.rename_unwanted(extra_mrcs)
@@ -1,24 +1,37 @@
+import argparse
 import os
-import glob
+import star_io
+
+def remove_jpg_from_starfile(starfile, outfile, jpg_dir, workers=1):
+    #keeps only the micrographs that still have a jpg
+    with os.scandir(jpg_dir) as entries:
+        jpgs = {os.path.splitext(e.name)[0] + '.mrc' for e in entries 
+                if e.name.endswith('.jpg')}
+    if workers > 1:
+        keep = star_io.ValueFilter('rlnMicrographName', jpgs, basename=True)
+        kept, total = star_io.filter_star_sharded(starfile, outfile, [keep], 
+                                                  workers=workers)
+    else:
+        kept, total = star_io.filter_star(starfile, outfile, 
+                                          lambda f: os.path.basename(f[0]) in jpgs,
+                                          columns=['rlnMicrographName'])
+    print(f'{kept} of {total} micrographs written to {outfile}')
+    return kept, total
+
 
 def main():
-    os.chdir(jpg_dir)
-    jpgs = [os.path.splitext(f)[0] + '.mrc' for f in glob.glob('*.jpg')]
-    os.chdir(work_dir)
-    with open(starfile, 'r') as f:
-        temp = f.readlines() 
-    print(temp)
-    out = []
-    for line in temp:
-        if os.path.basename(line.split()[0]) in jpgs:
-            out.append(line)
-    with open(outfile, 'w') as f:
-        f.write('\n'.join(out))
+    parser = argparse.ArgumentParser(description='Removes from a star file the '
+                                     'micrographs whose jpg was deleted')
+    parser.add_argument('starfile', help='e.g. micrographs.star')
+    parser.add_argument('--jpg_dir', help='Folder with the jpgs that were kept', 
+                        required=True)
+    parser.add_argument('-o', help='Output file. Default: [starfile]_clean.star')
+    parser.add_argument('--workers', help='More than 1: large star files are split '
+                        'and filtered in parallel. Default: 1', type=int, default=1)
+    args = parser.parse_args()
+    outfile = args.o or os.path.splitext(args.starfile)[0] + '_clean.star'
+    remove_jpg_from_starfile(args.starfile, outfile, args.jpg_dir, args.workers)
 
 
 if __name__ == '__main__':
-    work_dir = '/local_data/andrea/relion3_benchmark/Select/ctf_res'
-    starfile = 'micrographs.star.bak'
-    outfile = 'micrographs_clean.star'
-    jpg_dir = '/local_data/andrea/relion3_benchmark/Micrographs/jpgs'
-    main()
\ No newline at end of file
+    main()
@@ -1,21 +1,332 @@
-import glob
+import argparse
+import json
 import os
-import shutil
-from math import ceil, log10
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-path = os.path.abspath(os.getcwd())
-files = glob.glob(os.path.join(path, '*.tif'))
+JOURNAL = 'rename_files.journal'
 
-if not files:
-    raise OSError('no files found')
+class BulkRenamer(object):
+    '''
+    renumbers root_number.ext files with zero padded (and optionally
+    shifted) numbers, so that they sort in order, or renames files as listed
+    in a table. The folder is listed once and the whole mapping checked
+    before anything is renamed: a target that belongs to a file that is not
+    renamed, or that two files would get, stops the run. Files whose target
+    is the current name of another renamed file (chains and cycles) go
+    through a temporary name: first every file is moved out of the way,
+    then the temporary names are renamed to the targets.
+    Every rename is recorded in a journal, for --resume and --undo
+    '''
 
-digits = int(ceil(log10(len(files))))
+    def __init__(self):
+        super(BulkRenamer, self).__init__()
+        self.parse_arguments()
+        self.check_args()
 
-for f in files:
-    base, ext = os.path.splitext(f)
-    root, number = os.path.basename(base).split('_') 
-    number = number.zfill(digits)
-    new_name = os.path.join(path,
-                            '{}_{}{}'.format(root, number, ext))
-    shutil.move(f, new_name)
-    
\ No newline at end of file
+    def parse_arguments(self):
+        parser = argparse.ArgumentParser(description='Renumber files with zero '
+                                         'padded numbers (movie_7.tif -> movie_007.tif), '
+                                         'or rename them as listed in a file')
+        parser.add_argument('-f', '--folder', help='Folder with the files. '
+                            'Default: current directory')
+        parser.add_argument('--ext', help='Extension of the files to rename. '
+                            'Default: .tif')
+        parser.add_argument('--digits', help='Digits of the numbers. Default: as '
+                            'many as the largest number')
+        parser.add_argument('--shift', help='Added to every number, e.g. to continue '
+                            'the numbering of an earlier session. Default: 0')
+        parser.add_argument('--map', help='Instead of renumbering, rename as listed in '
+                            'this file: one "old new" pair of names per line')
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument('--resume', help='Finish the renames of an interrupted '
+                          'run, as recorded in the journal', action='store_true')
+        mode.add_argument('--undo', help='Rename back the files renamed by earlier '
+                          'runs, as recorded in the journal', action='store_true')
+        parser.add_argument('-n', '--dry_run', help='Only report what would be done',
+                            action='store_true')
+        parser.add_argument('--threads', help='Number of renames running at the same '
+                            'time. On network storage most of the time is spent '
+                            'waiting for the server. Default: 16')
+        parser.parse_args(namespace=self)
+        return parser
+
+    def check_args(self):
+        self.folder = os.path.abspath(self.folder or os.getcwd())
+        if not os.path.isdir(self.folder):
+            sys.exit('The folder {} does not exist'.format(self.folder))
+        self.ext = self.ext or '.tif'
+        if not self.ext.startswith('.'):
+            self.ext = '.' + self.ext
+        try:
+            self.threads = int(self.threads or 16)
+            self.digits = int(self.digits) if self.digits else None
+            self.shift = int(self.shift or 0)
+        except ValueError:
+            sys.exit('--threads, --digits and --shift must be integers')
+        if self.map and not os.path.isfile(self.map):
+            sys.exit('{} does not exist'.format(self.map))
+        self.journal = os.path.join(self.folder, JOURNAL)
+
+    def list_folder(self):
+        #the only listing of the folder: on network storage it is the slow part
+        with os.scandir(self.folder) as entries:
+            return {e.name for e in entries}
+
+    def read_map(self, names):
+        #{old: new} from the --map file
+        mapping = {}
+        with open(self.map, 'r') as f:
+            for n, line in enumerate(f, 1):
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                if len(fields) != 2 or '/' in fields[0] + fields[1]:
+                    sys.exit('Line {} of {}: expected "old new" file names'.format(
+                                                                        n, self.map))
+                if fields[0] not in names:
+                    sys.exit('{} (line {} of {}) does not exist'.format(fields[0], n,
+                                                                      self.map))
+                if fields[0] in mapping:
+                    sys.exit('{} is listed twice in {}'.format(fields[0], self.map))
+                mapping[fields[0]] = fields[1]
+        return mapping
+
+    def renumber(self, names):
+        #{old: new} of the files named root_number.ext, and the files skipped
+        numbered = []
+        skipped = []
+        for name in names:
+            if not name.endswith(self.ext):
+                continue
+            root, sep, number = name[:-len(self.ext)].rpartition('_')
+            if not sep or not number.isdigit():
+                skipped.append(name)
+                continue
+            numbered.append((name, root, int(number) + self.shift))
+        if not numbered:
+            return {}, skipped
+        digits = self.digits or max(len(str(abs(n))) for _, _, n in numbered)
+        mapping = {}
+        for name, root, number in numbered:
+            if number < 0:
+                sys.exit('{} would get a negative number'.format(name))
+            mapping[name] = '{}_{}{}'.format(root, str(number).zfill(digits), self.ext)
+        return mapping, skipped
+
+    def plan(self, names):
+        '''
+        returns ({source: target}, conflicts, skipped). Files that already
+        have the right name are not in the mapping
+        '''
+        if self.map:
+            mapping, skipped = self.read_map(names), []
+        else:
+            mapping, skipped = self.renumber(names)
+        mapping = {s: t for s, t in mapping.items() if s != t}
+        conflicts = []
+        claimed = {}
+        for source, target in sorted(mapping.items()):
+            if target in claimed:
+                conflicts.append('{} and {} would both become {}'.format(
+                                                    claimed[target], source, target))
+            elif target in names and target not in mapping:
+                conflicts.append('{} would overwrite {}'.format(source, target))
+            claimed[target] = source
+        return mapping, conflicts, sorted(skipped)
+
+    def steps(self, mapping, names, run):
+        '''
+        the renames [(phase, src, dst)]. Phase 1 moves every file to its
+        target, or to a temporary name if the target is still taken by
+        another file of the mapping; phase 2 renames the temporary names
+        '''
+        first, second = [], []
+        for source, target in sorted(mapping.items()):
+            if target in mapping:
+                tmp = '.{}.{}.tmp'.format(source, run)
+                if tmp in names:
+                    sys.exit('Temporary name {} already exists'.format(tmp))
+                first.append((1, source, tmp))
+                second.append((2, tmp, target))
+            else:
+                first.append((1, source, target))
+        return first + second
+
+    def write_journal(self, records):
+        with open(self.journal, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read_journal(self):
+        '''
+        returns (planned, done, undone): the renames by id, in the order
+        they were planned, and the ids that were completed and reverted.
+        A torn last line is ignored
+        '''
+        planned, done, undone = {}, set(), set()
+        try:
+            with open(self.journal, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if 'src' in record:
+                        planned[record['id']] = (record['phase'], record['src'],
+                                                 record['dst'])
+                    elif 'done' in record:
+                        done.add(record['done'])
+                    elif 'undone' in record:
+                        undone.add(record['undone'])
+        except FileNotFoundError:
+            pass
+        return planned, done, undone
+
+    def do_rename(self, src, dst):
+        #same folder: a plain rename, atomic and a single call to the server.
+        #os.rename would replace an existing dst on posix, check first
+        if os.path.lexists(os.path.join(self.folder, dst)):
+            raise FileExistsError('{} already exists'.format(dst))
+        os.rename(os.path.join(self.folder, src), os.path.join(self.folder, dst))
+
+    def rename_batch(self, batch):
+        #[(id, src, dst)] -> [(id, src, error or None)]
+        results = []
+        for i, src, dst in batch:
+            try:
+                self.do_rename(src, dst)
+                results.append((i, src, None))
+            except OSError as e:
+                results.append((i, src, e))
+        return results
+
+    def apply(self, renames, ids, key='done', batch=64):
+        '''
+        runs the renames [(src, dst)] of one phase in a thread pool, batch
+        renames per task, marking them in the journal as soon as their
+        batch is over. returns the number of renames that failed
+        '''
+        failed = 0
+        todo = [(i, src, dst) for i, (src, dst) in zip(ids, renames)]
+        with ThreadPoolExecutor(max_workers=self.threads) as executor, \
+             open(self.journal, 'a') as journal:
+            futures = [executor.submit(self.rename_batch, todo[n:n + batch])
+                       for n in range(0, len(todo), batch)]
+            for future in as_completed(futures):
+                for i, src, error in future.result():
+                    if error is not None:
+                        print('Could not rename {}: {}'.format(src, error))
+                        failed += 1
+                        continue
+                    journal.write(json.dumps({key: i}) + '\n')
+                journal.flush()
+        return failed
+
+    def run_phases(self, planned, ids, key='done', reverse=False):
+        '''
+        applies the planned renames of ids phase by phase (last phase first
+        if reverse). A phase starts only if the previous one had no errors
+        '''
+        phases = sorted({planned[i][0] for i in ids}, reverse=reverse)
+        done = 0
+        for phase in phases:
+            phase_ids = [i for i in ids if planned[i][0] == phase]
+            renames = [(planned[i][2], planned[i][1]) if reverse else planned[i][1:]
+                       for i in phase_ids]
+            failed = self.apply(renames, phase_ids, key)
+            done += len(renames) - failed
+            if failed:
+                print('{} renames failed, stopping. Fix the cause and run again with '
+                      '{}'.format(failed, '--undo' if reverse else '--resume'))
+                break
+        print('{} renames done. Journal: {}'.format(done, self.journal))
+        return done
+
+    def report(self, steps, conflicts=(), skipped=(), show=10):
+        #dry run: what would be done
+        print('Dry run, nothing is changed.')
+        if skipped:
+            print('{} files without _number are left alone'.format(len(skipped)))
+        for conflict in conflicts[:show]:
+            print('  conflict: ' + conflict)
+        print('Would rename {} files with {} renames'.format(
+                        sum(1 for s in steps if s[0] == 1), len(steps)))
+        for _, src, dst in steps[:show]:
+            print('  {} -> {}'.format(src, dst))
+        if len(steps) > show:
+            print('  ... and {} more'.format(len(steps) - show))
+
+    def resume_renames(self):
+        planned, done, _ = self.read_journal()
+        ids = []
+        for i, (phase, src, dst) in planned.items():
+            if i in done:
+                continue
+            if not os.path.lexists(os.path.join(self.folder, src)) and \
+               os.path.lexists(os.path.join(self.folder, dst)):
+                #done, but interrupted before it was recorded
+                self.write_journal([{'done': i}])
+                continue
+            ids.append(i)
+        print('Resuming {} renames from {}'.format(len(ids), self.journal))
+        if self.dry_run:
+            self.report([planned[i] for i in ids])
+            return 0
+        return self.run_phases(planned, ids)
+
+    def undo_renames(self):
+        planned, done, undone = self.read_journal()
+        #the last run first
+        runs = []
+        for i in planned:
+            run = i.rsplit(':', 1)[0]
+            if run not in runs:
+                runs.append(run)
+        print('Undoing the renames of {} runs from {}'.format(len(runs), self.journal))
+        total = 0
+        for run in reversed(runs):
+            ids = [i for i in planned if i.rsplit(':', 1)[0] == run
+                   and i in done and i not in undone]
+            if not ids:
+                continue
+            if self.dry_run:
+                self.report([(p, dst, src) for p, src, dst in (planned[i] for i in ids)])
+                continue
+            total += self.run_phases(planned, ids, key='undone', reverse=True)
+        return total
+
+    def main(self):
+        if self.resume:
+            return self.resume_renames()
+        if self.undo:
+            return self.undo_renames()
+        names = self.list_folder()
+        mapping, conflicts, skipped = self.plan(names)
+        run = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        steps = self.steps(mapping, names, run)
+        if self.dry_run:
+            self.report(steps, conflicts, skipped)
+            return 0
+        if conflicts:
+            print('\n'.join(conflicts[:10]))
+            sys.exit('{} conflicts, nothing was renamed'.format(len(conflicts)))
+        if not steps:
+            print('Nothing to rename in {}'.format(self.folder))
+            return 0
+        if skipped:
+            print('{} files without _number are left alone'.format(len(skipped)))
+        #the whole plan is in the journal before the first rename
+        ids = ['{}:{}'.format(run, n) for n in range(len(steps))]
+        self.write_journal({'id': i, 'phase': phase, 'src': src, 'dst': dst}
+                           for i, (phase, src, dst) in zip(ids, steps))
+        planned = {i: step for i, step in zip(ids, steps)}
+        return self.run_phases(planned, ids)
+
+
+if __name__ == '__main__':
+    r = BulkRenamer()
+    r.main()
@@ -0,0 +1,148 @@
+import argparse
+import os
+import sys
+import numpy as np
+
+#all the picks of a gautomatch_screener sweep in one npz file, as columns.
+#Every pick has the index of its micrograph and of its run, a run being one
+#(parameter, value) of the test matrix. counts[micrograph, run] is kept as
+#well, so that micrographs without picks show up as zeros (and runs that
+#failed as -1)
+RESULTS = 'gautomatch_results.npz'
+
+
+def save_results(outfile, picked):
+    '''
+    picked: {(mrc, parameter, value): [(x, y, figure of merit)]}
+    '''
+    micrographs = sorted({os.path.basename(mrc) for mrc, _, _ in picked})
+    runs = sorted({(par, str(value)) for _, par, value in picked})
+    mic_index = {m: i for i, m in enumerate(micrographs)}
+    run_index = {r: i for i, r in enumerate(runs)}
+    counts = np.full((len(micrographs), len(runs)), -1, dtype='i4')
+    total = sum(len(picks) for picks in picked.values())
+    columns = {'micrograph': np.empty(total, dtype='i4'),
+               'run': np.empty(total, dtype='i4'),
+               'x': np.empty(total, dtype='i4'),
+               'y': np.empty(total, dtype='i4'),
+               'fom': np.empty(total, dtype='f4')}
+    n = 0
+    for (mrc, par, value), picks in picked.items():
+        m = mic_index[os.path.basename(mrc)]
+        r = run_index[(par, str(value))]
+        counts[m, r] = len(picks)
+        if not picks:
+            continue
+        picks = np.asarray(picks, dtype='f8').reshape(-1, 3)
+        columns['micrograph'][n:n + len(picks)] = m
+        columns['run'][n:n + len(picks)] = r
+        columns['x'][n:n + len(picks)] = picks[:, 0]
+        columns['y'][n:n + len(picks)] = picks[:, 1]
+        columns['fom'][n:n + len(picks)] = picks[:, 2]
+        n += len(picks)
+    #write and rename, a crash never leaves half a file behind
+    tmp = outfile + '.tmp.npz'
+    np.savez_compressed(tmp, micrographs=np.array(micrographs, dtype=str),
+                        run_parameter=np.array([r[0] for r in runs], dtype=str),
+                        run_value=np.array([r[1] for r in runs], dtype=str),
+                        counts=counts, **columns)
+    os.replace(tmp, outfile)
+    return outfile
+
+
+class ScreenerResults(object):
+    '''
+    read access to a results file. The file is loaded once, queries are
+    done on the arrays in memory
+    '''
+
+    def __init__(self, results):
+        super(ScreenerResults, self).__init__()
+        with np.load(results) as data:
+            self.data = {k: data[k] for k in data.files}
+        self.micrographs = self.data['micrographs']
+        self.runs = list(zip(self.data['run_parameter'].tolist(),
+                             self.data['run_value'].tolist()))
+
+    def run_index(self, parameter, value):
+        try:
+            return self.runs.index((parameter, str(value)))
+        except ValueError:
+            raise KeyError('No run with {} = {}'.format(parameter, value))
+
+    def picks(self, parameter, value, micrograph=None):
+        '''
+        (x, y, fom) arrays of one run, optionally of one micrograph only
+        '''
+        mask = self.data['run'] == self.run_index(parameter, value)
+        if micrograph is not None:
+            m = np.flatnonzero(self.micrographs == os.path.basename(micrograph))
+            mask &= self.data['micrograph'] == (m[0] if len(m) else -1)
+        return self.data['x'][mask], self.data['y'][mask], self.data['fom'][mask]
+
+    def counts(self, parameter=None):
+        '''
+        picks per micrograph per value: {(parameter, value): counts array},
+        in the order of self.micrographs. -1 where the run failed
+        '''
+        return {run: self.data['counts'][:, r] for r, run in enumerate(self.runs)
+                if parameter is None or run[0] == parameter}
+
+    def fom_percentiles(self, percentiles=(5, 25, 50, 75, 95)):
+        #{(parameter, value): figure of merit at the percentiles}, NaN if no picks
+        foms = np.split(self.data['fom'][np.argsort(self.data['run'], kind='stable')],
+                        np.cumsum(np.bincount(self.data['run'],
+                                              minlength=len(self.runs)))[:-1])
+        return {run: np.percentile(f, percentiles) if len(f) else
+                     np.full(len(percentiles), np.nan)
+                for run, f in zip(self.runs, foms)}
+
+    def fom_histogram(self, parameter, value, bins=20, limits=(0, 1)):
+        _, _, fom = self.picks(parameter, value)
+        return np.histogram(fom, bins=bins, range=limits)
+
+    def summary(self):
+        '''
+        one row per run: parameter, value, mean/min/max picks per micrograph,
+        median figure of merit and its interquartile range
+        '''
+        percentiles = self.fom_percentiles((25, 50, 75))
+        rows = []
+        for run, counts in self.counts().items():
+            counts = counts[counts >= 0]
+            q1, median, q3 = percentiles[run]
+            if not len(counts):
+                counts = np.zeros(1, dtype='i4')
+            rows.append((run[0], run[1], counts.mean(), counts.min(), counts.max(),
+                         median, q3 - q1))
+        return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summary of a gautomatch_screener '
+                                     'sweep')
+    parser.add_argument('results', nargs='?', default=RESULTS,
+                        help='The results file. Default: ./' + RESULTS)
+    parser.add_argument('--per_micrograph', help='Also print the number of picks '
+                        'of every micrograph for every value', action='store_true')
+    args = parser.parse_args()
+    if not os.path.isfile(args.results):
+        sys.exit('{} does not exist'.format(args.results))
+    results = ScreenerResults(args.results)
+    print('{} micrographs, {} runs, {} picks'.format(len(results.micrographs),
+                                                     len(results.runs),
+                                                     len(results.data['fom'])))
+    print('{:<16}{:>10}{:>10}{:>8}{:>8}{:>12}{:>10}'.format(
+            'parameter', 'value', 'mean', 'min', 'max', 'median fom', 'iqr'))
+    for par, value, mean, low, high, median, iqr in results.summary():
+        print('{:<16}{:>10}{:>10.1f}{:>8}{:>8}{:>12.3f}{:>10.3f}'.format(
+                par, value, mean, low, high, median, iqr))
+    if args.per_micrograph:
+        counts = results.counts()
+        print('\t'.join(['micrograph'] + ['{}={}'.format(*run) for run in counts]))
+        for m, name in enumerate(results.micrographs):
+            print('\t'.join([name] + [str(c[m]) for c in counts.values()]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,578 @@
+import json
+import mmap
+import os
+import shlex
+import shutil
+import tempfile
+
+#RELION STAR files: one or more data_ blocks, each either a list of
+#_label value pairs or a loop_ table with one _label per column.
+#Files are read in binary mode, so that byte offsets can be used to seek
+#straight to a table and to copy the parts that are not modified
+
+
+def label(name):
+    #accepts rlnMicrographName as well as _rlnMicrographName
+    return name if name.startswith('_') else '_' + name
+
+
+class Table(object):
+    '''
+    description of one data_ block, without the rows.
+    start, stop: byte range of the rows of a loop_ (stop is None if the
+    file was not read that far). header: the bytes from data_ to start
+    '''
+
+    def __init__(self, name, offset):
+        super(Table, self).__init__()
+        self.name = name
+        self.offset = offset
+        self.loop = False
+        self.labels = []
+        self.pairs = {}
+        self.start = None
+        self.stop = None
+        self.header = b''
+
+    def __contains__(self, name):
+        return label(name) in self.labels
+
+    def __repr__(self):
+        return 'Table(data_{}, {} columns)'.format(self.name, len(self.labels))
+
+    def index(self, name):
+        try:
+            return self.labels.index(label(name))
+        except ValueError:
+            raise KeyError('{} not found in data_{} (columns: {})'.format(
+                                        label(name), self.name, ' '.join(self.labels)))
+
+    def indices(self, names):
+        return [self.index(n) for n in names]
+
+
+def _split(line):
+    #quoted values are rare in RELION files, only pay for shlex when needed
+    line = line.decode()
+    if '"' in line or "'" in line:
+        return shlex.split(line, comments=True)
+    return line.split()
+
+
+def _scan(f):
+    '''
+    yields every Table of an open binary file as soon as its header is
+    complete. The caller can stop early; if it does not, the stop offsets
+    are filled in as the rest of the file is read
+    '''
+    pos = 0
+    table = None
+    pending = False #header read but table not yet yielded
+    for line in f:
+        stripped = line.strip()
+        if stripped.startswith(b'data_'):
+            if table is not None:
+                table.stop = pos
+                if pending:
+                    yield table
+            table = Table(stripped[5:].decode(), pos)
+            table.start = pos + len(line)
+            pending = True
+        elif table is None or not stripped or stripped.startswith(b'#'):
+            pass
+        elif stripped.startswith(b'loop_'):
+            table.loop = True
+            table.start = pos + len(line)
+        elif stripped.startswith(b'_') and pending:
+            fields = _split(stripped)
+            if table.loop:
+                table.labels.append(fields[0])
+            else:
+                table.pairs[fields[0]] = fields[1] if len(fields) > 1 else ''
+            table.start = pos + len(line)
+        elif pending:
+            #first row of a loop: the header is complete
+            pending = False
+            yield table
+        pos += len(line)
+    if table is not None:
+        table.stop = pos
+        if pending:
+            yield table
+
+
+def _finish(table, f):
+    f.seek(table.offset)
+    table.header = f.read(table.start - table.offset)
+    return table
+
+
+def read_tables(starfile):
+    '''
+    all the blocks of a STAR file, with the byte range of their rows.
+    Reads the whole file once, in constant memory
+    '''
+    with open(starfile, 'rb') as f:
+        tables = list(_scan(f))
+        return [_finish(t, f) for t in tables]
+
+
+def find_table(starfile, block=None, column=None):
+    '''
+    the first block named block (without data_), or the first one that has
+    the column, or the first loop_. Only reads up to the header of that block
+    '''
+    with open(starfile, 'rb') as f:
+        for table in _scan(f):
+            if block is not None and table.name != block:
+                continue
+            if column is not None and column not in table:
+                continue
+            if block is None and column is None and not table.loop:
+                continue
+            return _finish(table, f)
+    what = 'data_' + block if block is not None else column or 'loop_'
+    raise KeyError('No {} in {}'.format(what, starfile))
+
+
+def _iter_body(f, table):
+    #raw row lines of a loop. Stops at the next block
+    f.seek(table.start)
+    for line in f:
+        stripped = line.strip()
+        if not stripped or stripped.startswith(b'#'):
+            continue
+        if stripped.startswith(b'data_') or stripped.startswith(b'loop_'):
+            break
+        yield line
+
+
+def iter_rows(starfile, columns=None, block=None, table=None):
+    '''
+    streams the rows of a loop as tuples of strings, one line at a time.
+    columns: labels to return, in that order. Default: all of them.
+    The table is found as in find_table(starfile, block, first column)
+    '''
+    if table is None:
+        table = find_table(starfile, block, columns[0] if columns else None)
+    idx = table.indices(columns) if columns else None
+    with open(starfile, 'rb') as f:
+        for line in _iter_body(f, table):
+            fields = _split(line)
+            if idx is None:
+                yield tuple(fields)
+            else:
+                yield tuple(fields[i] for i in idx)
+
+
+def _to_array(values):
+    #int if possible, then float, else strings
+    import numpy as np
+    for dtype in ('i8', 'f8'):
+        try:
+            return np.array(values, dtype=dtype)
+        except ValueError:
+            pass
+    return np.array(values, dtype=str)
+
+
+def read_columns(starfile, columns, block=None, table=None, chunk=2 ** 16):
+    '''
+    the columnar path: returns {label: numpy array} for the given columns.
+    Numeric columns become int64 or float64 arrays, the others string arrays.
+    Rows are converted chunk rows at a time, so the only large objects
+    are the arrays themselves
+    '''
+    #numpy only for the columnar path: the row tools start without it
+    import numpy as np
+    if table is None:
+        table = find_table(starfile, block, columns[0])
+    idx = table.indices(columns)
+    parts = [[] for _ in columns]
+    buffer = [[] for _ in columns]
+    def flush():
+        for part, values in zip(parts, buffer):
+            if values:
+                part.append(_to_array(values))
+                del values[:]
+    with open(starfile, 'rb') as f:
+        for n, line in enumerate(_iter_body(f, table), 1):
+            fields = _split(line)
+            for values, i in zip(buffer, idx):
+                values.append(fields[i])
+            if n % chunk == 0:
+                flush()
+    flush()
+    out = {}
+    for name, part in zip(columns, parts):
+        if not part:
+            out[name] = np.array([], dtype='f8')
+        elif any(p.dtype.kind == 'U' for p in part):
+            out[name] = np.concatenate([p.astype(str) for p in part])
+        elif any(p.dtype.kind == 'f' for p in part):
+            out[name] = np.concatenate([p.astype('f8') for p in part])
+        else:
+            out[name] = np.concatenate(part)
+    return out
+
+
+def read_records(starfile, columns, block=None, table=None):
+    '''
+    as read_columns, as a numpy record array with the labels (without the
+    leading _) as field names
+    '''
+    import numpy as np
+    data = read_columns(starfile, columns, block, table)
+    return np.rec.fromarrays([data[c] for c in columns],
+                             names=[label(c)[1:] for c in columns])
+
+
+def write_star(outfile, labels, rows, block=''):
+    '''
+    writes a single loop_ table. rows: iterable of sequences of values,
+    written one at a time
+    '''
+    with open(outfile, 'w') as f:
+        f.write('\ndata_{}\n\nloop_\n'.format(block))
+        for i, name in enumerate(labels, 1):
+            f.write('{} #{}\n'.format(label(name), i))
+        count = 0
+        for row in rows:
+            f.write('\t'.join(str(v) for v in row) + '\n')
+            count += 1
+    return count
+
+
+def filter_star(starfile, outfile, keep, columns=None, block=None, table=None):
+    '''
+    copies starfile to outfile, dropping the rows of one loop for which
+    keep(fields) is False. fields are the values of columns, or of all
+    columns. Everything else (other blocks, headers, comments) is copied
+    byte for byte. Returns (rows kept, rows read)
+    '''
+    if table is None:
+        table = find_table(starfile, block, columns[0] if columns else None)
+    idx = table.indices(columns) if columns else None
+    kept = total = 0
+    with open(starfile, 'rb') as f, open(outfile, 'wb') as out:
+        out.write(f.read(table.start))
+        for line in f:
+            stripped = line.strip()
+            if not stripped or stripped.startswith(b'#'):
+                out.write(line)
+                continue
+            if stripped.startswith(b'data_') or stripped.startswith(b'loop_'):
+                #the rest of the file is not touched
+                out.write(line)
+                shutil.copyfileobj(f, out)
+                break
+            fields = _split(line)
+            total += 1
+            if keep(fields if idx is None else [fields[i] for i in idx]):
+                if not line.endswith(b'\n'):
+                    line += b'\n'
+                out.write(line)
+                kept += 1
+    return kept, total
+
+
+#sidecar index: for every value of one column (usually rlnMicrographName),
+#the byte ranges of its rows. RELION writes the particles of a micrograph
+#next to each other, so there are few ranges even for millions of rows
+INDEX_SUFFIX = '.idx'
+
+
+def index_path(starfile):
+    return starfile + INDEX_SUFFIX
+
+
+def _iter_body_offsets(f, table):
+    #as _iter_body, with the byte offset of every line. Returns the end offset
+    pos = table.start
+    f.seek(pos)
+    for line in f:
+        stripped = line.strip()
+        if stripped.startswith(b'data_') or stripped.startswith(b'loop_'):
+            break
+        if stripped and not stripped.startswith(b'#'):
+            yield pos, line
+        pos += len(line)
+
+
+def build_index(starfile, column='rlnMicrographName', block=None):
+    '''
+    reads the table once and writes the sidecar index of column.
+    The index is tied to the size and modification time of starfile
+    '''
+    table = find_table(starfile, block, column)
+    i = table.index(column)
+    stat = os.stat(starfile)
+    ranges = {} #value -> [[start, stop, rows], ...]
+    last = None
+    stop = table.start
+    with open(starfile, 'rb') as f:
+        for pos, line in _iter_body_offsets(f, table):
+            value = _split(line)[i]
+            stop = pos + len(line)
+            if value == last and ranges[value][-1][1] == pos:
+                ranges[value][-1][1] = stop
+                ranges[value][-1][2] += 1
+            else:
+                ranges.setdefault(value, []).append([pos, stop, 1])
+            last = value
+    index = {'size': stat.st_size,
+             'mtime': stat.st_mtime_ns,
+             'block': table.name,
+             'column': label(column),
+             'start': table.start,
+             'stop': stop,
+             'ranges': ranges}
+    #write and rename, the index is either complete or not there
+    tmp = '{}.{}.tmp'.format(index_path(starfile), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, index_path(starfile))
+    return index
+
+
+def load_index(starfile, column='rlnMicrographName'):
+    #the sidecar index, or None if there is none or starfile changed since
+    try:
+        with open(index_path(starfile), 'r') as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    stat = os.stat(starfile)
+    if (index.get('size'), index.get('mtime'), index.get('column')) != \
+       (stat.st_size, stat.st_mtime_ns, label(column)):
+        return None
+    return index
+
+
+def get_index(starfile, column='rlnMicrographName', block=None):
+    index = load_index(starfile, column)
+    if index is None:
+        index = build_index(starfile, column, block)
+    return index
+
+
+def count_rows(index):
+    #{value: number of rows}, without reading the star file
+    return {value: sum(r[2] for r in ranges) 
+            for value, ranges in index['ranges'].items()}
+
+
+def select_ranges(index, keep):
+    '''
+    the byte ranges of the rows whose indexed value passes keep(value),
+    in file order, with adjacent ranges merged. Returns (ranges, rows)
+    '''
+    selected = sorted(r for value, ranges in index['ranges'].items() 
+                      if keep(value) for r in ranges)
+    merged = []
+    rows = 0
+    for start, stop, n in selected:
+        if merged and merged[-1][1] == start:
+            merged[-1][1] = stop
+        else:
+            merged.append([start, stop])
+        rows += n
+    return merged, rows
+
+
+def copy_rows(starfile, outfile, index, keep):
+    '''
+    as filter_star, with the decision taken on the indexed value only:
+    the header, the selected byte ranges and the rest of the file are copied
+    from a memory map without parsing any row. Returns (rows kept, rows read)
+    '''
+    ranges, kept = select_ranges(index, keep)
+    total = sum(count_rows(index).values())
+    with open(starfile, 'rb') as f, open(outfile, 'wb') as out:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0, 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                out.write(view[:index['start']])
+                for start, stop in ranges:
+                    out.write(view[start:stop])
+                if ranges and mm[ranges[-1][1] - 1] != ord('\n'):
+                    out.write(b'\n')
+                out.write(view[index['stop']:])
+            finally:
+                view.release()
+    return kept, total
+
+
+def iter_selected_rows(starfile, index, keep, columns=None):
+    '''
+    as iter_rows, but only for the rows whose indexed value passes keep(value).
+    Only the selected byte ranges are read
+    '''
+    table = find_table(starfile, index['block'])
+    idx = table.indices(columns) if columns else None
+    ranges, _ = select_ranges(index, keep)
+    with open(starfile, 'rb') as f:
+        for start, stop in ranges:
+            f.seek(start)
+            for line in f.read(stop - start).splitlines():
+                fields = _split(line)
+                if not fields:
+                    continue
+                if idx is None:
+                    yield tuple(fields)
+                else:
+                    yield tuple(fields[i] for i in idx)
+
+
+class ValueFilter(object):
+    '''
+    a keep (or, with drop=True, drop) condition on one column, that can be
+    sent to other processes: values in a set (compared without the
+    directories if basename=True) and/or numbers between minimum and maximum
+    '''
+
+    def __init__(self, column, values=None, minimum=None, maximum=None,
+                 basename=False, drop=False):
+        super(ValueFilter, self).__init__()
+        self.column = label(column)
+        self.values = set(values) if values is not None else None
+        self.minimum = minimum
+        self.maximum = maximum
+        self.basename = basename
+        self.drop = drop
+        self.i = None
+
+    def bind(self, table):
+        self.i = table.index(self.column)
+        return self
+
+    def __call__(self, fields):
+        value = fields[self.i]
+        keep = True
+        if self.values is not None:
+            keep = (value.rpartition('/')[2] if self.basename else value) in self.values
+        if keep and (self.minimum is not None or self.maximum is not None):
+            number = float(value)
+            keep = (self.minimum is None or number >= self.minimum) and \
+                   (self.maximum is None or number <= self.maximum)
+        return keep != self.drop
+
+
+def shard_ranges(starfile, start, n):
+    '''
+    splits the bytes from start to the end of the file in about n ranges
+    that begin and end at line boundaries
+    '''
+    size = os.path.getsize(starfile)
+    step = max((size - start) // max(n, 1), 1)
+    bounds = [start]
+    with open(starfile, 'rb') as f:
+        for target in range(start + step, size, step):
+            if target <= bounds[-1]:
+                continue
+            f.seek(target - 1)
+            f.readline() #to the beginning of the next line
+            if f.tell() < size and f.tell() > bounds[-1]:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _filter_shard(starfile, start, stop, table, filters, columns, strip_paths,
+                  tmpdir):
+    '''
+    worker of filter_star_sharded: writes the rows of one byte range that pass
+    all filters to a temporary file. A range can run past the end of the
+    table: the offset of the next block is returned as end, None otherwise.
+    returns (temporary file, rows kept, rows read, end)
+    '''
+    filters = [f.bind(table) for f in filters]
+    idx = table.indices(columns) if columns else None
+    kept = total = 0
+    end = None
+    pos = start
+    fd, shard = tempfile.mkstemp(suffix='.star', dir=tmpdir)
+    with open(starfile, 'rb') as f, os.fdopen(fd, 'wb') as out:
+        f.seek(start)
+        while pos < stop:
+            line = f.readline()
+            if not line:
+                break
+            stripped = line.strip()
+            if stripped.startswith(b'data_') or stripped.startswith(b'loop_'):
+                end = pos
+                break
+            pos += len(line)
+            if not stripped or stripped.startswith(b'#'):
+                if idx is None:
+                    out.write(line)
+                continue
+            fields = _split(line)
+            total += 1
+            if not all(f(fields) for f in filters):
+                continue
+            kept += 1
+            if idx is None:
+                out.write(line if line.endswith(b'\n') else line + b'\n')
+            else:
+                values = [fields[i] for i in idx]
+                if strip_paths:
+                    values = [v.rpartition('/')[2] for v in values]
+                out.write(('\t'.join(values) + '\n').encode())
+    return shard, kept, total, end
+
+
+def filter_star_sharded(starfile, outfile, filters=(), columns=None, header=True,
+                        strip_paths=False, block=None, table=None, workers=None,
+                        shards=None):
+    '''
+    filter_star for large files: the rows of one loop are split at line
+    boundaries into byte ranges that are filtered in a process pool, and the
+    results are concatenated in the original order.
+    filters: ValueFilter, all of them must pass.
+    Without columns the output is the input file without the dropped rows.
+    With columns only that table is written, with only those columns
+    (header=False: only the values, strip_paths: without directories).
+    returns (rows kept, rows read)
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    if table is None:
+        column = columns[0] if columns else filters[0].column if filters else None
+        table = find_table(starfile, block, column)
+    workers = workers or os.cpu_count()
+    ranges = shard_ranges(starfile, table.start, shards or 4 * workers)
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outfile)))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_filter_shard, starfile, start, stop, table,
+                                       filters, columns, strip_paths, tmpdir)
+                       for start, stop in ranges]
+            kept = total = 0
+            with open(starfile, 'rb') as f, open(outfile, 'wb') as out:
+                if columns is None:
+                    out.write(f.read(table.start))
+                elif header:
+                    out.write('\ndata_{}\n\nloop_\n'.format(table.name).encode())
+                    for i, name in enumerate(columns, 1):
+                        out.write('{} #{}\n'.format(label(name), i).encode())
+                for future in futures:
+                    #the ranges after the end of the table may hold other
+                    #blocks and are not looked at
+                    shard, shard_kept, shard_total, end = future.result()
+                    with open(shard, 'rb') as part:
+                        shutil.copyfileobj(part, out)
+                    kept += shard_kept
+                    total += shard_total
+                    if end is not None:
+                        #the table ends here, the rest of the file is not touched
+                        if columns is None:
+                            f.seek(end)
+                            shutil.copyfileobj(f, out)
+                        for later in futures:
+                            later.cancel()
+                        break
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return kept, total
@@ -0,0 +1,66 @@
+import sys
+import pytest
+import fasta_io
+import change_headers
+
+
+def write(path, text):
+    path.write_bytes(text)
+    return str(path)
+
+
+def test_index_without_final_newline(tmp_path):
+    fasta = write(tmp_path / 't.fa', b'>a\nACGTACGT\nACG\n>b desc\nTTTT\nTT')
+    entries = fasta_io.build_index(fasta)
+    assert entries == [fasta_io.FaiEntry('a', 11, 3, 8, 9),
+                       fasta_io.FaiEntry('b', 6, 24, 4, 5)]
+    index = fasta_io.get_index(fasta)
+    assert fasta_io.fetch(fasta, index['a'], 6, 11) == b'GTACG'
+    assert fasta_io.fetch(fasta, index['b']) == b'TTTTTT'
+
+
+def test_single_line_without_newline(tmp_path):
+    fasta = write(tmp_path / 't.fa', b'>a\nACGTACGT')
+    entry, = fasta_io.build_index(fasta)
+    assert entry == fasta_io.FaiEntry('a', 8, 3, 8, 9)
+    assert fasta_io.fetch(fasta, entry, 2, 5) == b'GTA'
+
+
+def test_longer_last_line_is_rejected(tmp_path):
+    fasta = write(tmp_path / 't.fa', b'>a\nACG\nACGTACGT\n')
+    with pytest.raises(ValueError, match='longer'):
+        fasta_io.build_index(fasta)
+
+
+def run(monkeypatch, args):
+    monkeypatch.setattr(sys, 'argv', ['change_headers'] + args)
+    changer = change_headers.HeaderChanger()
+    changer.main()
+    return changer
+
+
+def test_fetch_error_exits(tmp_path, monkeypatch):
+    fasta = write(tmp_path / 't.fa', b'>a\nACG\nACGTACGT\n')
+    with pytest.raises(SystemExit, match='longer'):
+        run(monkeypatch, [fasta, '--fetch', 'a'])
+
+
+def test_uniquify_numbers_written_records(tmp_path, monkeypatch):
+    fasta = write(tmp_path / 't.fa', b'>x\nAAMKL\n>x\nGGGG\n>x\nCMKLA')
+    out = str(tmp_path / 'out.fa')
+    run(monkeypatch, [fasta, '-o', out, '--uniquify', '--motif', 'mkl',
+                      '--drop_missing', '--index'])
+    assert open(out, 'rb').read() == b'>x_1\nMKL\n>x_2\nMKLA\n'
+    assert fasta_io.load_index(out) == {e.name: e for e in fasta_io.build_index(out)}
+
+
+def test_failed_pass_leaves_nothing(tmp_path, monkeypatch):
+    fasta = write(tmp_path / 't.fa', b'>a\nACGT\nnot fasta')
+    def broken(fasta):
+        yield b'a', [b'ACGT']
+        raise ValueError('{} is broken'.format(fasta))
+    monkeypatch.setattr(fasta_io, 'iter_records', broken)
+    out = str(tmp_path / 'out.fa')
+    with pytest.raises(SystemExit, match='broken'):
+        run(monkeypatch, [fasta, '-o', out, '--uniquify', '--index'])
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['t.fa']
@@ -0,0 +1,70 @@
+import math
+import sys
+import pytest
+import gautomatch_screener
+
+
+def make_screener(test, default=None):
+    #only the attributes the adaptive search uses, no folders or gpus needed
+    screener = object.__new__(gautomatch_screener.Gautomatcher)
+    screener.test = test
+    screener.default = default or {}
+    screener.min_picks = 1
+    screener.target_picks = None
+    screener.max_rounds = 10
+    screener.tolerance = 0.01
+    screener.mrc_files = ['m0.mrc', 'm1.mrc']
+    screener.subset = 8
+    return screener
+
+
+def test_refine_values_stays_in_bounds():
+    screener = make_screener({'cc_cutoff': [0.05, 0.1, 0.3]})
+    bounds = screener.value_range('cc_cutoff')
+    assert bounds == (0.05, 0.3)
+    assert screener.refine_values({0.05, 0.1, 0.3}, 0.3, bounds) == [0.2]
+    assert screener.refine_values({0.05, 0.1, 0.3}, 0.05, bounds) == [0.075]
+    #without bounds the edge steps out
+    assert 0.5 in screener.refine_values({0.05, 0.1, 0.3}, 0.3)
+
+
+def test_objective_does_not_favour_fewer_picks():
+    screener = make_screener({})
+    foms = [i / 100 for i in range(100)]
+    #a higher cutoff only drops the weaker picks
+    loose = {'m0': [(0, 0, f) for f in foms if f >= 0.1]}
+    strict = {'m0': [(0, 0, f) for f in foms if f >= 0.9]}
+    assert screener.objective(loose) > screener.objective(strict)
+    assert screener.objective({'m0': []}) == -math.inf
+
+
+def test_search_ends_in_range_and_skips_failed_values():
+    screener = make_screener({'cc_cutoff': [0.1, 0.05, 0.3], 'lsigma_D': [200, 300, 400]},
+                             {'cc_cutoff': 0.1, 'lsigma_D': 200})
+    evaluated = []
+    def evaluate(mrcs, par, values, base):
+        evaluated.extend((par, v) for v in values if v != base[par])
+        #cc_cutoff: the mean figure of merit only rises; lsigma_D 400 always fails
+        if par == 'cc_cutoff':
+            return {v: v for v in values}
+        return {v: -abs(v - 300) for v in values if v != 400}
+    screener.evaluate = evaluate
+    best, score = screener.adaptive_search()
+    assert best == {'cc_cutoff': 0.3, 'lsigma_D': 300}
+    assert 0.05 <= best['cc_cutoff'] <= 0.3
+    assert evaluated.count(('lsigma_D', 400)) == 1
+    assert len(evaluated) == len(set(evaluated))
+
+
+@pytest.mark.parametrize('args, message', [
+    (['--n_threads', '0'], '--n_threads'),
+    (['--n_threads', '-2'], '--n_threads'),
+    (['--slots_per_gpu', '0'], '--slots_per_gpu'),
+    (['--retries', '-1'], '--retries'),
+])
+def test_check_args_rejects_bad_counts(tmp_path, monkeypatch, args, message):
+    (tmp_path / 'jpgs').mkdir()
+    monkeypatch.setattr(sys, 'argv', ['gautomatch_screener', '--mrc_folder',
+                                      str(tmp_path)] + args)
+    with pytest.raises(SystemExit, match=message):
+        gautomatch_screener.Gautomatcher()
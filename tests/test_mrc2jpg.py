@@ -0,0 +1,61 @@
+import json
+import os
+import sys
+import numpy as np
+import mrc_io
+import mrc2jpg
+
+MANIFEST = mrc2jpg.MANIFEST
+CONVERT = mrc2jpg.imageConverter.create_images_parallel
+
+
+def make_converter(monkeypatch, args):
+    monkeypatch.setattr(sys, 'argv', ['mrc2jpg'] + args)
+    return mrc2jpg.imageConverter()
+
+
+def run_watcher(monkeypatch, args, polls=3):
+    '''
+    runs --watch for a few polls, then stops it as Ctrl-C would.
+    returns the micrographs converted
+    '''
+    #patched on the class: the converter itself is sent to the worker processes
+    cls = mrc2jpg.imageConverter
+    converted = []
+    def create_images(self, mrclist):
+        converted.extend(os.path.basename(m) for m in mrclist)
+        return CONVERT(self, mrclist)
+    calls = []
+    def wait_for_changes(self, notifier):
+        calls.append(1)
+        if len(calls) >= polls:
+            raise KeyboardInterrupt
+        return set()
+    monkeypatch.setattr(cls, 'create_images_parallel', create_images)
+    monkeypatch.setattr(cls, 'start_notifier', lambda self: None)
+    monkeypatch.setattr(cls, 'wait_for_changes', wait_for_changes)
+    converter = make_converter(monkeypatch, args)
+    converter.watch_folder()
+    return converted
+
+
+def test_watch_restart_with_clip_does_not_redo(tmp_path, monkeypatch):
+    mrcs = tmp_path / 'mrcs'
+    jpgs = tmp_path / 'jpgs'
+    mrcs.mkdir()
+    jpgs.mkdir()
+    rng = np.random.default_rng(0)
+    for n in range(3):
+        mrc_io.write_mrc(str(mrcs / 'mic{}.mrc'.format(n)),
+                         rng.normal(size=(64, 64)).astype('f4'))
+    args = ['-i', str(mrcs), '-o', str(jpgs), '--watch', '--clip', '1,99',
+            '--n_cpus', '1', '--poll', '0']
+    first = run_watcher(monkeypatch, args)
+    assert sorted(first) == ['mic0.mrc', 'mic1.mrc', 'mic2.mrc']
+    with open(jpgs / MANIFEST) as f:
+        assert json.load(f)['mic0.mrc']['params']['clip'] == [1.0, 99.0]
+    #restarted with the same parameters: nothing left to do
+    assert run_watcher(monkeypatch, args) == []
+    #different clipping: everything again
+    args[args.index('1,99')] = '2,98'
+    assert sorted(run_watcher(monkeypatch, args)) == sorted(first)
@@ -0,0 +1,30 @@
+import numpy as np
+from mrc_filters import SHRINK_FIRST_MAX_SIGMA, Preprocessor, gaussian_lowpass, mean_shrink
+
+
+def test_threshold_passes_little_at_nyquist():
+    #transfer of the gaussian at the nyquist of the shrunk image
+    assert np.exp(-0.5 ** 2 / (2 * SHRINK_FIRST_MAX_SIGMA ** 2)) < 0.005
+
+
+def test_shrink_first_close_to_filter_first():
+    '''
+    at the largest cutoff that shrinks first, the result stays within a few
+    percent of filtering the full image and then shrinking
+    '''
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[:512, :512]
+    #white noise is the worst case: most of its power is above the new nyquist
+    image = (rng.standard_normal((512, 512)) + 3 * np.sin(x / 20) * np.cos(y / 33)
+             ).astype('f4')
+    for scale in (2, 4):
+        apix = 1.0
+        lowpass = SHRINK_FIRST_MAX_SIGMA / (apix * scale)
+        preprocessor = Preprocessor(lowpass=lowpass, scale=scale)
+        assert preprocessor.shrink_first(apix)
+        assert not Preprocessor(lowpass=lowpass * 1.1, scale=scale).shrink_first(apix)
+        fast = preprocessor(image, apix=apix)
+        exact = mean_shrink(gaussian_lowpass(image, lowpass * apix), scale)
+        assert fast.shape == exact.shape
+        assert np.sqrt(np.mean((fast - exact) ** 2)) < 0.03 * exact.std()
+        assert np.abs(fast - exact).max() < 0.03 * np.ptp(exact)
@@ -0,0 +1,120 @@
+import os
+import sys
+import pytest
+import rename_files
+
+DO_RENAME = rename_files.BulkRenamer.do_rename
+
+
+def make_files(folder, names):
+    #every file holds its original name
+    for name in names:
+        (folder / name).write_text(name)
+
+
+def contents(folder):
+    #{name: original name} of the files, the journal left out
+    return {p.name: p.read_text() for p in folder.iterdir()
+            if p.name != rename_files.JOURNAL}
+
+
+def run(monkeypatch, folder, *args):
+    monkeypatch.setattr(sys, 'argv', ['rename_files', '-f', str(folder)] + list(args))
+    return rename_files.BulkRenamer().main()
+
+
+def write_map(folder, pairs):
+    path = folder.parent / 'map.txt'
+    path.write_text(''.join('{} {}\n'.format(*p) for p in pairs))
+    return str(path)
+
+
+def test_renumber(tmp_path, monkeypatch):
+    make_files(tmp_path, ['m_1.tif', 'm_10.tif', 'm_2.tif', 'notes.txt'])
+    assert run(monkeypatch, tmp_path) == 2
+    assert contents(tmp_path) == {'m_01.tif': 'm_1.tif', 'm_02.tif': 'm_2.tif',
+                                  'm_10.tif': 'm_10.tif', 'notes.txt': 'notes.txt'}
+
+
+def test_swap(tmp_path, monkeypatch):
+    folder = tmp_path / 'data'
+    folder.mkdir()
+    make_files(folder, ['a.tif', 'b.tif'])
+    mapping = write_map(folder, [('a.tif', 'b.tif'), ('b.tif', 'a.tif')])
+    #each file goes through a temporary name: 2 renames each
+    assert run(monkeypatch, folder, '--map', mapping) == 4
+    assert contents(folder) == {'a.tif': 'b.tif', 'b.tif': 'a.tif'}
+
+
+def test_chain(tmp_path, monkeypatch):
+    #m_0 -> m_1 -> m_2 -> m_3, with --shift 1
+    make_files(tmp_path, ['m_0.tif', 'm_1.tif', 'm_2.tif'])
+    run(monkeypatch, tmp_path, '--shift', '1')
+    assert contents(tmp_path) == {'m_1.tif': 'm_0.tif', 'm_2.tif': 'm_1.tif',
+                                  'm_3.tif': 'm_2.tif'}
+
+
+@pytest.mark.parametrize('pairs, message', [
+    ([('a.tif', 'c.tif')], 'would overwrite c.tif'),
+    ([('a.tif', 'd.tif'), ('b.tif', 'd.tif')], 'would both become d.tif'),
+])
+def test_collision_aborts(tmp_path, monkeypatch, capsys, pairs, message):
+    folder = tmp_path / 'data'
+    folder.mkdir()
+    make_files(folder, ['a.tif', 'b.tif', 'c.tif'])
+    with pytest.raises(SystemExit, match='1 conflicts'):
+        run(monkeypatch, folder, '--map', write_map(folder, pairs))
+    assert message in capsys.readouterr().out
+    assert contents(folder) == {n: n for n in ['a.tif', 'b.tif', 'c.tif']}
+    assert not (folder / rename_files.JOURNAL).exists()
+
+
+def fail_once(monkeypatch, failures):
+    '''
+    do_rename fails for the sources in failures: 'before' without renaming,
+    'after' once the file is renamed, as if interrupted before the journal
+    was written
+    '''
+    def do_rename(self, src, dst):
+        when = failures.pop(src, None)
+        if when == 'before':
+            raise OSError('simulated failure')
+        DO_RENAME(self, src, dst)
+        if when == 'after':
+            raise OSError('simulated failure')
+    monkeypatch.setattr(rename_files.BulkRenamer, 'do_rename', do_rename)
+
+
+def test_resume_after_failure(tmp_path, monkeypatch):
+    folder = tmp_path / 'data'
+    folder.mkdir()
+    names = ['a.tif', 'b.tif', 'c.tif', 'd.tif']
+    make_files(folder, names)
+    #a cycle a -> b -> c -> a and a plain rename d -> e
+    pairs = [('a.tif', 'b.tif'), ('b.tif', 'c.tif'), ('c.tif', 'a.tif'),
+             ('d.tif', 'e.tif')]
+    fail_once(monkeypatch, {'b.tif': 'before', 'd.tif': 'after'})
+    #phase 1 is left half done, phase 2 is not started
+    assert run(monkeypatch, folder, '--map', write_map(folder, pairs)) == 2
+    assert 'e.tif' in contents(folder)
+    assert 'b.tif' in contents(folder)
+    assert run(monkeypatch, folder, '--resume') == 4
+    assert contents(folder) == {'b.tif': 'a.tif', 'c.tif': 'b.tif', 'a.tif': 'c.tif',
+                                'e.tif': 'd.tif'}
+    #nothing left to do
+    assert run(monkeypatch, folder, '--resume') == 0
+
+
+def test_undo(tmp_path, monkeypatch):
+    folder = tmp_path / 'data'
+    folder.mkdir()
+    names = ['a.tif', 'b.tif', 'm_1.tif']
+    make_files(folder, names)
+    pairs = [('a.tif', 'b.tif'), ('b.tif', 'a.tif'), ('m_1.tif', 'm_01.tif')]
+    run(monkeypatch, folder, '--map', write_map(folder, pairs))
+    assert contents(folder) == {'a.tif': 'b.tif', 'b.tif': 'a.tif', 'm_01.tif': 'm_1.tif'}
+    assert run(monkeypatch, folder, '--undo') == 5
+    assert contents(folder) == {n: n for n in names}
+    #a second undo finds nothing left
+    assert run(monkeypatch, folder, '--undo') == 0
+    assert contents(folder) == {n: n for n in names}
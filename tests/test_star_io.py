@@ -0,0 +1,165 @@
+import pytest
+import star_io
+
+HEAD = '''
+# version 30001
+
+data_optics
+
+loop_
+_rlnOpticsGroup #1
+_rlnVoltage #2
+1 300.0
+
+data_general
+
+_rlnImageSizeX 4096
+_rlnComment 'two words'
+
+data_particles
+
+loop_
+_rlnCoordinateX #1
+_rlnCoordinateY #2
+_rlnMicrographName #3
+_rlnDefocusU #4
+'''
+
+#the particles of a micrograph are not all next to each other
+ROWS = [(10.5, 20.0, 'mic_1.mrc', 10000),
+        (11.0, 21.0, 'mic_1.mrc', 10000),
+        (12.0, 22.0, 'mic_2.mrc', 12000),
+        (13.0, 23.0, 'mic_2.mrc', 12000),
+        (14.0, 24.0, 'mic_3.mrc', 15000),
+        (15.0, 25.0, 'mic_1.mrc', 10000)]
+
+TAIL = '''
+data_tail
+
+_rlnFoo bar
+'''
+
+
+def row(x, y, mic, defocus):
+    return '{} {} MotionCorr/job002/{} {}\n'.format(x, y, mic, defocus)
+
+
+def star_text(rows, tail=TAIL):
+    return HEAD + ''.join(row(*r) for r in rows) + tail
+
+
+@pytest.fixture
+def starfile(tmp_path):
+    path = tmp_path / 'particles.star'
+    path.write_text(star_text(ROWS))
+    return str(path)
+
+
+def test_blocks(starfile):
+    tables = star_io.read_tables(starfile)
+    assert [t.name for t in tables] == ['optics', 'general', 'particles', 'tail']
+    assert [t.loop for t in tables] == [True, False, True, False]
+    #the headers and the rows make up the whole file
+    text = open(starfile, 'rb').read()
+    assert b''.join(t.header + text[t.start:t.stop] for t in tables) == \
+           text[tables[0].offset:]
+
+
+def test_key_value_block(starfile):
+    general = star_io.find_table(starfile, 'general')
+    assert not general.loop
+    assert general.pairs == {'_rlnImageSizeX': '4096', '_rlnComment': 'two words'}
+    assert star_io.find_table(starfile, 'tail').pairs == {'_rlnFoo': 'bar'}
+
+
+def test_find_table(starfile):
+    assert star_io.find_table(starfile).name == 'optics'
+    assert star_io.find_table(starfile, column='rlnDefocusU').name == 'particles'
+    with pytest.raises(KeyError):
+        star_io.find_table(starfile, 'missing')
+
+
+def test_labels_with_and_without_underscore(starfile):
+    table = star_io.find_table(starfile, column='rlnMicrographName')
+    assert 'rlnMicrographName' in table and '_rlnMicrographName' in table
+    assert table.index('rlnMicrographName') == table.index('_rlnMicrographName') == 2
+    with pytest.raises(KeyError):
+        table.index('rlnAnglePsi')
+    rows = list(star_io.iter_rows(starfile, ['_rlnDefocusU', 'rlnCoordinateX']))
+    assert rows == [(str(r[3]), str(r[0])) for r in ROWS]
+    assert list(star_io.iter_rows(starfile, ['rlnVoltage'])) == [('300.0',)]
+
+
+def test_read_columns(starfile):
+    columns = star_io.read_columns(starfile, ['rlnCoordinateX', 'rlnDefocusU',
+                                              'rlnMicrographName'], chunk=4)
+    assert columns['rlnCoordinateX'].dtype.kind == 'f'
+    assert columns['rlnDefocusU'].dtype.kind == 'i'
+    assert columns['rlnDefocusU'].tolist() == [r[3] for r in ROWS]
+    assert columns['rlnMicrographName'][-1] == 'MotionCorr/job002/mic_1.mrc'
+
+
+def keep_mics(mics):
+    return lambda value: value.rpartition('/')[2] in mics
+
+
+def test_filter_star_round_trip(starfile, tmp_path):
+    out = str(tmp_path / 'out.star')
+    assert star_io.filter_star(starfile, out, lambda fields: True,
+                               block='particles') == (6, 6)
+    assert open(out).read() == open(starfile).read()
+    #without block or columns: the first loop
+    assert star_io.filter_star(starfile, out, lambda fields: False) == (0, 1)
+    assert open(out).read() == open(starfile).read().replace('1 300.0\n', '')
+
+
+@pytest.mark.parametrize('tail', [TAIL, ''])
+def test_filters_byte_identical(tmp_path, tail):
+    #with tail='' the last row has no line end
+    path = tmp_path / 'particles.star'
+    text = star_text(ROWS, tail)
+    path.write_text(text if tail else text.rstrip('\n'))
+    starfile = str(path)
+    expected = star_text([r for r in ROWS if r[2] != 'mic_2.mrc'], tail)
+    keep = keep_mics({'mic_1.mrc', 'mic_3.mrc'})
+
+    out = str(tmp_path / 'filter_star.star')
+    assert star_io.filter_star(starfile, out, lambda f: keep(f[0]),
+                               ['rlnMicrographName']) == (4, 6)
+    assert open(out).read() == expected
+
+    out = str(tmp_path / 'copy_rows.star')
+    index = star_io.get_index(starfile)
+    assert star_io.count_rows(index) == {'MotionCorr/job002/mic_1.mrc': 3,
+                                         'MotionCorr/job002/mic_2.mrc': 2,
+                                         'MotionCorr/job002/mic_3.mrc': 1}
+    assert star_io.copy_rows(starfile, out, index, keep) == (4, 6)
+    assert open(out).read() == expected
+
+    #more shards than rows: some of them start after the end of the table
+    out = str(tmp_path / 'sharded.star')
+    drop = star_io.ValueFilter('rlnMicrographName', {'mic_2.mrc'}, basename=True,
+                               drop=True)
+    assert star_io.filter_star_sharded(starfile, out, [drop], workers=2,
+                                       shards=20) == (4, 6)
+    assert open(out).read() == expected
+
+
+def test_sharded_columns(starfile, tmp_path):
+    out = str(tmp_path / 'names.txt')
+    defocus = star_io.ValueFilter('rlnDefocusU', minimum=11000)
+    kept, total = star_io.filter_star_sharded(starfile, out, [defocus],
+                                              columns=['rlnMicrographName'],
+                                              header=False, strip_paths=True,
+                                              workers=2, shards=3)
+    assert (kept, total) == (3, 6)
+    assert open(out).read() == 'mic_2.mrc\nmic_2.mrc\nmic_3.mrc\n'
+
+
+def test_index_is_rebuilt_when_the_file_changes(starfile):
+    star_io.build_index(starfile)
+    assert star_io.load_index(starfile) is not None
+    with open(starfile, 'a') as f:
+        f.write('\n')
+    assert star_io.load_index(starfile) is None
+    assert star_io.load_index(starfile, 'rlnDefocusU') is None
@@ -0,0 +1,61 @@
+from collections import Counter
+import word_frequency_psiblast as wf
+
+#a PSI-BLAST output with three iterations, two of them for the same query
+PSIBLAST = '''<?xml version="1.0"?>
+<BlastOutput>
+<BlastOutput_program>psiblast</BlastOutput_program>
+<BlastOutput_query-def>query A</BlastOutput_query-def>
+<BlastOutput_iterations>
+<Iteration><Iteration_iter-num>1</Iteration_iter-num>
+<Iteration_query-def>query A</Iteration_query-def><Iteration_hits>
+<Hit><Hit_num>1</Hit_num><Hit_def>DNA polymerase [Homo sapiens]</Hit_def></Hit>
+<Hit><Hit_num>2</Hit_num><Hit_def>LOW QUALITY PROTEIN: kinesin-like protein KIF11 isoform X1 [Mus musculus]</Hit_def></Hit>
+</Iteration_hits></Iteration>
+<Iteration><Iteration_iter-num>2</Iteration_iter-num>
+<Iteration_query-def>No definition line</Iteration_query-def><Iteration_hits>
+<Hit><Hit_num>1</Hit_num><Hit_def>DNA  polymerase  [Homo sapiens]</Hit_def></Hit>
+<Hit><Hit_num>2</Hit_num><Hit_def>Heat shock protein 70, partial [Danio rerio]</Hit_def></Hit>
+</Iteration_hits></Iteration>
+<Iteration><Iteration_iter-num>1</Iteration_iter-num>
+<Iteration_query-def>query C</Iteration_query-def><Iteration_hits>
+<Hit><Hit_num>1</Hit_num><Hit_def>tubulin alpha chain [Sus scrofa]</Hit_def></Hit>
+</Iteration_hits></Iteration>
+</BlastOutput_iterations>
+</BlastOutput>
+'''
+
+TAGS_A = Counter({'DNA polymerase': 2,
+                  'LOW QUALITY PROTEIN: kinesin-like protein KIF11': 1,
+                  'Heat shock protein 70,': 1})
+#LOW, QUALITY and PROTEIN are not counted as words
+WORDS_A = Counter({'DNA': 2, 'polymerase': 2, 'kinesin-like': 1, 'KIF11': 1,
+                   'Heat': 1, 'shock': 1, '70': 1})
+TAGS_C = Counter({'tubulin alpha chain': 1})
+WORDS_C = Counter({'tubulin': 1, 'alpha': 1, 'chain': 1})
+
+
+def write_xml(tmp_path):
+    xml_file = tmp_path / 'psiblast.xml'
+    xml_file.write_text(PSIBLAST)
+    return str(xml_file)
+
+
+def test_parse_result(tmp_path):
+    tags, words = wf.parse_result(write_xml(tmp_path))
+    assert tags == TAGS_A + TAGS_C
+    assert words == WORDS_A + WORDS_C
+
+
+def test_counts_by_query(tmp_path):
+    #an iteration without definition line belongs to the query of the file
+    assert wf.count_file(write_xml(tmp_path)) == {'query A': (TAGS_A, WORDS_A),
+                                                  'query C': (TAGS_C, WORDS_C)}
+
+
+def test_count_files_merges(tmp_path):
+    xml_file = write_xml(tmp_path)
+    tags, words, queries = wf.count_files([xml_file, xml_file], workers=1)
+    assert tags == (TAGS_A + TAGS_C) + (TAGS_A + TAGS_C)
+    assert words == (WORDS_A + WORDS_C) + (WORDS_A + WORDS_C)
+    assert queries['query C'] == (TAGS_C + TAGS_C, WORDS_C + WORDS_C)
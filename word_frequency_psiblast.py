@@ -1,9 +1,9 @@
 import os
 import sys
-import matplotlib.pyplot as plt
-import numpy as np
 import re
-from bs4 import BeautifulSoup
+import xml.etree.ElementTree as ET
+from collections import Counter
+from functools import lru_cache
 
 clean = ['\[.*\]',
              'isoform X[0-9]',
@@ -20,7 +20,7 @@ clean = ['\[.*\]',
 useless_words = {'[uU]ncharacteri[sz]ed',
                      '[Pp]rotein',
                      'PROTEIN',
-                     'LOW'
+                     'LOW',
                      'QUALITY',
                      'containing',
                      'domain-containing',
@@ -32,90 +32,251 @@ useless_words = {'[uU]ncharacteri[sz]ed',
                      'function',
                      'unknown'}  #shorter than 2
 
-colors = iter(('red', 'orange'))
+#compiled once, not for every description/token
+CLEAN = re.compile('|'.join(clean))
+USELESS = re.compile('|'.join(useless_words))
+PUNCTUATION = re.compile('[\(\[\{\}\]\)\,\;\.\:]')
+NOT_ALPHANUMERIC = re.compile('[^A-z0-9]') #otherwise N-formyl will match
+TOO_SHORT = re.compile(r'\b[A-z]{1,2}\b')
 
-def plot_frequencies(final_text):
-    freq={}
-#     match_pattern = re.findall(r'\b[a-z]{1,15}\b', final_text)
-    try:
-        match_pattern = final_text.split()
-    except AttributeError as e:
-        if isinstance(final_text, list):
-            match_pattern = final_text
-        else:
-            raise e
-    for word in match_pattern:
-        count=freq.get(word,0)
-        freq[word]=count + 1
-    frequency_list = freq.keys()
-#     for words in frequency_list:
-#         print(words + ' -> ' + str(freq[words]))
-    results = []
-    for word in frequency_list:
-        tuple_ = (word, freq[word])
-        results.append(tuple_)
-    byFreq=sorted(results, key=lambda word: word[1], reverse=True)
-    words_names=[]
-    words_count=[]
-    for (word, freq) in byFreq[:]:
-#         print (word, freq)
-        words_names.append(word)
-        words_count.append(freq)
+TOP = 30 #words in the tables and plots of a report
+
+def plot_frequencies(counts, color='red', top=None, outfile=None, title=None):
+    '''
+    horizontal bars of the top most common words. Shown, or with outfile
+    saved to it (the caller must have selected a non interactive backend)
+    '''
+    import matplotlib.pyplot as plt
+    import numpy as np
+    if not isinstance(counts, Counter):
+        counts = Counter(counts.split() if isinstance(counts, str) else counts)
+    byFreq = counts.most_common(top)
+    words_names = [word for word, _ in byFreq]
+    words_count = [freq for _, freq in byFreq]
     # Plot histogram using matplotlib bar()
-    plt.figure()
-    plt.ylabel('Words')
-    plt.xlabel('Frequency')
+    fig, ax = plt.subplots(figsize=(8, max(4, 0.25 * len(words_names) + 1)))
+    ax.set_ylabel('Words')
+    ax.set_xlabel('Frequency')
+    if title:
+        ax.set_title(title)
     indexes = np.arange(len(words_names) )
     width = .4
-    plt.barh(indexes, words_count, width, color=next(colors))
-    plt.yticks(indexes + width * .4, words_names)
-    plt.tick_params(labelsize='small')
-    #plt.legend()
-#     plt.tight_layout()
-    plt.show(block=False)
-
-def parse_result(xml_file):    
-    with open (xml_file, 'r') as f:
-        soup = BeautifulSoup(f.read(), 'lxml')
-    descriptions = soup.find_all('hit_def')
-    tags = []
-    mega_regexp = '|'.join(clean)
+    ax.barh(indexes, words_count, width, color=color)
+    ax.set_yticks(indexes + width * .4)
+    ax.set_yticklabels(words_names)
+    ax.invert_yaxis() #most common on top
+    ax.tick_params(labelsize='small')
+    if outfile:
+        fig.savefig(outfile, bbox_inches='tight')
+        plt.close(fig)
+    else:
+        plt.show(block=False)
+
+def iter_hits(xml_file):
+    '''
+    (query, text) of every Hit_def of a BLAST xml, streamed. The query is
+    the definition line of the query of the iteration. Every element is
+    removed from the tree as soon as it is closed, so memory use does not
+    depend on the size of the file
+    '''
+    open_elements = []
+    default = query = os.path.basename(xml_file)
+    with open(xml_file, 'rb') as f:
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                open_elements.append(elem)
+                if elem.tag == 'Iteration':
+                    query = default
+                continue
+            open_elements.pop()
+            if elem.tag == 'Hit_def' and elem.text:
+                yield query, elem.text
+            elif elem.tag in ('Iteration_query-def', 'BlastOutput_query-def') \
+                    and elem.text and elem.text != 'No definition line':
+                query = elem.text
+                if elem.tag == 'BlastOutput_query-def':
+                    default = query
+            if open_elements:
+                open_elements[-1].remove(elem)
+
+def iter_hit_defs(xml_file):
+    return (text for _, text in iter_hits(xml_file))
+
+@lru_cache(maxsize=2 ** 16)
+def clean_description(text):
+    #remove species names and other bullshit
+    return ' '.join(CLEAN.sub('', text).split())
+
+@lru_cache(maxsize=2 ** 18)
+def clean_token(token):
+    #the token without punctuation, or None if it is not worth counting.
+    #The same words come up over and over, each is checked once
+    token = PUNCTUATION.sub('', token) #remove punctuation & parentheses
+    if TOO_SHORT.match(NOT_ALPHANUMERIC.sub('', token)):
+        return None
+    if USELESS.search(token):
+        return None
+    return token
+
+def count_words(descriptions, tags=None, words=None):
+    '''
+    counts the cleaned descriptions in tags and their words in words
+    (Counters, new ones if not given). Returns (tags, words)
+    '''
+    tags = Counter() if tags is None else tags
+    words = Counter() if words is None else words
     for text in descriptions:
-        for tag in text:
-            t = re.sub(mega_regexp, '', tag) #remove species names and other bullshit
-            tags.append(t)
-    mega_regexp = re.compile('|'.join(useless_words))
-    words = []
-    discarded = []
-    for tag in tags[:]:
+        tag = clean_description(text)
+        tags[tag] += 1
         for token in tag.split():
-            token = re.sub('[\(\[\{\}\]\)\,\;\.\:]','',token) #remove punctuation & parentheses
-            t = re.sub('[^A-z0-9]', '', token) #otherwise N-formyl will match
-            if re.compile(r'\b[A-z]{1,2}\b').match(t): 
-                continue
-            if not mega_regexp.search(token):
-                words.append(token)
-            else:
-                discarded.append(token)
-    return tags, ' '.join(words)
+            token = clean_token(token)
+            if token:
+                words[token] += 1
+    return tags, words
+
+def parse_result(xml_file):
+    '''
+    returns (tags, words): Counters of the cleaned hit descriptions and of
+    the words in them
+    '''
+    return count_words(iter_hit_defs(xml_file))
             
     
 
+def count_file(xml_file):
+    '''
+    {query: (tags, words)} of one xml file. Run in the worker processes
+    of a report
+    '''
+    counts = {}
+    for query, text in iter_hits(xml_file):
+        if query not in counts:
+            counts[query] = (Counter(), Counter())
+        count_words([text], *counts[query])
+    return counts
+
+def list_xml(paths):
+    #the xml files, folders are searched (not recursively)
+    xml_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            with os.scandir(path) as entries:
+                xml_files += sorted(e.path for e in entries if e.name.endswith('.xml'))
+        elif os.path.isfile(path):
+            xml_files.append(path)
+        else:
+            sys.exit(f'{path} does not exist')
+    if not xml_files:
+        sys.exit('No xml files found')
+    return xml_files
+
+def count_files(xml_files, workers=None):
+    '''
+    parses the files in a process pool and merges their counts.
+    Returns (tags, words, {query: (tags, words)})
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    workers = min(workers or os.cpu_count(), len(xml_files))
+    tags, words, queries = Counter(), Counter(), {}
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(count_file, xml_files)
+    else:
+        executor = None
+        results = map(count_file, xml_files)
+    try:
+        for n, (xml_file, counts) in enumerate(zip(xml_files, results), 1):
+            for query, (query_tags, query_words) in counts.items():
+                if query not in queries:
+                    queries[query] = (Counter(), Counter())
+                queries[query][0].update(query_tags)
+                queries[query][1].update(query_words)
+                tags.update(query_tags)
+                words.update(query_words)
+            print(f'{n}/{len(xml_files)} {os.path.basename(xml_file)}')
+    finally:
+        if executor:
+            executor.shutdown()
+    return tags, words, queries
+
+def write_table(outfile, tables, top=TOP):
+    '''
+    tab separated top words of every (name, Counter) in tables: name, rank,
+    word, count and fraction of all the words of that name
+    '''
+    with open(outfile, 'w') as f:
+        f.write('\t'.join(('query', 'rank', 'word', 'count', 'fraction')) + '\n')
+        for name, counts in tables:
+            total = sum(counts.values())
+            for rank, (word, count) in enumerate(counts.most_common(top), 1):
+                f.write(f'{name}\t{rank}\t{word}\t{count}\t{count / total:.5f}\n')
+
+def safe_name(name):
+    return re.sub('[^A-Za-z0-9_.-]+', '_', name)[:100]
+
+def report(xml_files, outdir, top=TOP, workers=None, plot_queries=False):
+    '''
+    overall and per query frequencies of a batch of xml files, as tables
+    and png plots in outdir
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    tags, words, queries = count_files(xml_files, workers)
+    write_table(os.path.join(outdir, 'words.tsv'), [('all', words)], top)
+    write_table(os.path.join(outdir, 'descriptions.tsv'), [('all', tags)], top)
+    write_table(os.path.join(outdir, 'query_words.tsv'),
+                ((q, queries[q][1]) for q in sorted(queries)), top)
+    write_table(os.path.join(outdir, 'query_descriptions.tsv'),
+                ((q, queries[q][0]) for q in sorted(queries)), top)
+    print(f'{sum(tags.values())} hits of {len(queries)} queries in {len(xml_files)} '
+          f'files. Tables written to {outdir}')
+    #plots are optional, the tables are there even without matplotlib
+    try:
+        import matplotlib
+    except ImportError:
+        print('matplotlib is not installed, no plots written')
+        return
+    matplotlib.use('Agg') #no display on the cluster
+    title = f'{len(xml_files)} files, {len(queries)} queries'
+    plot_frequencies(words, 'red', top, os.path.join(outdir, 'words.png'), title)
+    plot_frequencies(tags, 'orange', top, os.path.join(outdir, 'descriptions.png'), title)
+    if plot_queries:
+        query_dir = os.path.join(outdir, 'queries')
+        os.makedirs(query_dir, exist_ok=True)
+        for query, (query_tags, query_words) in queries.items():
+            plot_frequencies(query_words, 'red', top, 
+                             os.path.join(query_dir, safe_name(query) + '_words.png'), query)
+    print(f'Plots written to {outdir}')
+
 def main(xml_file):
+    import matplotlib.pyplot as plt
     tags, words = parse_result(xml_file)
-    x = plot_frequencies(words)
-    y = plot_frequencies(tags)
+    x = plot_frequencies(words, 'red')
+    y = plot_frequencies(tags, 'orange')
     plt.show()
 
 
     
+def command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description='Word frequencies of the hit '
+                                     'descriptions of BLAST xml outputs')
+    parser.add_argument('xml', nargs='+', help='xml files, or folders with xml '
+                        'files. A single file without -o is plotted interactively')
+    parser.add_argument('-o', help='Output folder of the report (tables and plots)')
+    parser.add_argument('--top', help=f'Most common words reported. Default: {TOP}',
+                        type=int, default=TOP)
+    parser.add_argument('--workers', help='Files parsed at the same time. '
+                        'Default: number of cores', type=int)
+    parser.add_argument('--plot_queries', help='Also plot the words of every query',
+                        action='store_true')
+    args = parser.parse_args()
+    xml_files = [os.path.abspath(f) for f in list_xml(args.xml)]
+    if len(xml_files) == 1 and not args.o and not os.path.isdir(args.xml[0]):
+        main(xml_files[0])
+        return
+    report(xml_files, args.o or 'word_frequency_report', args.top, args.workers,
+           args.plot_queries)
+
+
 if __name__ == '__main__':
-    try:
-        xml_file = os.path.abspath(sys.argv[1])
-    except IndexError:
-        print('''\nPlease specify input file, e.g. python word_frequency_psyblast.py input_file.\n''')
-        sys.exit()
-    if not os.path.isfile(xml_file):
-        print(f'\n{xml_file} does not exist. Please input a valid file name\n')
-        sys.exit()
-    main(xml_file)
\ No newline at end of file
+    command_line()
\ No newline at end of file